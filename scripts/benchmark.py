@@ -0,0 +1,109 @@
+"""Measure Hark machine throughput (steps per second)
+
+Usage: python scripts/benchmark.py [N] [REPEATS]
+
+Runs some compute-heavy Hark functions with the in-memory controller, in the
+current thread, and reports the number of machine steps executed per second at
+each probe level (and with sampled step tracing).
+"""
+import gc
+import sys
+import time
+
+from hark_lang.controllers.local import DataController
+from hark_lang.executors.thread import Invoker
+from hark_lang.load import compile_text
+from hark_lang.machine import types as mt
+from hark_lang.machine.machine import TlMachine
+from hark_lang.machine.probe import Probe, ProbeLevel
+
+PROGRAM = """
+fn fib(n) {
+  if n < 2 {
+    n
+  }
+  else {
+    fib(n - 1) + fib(n - 2)
+  }
+}
+
+fn count(n, acc) {
+  if n == 0 {
+    acc
+  }
+  else {
+    count(n - 1, acc + n)
+  }
+}
+
+fn build(n, acc) {
+  if n == 0 {
+    length(acc)
+  }
+  else {
+    build(n - 1, append(acc, n))
+  }
+}
+
+fn fib_main(n) {
+  fib(parse_float(n) / 10)
+}
+
+fn count_main(n) {
+  count(parse_float(n) * 50, 0)
+}
+
+fn build_main(n) {
+  build(parse_float(n) * 5, null)
+}
+"""
+
+BENCHMARKS = ["fib_main", "count_main", "build_main"]
+
+# (name, probe level, step sample period)
+PROBE_SETTINGS = [
+    ("off", ProbeLevel.OFF, 1),
+    ("lifecycle", ProbeLevel.LIFECYCLE, 1),
+    ("calls", ProbeLevel.CALLS, 1),
+    ("steps/100", ProbeLevel.STEPS, 100),
+    ("steps", ProbeLevel.STEPS, 1),
+]
+
+
+def run_once(exe, function, n: str, level: ProbeLevel, sample: int):
+    """Run FUNCTION to completion and return (steps, seconds)"""
+    controller = DataController()
+    controller.set_executable(exe)
+    invoker = Invoker(controller)
+    vmid = controller.toplevel_machine(exe.bindings[function], [mt.TlString(n)])
+    machine = TlMachine(vmid, invoker)
+    machine.probe = Probe(vmid, level, sample)
+    gc.collect()
+    start = time.perf_counter()
+    machine.run()
+    elapsed = time.perf_counter() - start
+    if controller.broken:
+        raise RuntimeError(machine.state.error_msg)
+    return machine._steps, elapsed
+
+
+def main(n: int = 200, repeats: int = 3):
+    exe = compile_text(PROGRAM)
+    print(
+        f"{'BENCHMARK':<12} {'PROBE':<10} {'STEPS':>10} {'SECONDS':>10} {'STEPS/S':>12}"
+    )
+    for function in BENCHMARKS:
+        for name, level, sample in PROBE_SETTINGS:
+            # Best of N, to reduce noise
+            steps, elapsed = min(
+                (run_once(exe, function, str(n), level, sample) for _ in range(repeats)),
+                key=lambda r: r[1],
+            )
+            rate = steps / elapsed
+            print(
+                f"{function:<12} {name:<10} {steps:>10} {elapsed:>10.3f} {rate:>12.0f}"
+            )
+
+
+if __name__ == "__main__":
+    main(*map(int, sys.argv[1:]))
@@ -3,19 +3,20 @@
 Usage:
   hark [options] info
   hark [options] init
-  hark [options] asm FILE
+  hark [options] asm [-O] FILE
   hark [options] deploy
   hark [options] destroy
   hark [options] invoke [-f FUNCTION] [--async] [ARG...]
   hark [options] events [--unified | --json] [SESSION_ID]
   hark [options] stdout [--json] [SESSION_ID]
-  hark [options] FILE [-f FUNCTION] [-s MODE] [-c MODE] [ARG...]
+  hark [options] FILE [-f FUNCTION] [-s MODE] [-c MODE] [-w N] [ARG...]
   hark --version
   hark -h | --help
 
 Commands:
   info     Show info about this Hark environment
   asm      Compile a file and print the bytecode listing.
+           Use -O to show the optimised bytecode (which is what runs).
   deploy   Deploy to the cloud.
   destroy  Remove cloud deployment.
   invoke   Invoke a Hark function in the cloud.
@@ -35,8 +36,13 @@ Options:
 
   -f FUNCTION, --function=FUNCTION  Target function      [default: main]
   -s MODE, --storage=MODE           memory | dynamodb    [default: memory]
-  -c MODE, --concurrency=MODE       processes | threads  [default: threads]
+  -c MODE, --concurrency=MODE       processes | threads | green | asyncio
+                                    [default: threads]
+  -w N, --workers=N                 Max threads running at once (threads mode)
+  -p LEVEL, --probe=LEVEL           off | lifecycle | calls | steps
+  --probe-sample=N                  Only record every Nth step event
 
+  -O, --optimised  Show optimised bytecode
   -u, --unified  Merge events into one table
   -j, --json     Print as json
 
@@ -120,6 +126,19 @@ def _run(args):
 
     LOG.info(f"Running `{fn}` in {filename} ({len(fn_args)} args)...")
 
+    # Override the probe defaults (from HARK_PROBE_LEVEL/SAMPLE) for this run
+    if args["--probe"] or args["--probe-sample"]:
+        from ..machine import probe
+
+        try:
+            sample = int(args["--probe-sample"]) if args["--probe-sample"] else None
+        except ValueError:
+            exit_problem("Bad probe sample period", "It must be an integer.")
+        probe.configure(
+            level=probe.ProbeLevel.parse(args["--probe"]) if args["--probe"] else None,
+            sample=sample,
+        )
+
     # Try to find a timeout for the task. NOTE: we use the "lambda" timeout even
     # for local invocations. Maybe there should be a more general timeout
     try:
@@ -130,6 +149,11 @@ def _run(args):
         # default. Maybe it should be None.
         timeout = 60
 
+    try:
+        workers = int(args["--workers"]) if args["--workers"] else None
+    except ValueError:
+        exit_problem("Bad number of workers", "It must be an integer.")
+
     supported_storages = ["memory", "dynamodb"]
 
     if args["--storage"] not in supported_storages:
@@ -139,23 +163,35 @@ def _run(args):
         )
 
     if args["--storage"] == "memory":
-        if args["--concurrency"] == "processes":
-            exit_problem(
-                "Can't use processes with in-memory storage",
-                "Processes can only be used with a thread-safe memory store, like dynamodb",
-            )
-
-        from ..run.local import run_local
+        from ..run.local import (
+            run_local,
+            run_local_async,
+            run_local_green,
+            run_local_processes,
+        )
 
-        result = run_local(filename, fn, fn_args, timeout)
+        if args["--concurrency"] == "processes":
+            result = run_local_processes(filename, fn, fn_args, timeout)
+        elif args["--concurrency"] == "green":
+            result = run_local_green(filename, fn, fn_args, timeout)
+        elif args["--concurrency"] == "asyncio":
+            result = run_local_async(filename, fn, fn_args, timeout)
+        else:
+            result = run_local(filename, fn, fn_args, timeout, workers=workers)
 
     elif args["--storage"] == "dynamodb":
         from ..run.dynamodb import run_ddb_local, run_ddb_processes
 
+        if args["--concurrency"] in ("green", "asyncio"):
+            exit_problem(
+                "Can't use green threads or asyncio with dynamodb storage",
+                "Use threads or processes, or in-memory storage",
+            )
+
         if args["--concurrency"] == "processes":
             result = run_ddb_processes(filename, fn, fn_args, timeout)
         else:
-            result = run_ddb_local(filename, fn, fn_args, timeout)
+            result = run_ddb_local(filename, fn, fn_args, timeout, workers=workers)
 
     else:
         raise ValueError(args["--storage"])
@@ -168,7 +204,7 @@ def _asm(args):
     """Compile a file and print the assembly"""
     from ..load import compile_file
 
-    exe = compile_file(Path(args["FILE"]))
+    exe = compile_file(Path(args["FILE"]), optimise=args["--optimised"])
     print(neutral("\nBYTECODE:"))
     exe.listing()
     print(neutral("\nBINDINGS:\n"))
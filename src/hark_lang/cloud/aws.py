@@ -457,6 +457,7 @@ class ExecutionRole:
                         "dynamodb:PutItem",
                         "dynamodb:UpdateItem",
                         "dynamodb:DeleteItem",
+                        "dynamodb:BatchWriteItem",
                         "dynamodb:DescribeTable",
                     ],
                     "Resource": table_arn,
@@ -713,6 +714,8 @@ class HarkFunction:
             "DYNAMODB_TABLE": DataTable.resource_name(config),
             "USE_LIVE_AWS": "foo",  # setting this to "yes" breaks AWS...?
             "RESUME_FN_NAME": FnResume.resource_name(config),
+            # Don't pay for call/step tracing in production by default
+            "HARK_PROBE_LEVEL": "lifecycle",
             **user_env,
         }
 
@@ -6,7 +6,7 @@ session.
 
 Data per session:
 - futures (resolved, value, chain, continuations - machine, offset)
-- machines (probe logs, state - ip, stopped flag, stacks, and bindings)
+- machines (probe logs, state - ip, stopped flag, stacks, and locals)
 
 Data exchange points:
 - machine forks (State of new machine set to point at the fork IP)
@@ -17,12 +17,20 @@ Data exchange points:
 - machine stops (upload the State)
 - machine continues (download the State)
 """
-import functools
+import contextlib
+import json
 import logging
 import sys
+import threading
 import time
+import uuid
 import warnings
-from typing import List, Tuple
+from typing import List, Optional, Tuple
+
+from pynamodb.constants import STRING_SHORT
+from pynamodb.exceptions import TransactWriteError, UpdateError
+from pynamodb.expressions.condition import size
+from pynamodb.transactions import TransactWrite
 
 from ..machine import future as fut
 from ..machine.controller import Controller, ControllerError
@@ -30,9 +38,11 @@ from . import ddb_model as db
 from .ddb_model import (
     AREC,
     FUTURE,
+    JOIN,
     META,
     PEVENTS,
     PLOGS,
+    RUN,
     STATE,
     STDOUT,
     PLUGINS_HASH_KEY,
@@ -54,6 +64,12 @@ LOG = logging.getLogger(__name__)
 
 class DataController(Controller):
     supports_plugins = True
+    # Number of State deltas to save before writing a full snapshot again
+    snapshot_interval = 10
+    # Approximate size (bytes) of output stream chunks (the item limit is 400k)
+    chunk_size = 64 * 1024
+    # Number of activation record IDs to reserve at a time
+    arec_block_size = 16
 
     @classmethod
     def with_new_session(cls):
@@ -84,6 +100,19 @@ class DataController(Controller):
             self.executable = None
             # It's allowed to initialise a controller with no executable, as
             # long as the user calls set_executable before creating a machine.
+        # vmid -> (copy of the State as last saved/loaded, number of deltas,
+        # state version)
+        self._saved_states = {}
+        # Output stream group -> (serialised item, size) not written yet
+        self._buffers = {STDOUT: [], PEVENTS: [], PLOGS: []}
+        self._buffered_size = 0  # approximate, in bytes
+        self._buffer_lock = threading.Lock()
+        # Activation records made by this controller, but not saved yet (ptr ->
+        # ActivationRecord). Only this controller can see them, so they're
+        # changed in memory. See _save_unsaved.
+        self._unsaved_arecs = {}
+        self._arec_lock = threading.RLock()
+        self._free_arec_ptrs = []  # reserved, but not used yet
 
     def _qry(self, group, item_id=None):
         """Retrieve the specified group:item_id"""
@@ -95,41 +124,81 @@ class DataController(Controller):
                 f"Item {_key} does not exist in {self.session_id}"
             ) from exc
 
-    @functools.lru_cache
-    def _lock_item(self, group: str, item_id=None) -> db.SessionLocker:
-        """Get a context manager that locks the specified group:item_id"""
-        item = self._qry(group, item_id)
-        return db.SessionLocker(item)
+    def _update_meta(self, *actions):
+        """Atomically update the META item
+
+        NOTE: META is only ever changed with update expressions, never saved
+        whole, so that there's no need to lock it.
+        """
+        s = self.SI(self.session_id, META)
+        s.update(actions=list(actions))
+        return s.meta
 
     def set_executable(self, exe):
         self.executable = exe
-        s = self._qry(META)
-        s.meta.exe = exe.serialise()
-        s.save()
+        self._update_meta(self.SI.meta.exe.set(exe.serialise()))
         LOG.info("Updated session code")
 
     def set_entrypoint(self, fn_name: str):
-        s = self._qry(META)
-        s.meta.entrypoint = fn_name
-        s.save()
+        self._update_meta(self.SI.meta.entrypoint.set(fn_name))
 
     ## Threads
 
     def new_thread(self) -> int:
         """Create a new thread, returning the thead ID"""
-        with self._lock_item(META):
-            s = self._qry(META)
-            vmid = s.meta.num_threads
-            s.meta.num_threads += 1
-            s.meta.stopped.append(False)
-            s.save()
-
-        db.new_session_item(self.session_id, f"{STATE}:{vmid}", state=State([])).save()
+        meta = self._update_meta(
+            self.SI.meta.num_threads.set(self.SI.meta.num_threads + 1),
+            self.SI.meta.num_running.set(self.SI.meta.num_running + 1),
+        )
+        vmid = meta.num_threads - 1
+
+        db.new_session_item(
+            self.session_id,
+            f"{STATE}:{vmid}",
+            state=State([]),
+            state_deltas=[],
+            state_version=0,
+        ).save()
         db.new_session_item(
             self.session_id, f"{FUTURE}:{vmid}", future=fut.Future()
         ).save()
+        db.new_session_item(self.session_id, f"{RUN}:{vmid}", stopped=False).save()
         return vmid
 
+    def new_threads(self, count):
+        """Reserve thread and activation record IDs with one META update"""
+        meta = self._update_meta(
+            self.SI.meta.num_threads.set(self.SI.meta.num_threads + count),
+            self.SI.meta.num_arecs.set(self.SI.meta.num_arecs + count),
+            self.SI.meta.num_running.set(self.SI.meta.num_running + count),
+        )
+        first_vmid = meta.num_threads - count
+        first_ptr = meta.num_arecs - count
+        vmids = list(range(first_vmid, first_vmid + count))
+        ptrs = list(range(first_ptr, first_ptr + count))
+        return vmids, ptrs
+
+    def init_threads(self, threads):
+        """Write the items of new threads in batches
+
+        The threads were already counted as running by new_threads. Unsaved
+        activation records are saved too, as the threads may refer to them.
+        """
+        with self._arec_lock, self.SI.batch_write() as batch:
+            self._save_unsaved(batch)
+            for vmid, ptr, arec, state in threads:
+                items = [
+                    (f"{AREC}:{ptr}", dict(arec=arec)),
+                    (
+                        f"{STATE}:{vmid}",
+                        dict(state=state, state_deltas=[], state_version=0),
+                    ),
+                    (f"{FUTURE}:{vmid}", dict(future=fut.Future())),
+                    (f"{RUN}:{vmid}", dict(stopped=False)),
+                ]
+                for item_id, data in items:
+                    batch.save(db.new_session_item(self.session_id, item_id, **data))
+
     def get_thread_ids(self) -> List[int]:
         """Get a list of thread IDs in this session"""
         s = self._qry(META)
@@ -143,22 +212,83 @@ class DataController(Controller):
 
     def all_stopped(self):
         s = self._qry(META)
-        return all(s.meta.stopped)
+        return s.meta.num_running == 0
 
     def set_stopped(self, vmid, stopped: bool):
-        with self._lock_item(META):
-            s = self._qry(META)
-            s.meta.stopped[vmid] = stopped
-            s.save()
+        # Only change the running count if the flag actually changes. Both
+        # are written in one transaction, so they can't disagree.
+        change = -1 if stopped else 1
+        # Use the model's (cached) connection, rather than a new client each time
+        connection = self.SI._get_connection().connection
+        try:
+            with TransactWrite(connection=connection) as transaction:
+                transaction.update(
+                    self.SI(self.session_id, f"{RUN}:{vmid}"),
+                    actions=[self.SI.stopped.set(stopped)],
+                    condition=(self.SI.stopped != stopped),
+                )
+                transaction.update(
+                    self.SI(self.session_id, META),
+                    actions=[
+                        self.SI.meta.num_running.set(
+                            self.SI.meta.num_running + change
+                        )
+                    ],
+                )
+        except TransactWriteError:
+            # The reason isn't always given, but if the flag is already set,
+            # the condition failed -- and there's nothing to do anyway
+            if self._qry(RUN, vmid).stopped == stopped:
+                return
+            raise
 
     def set_state(self, vmid, state):
         # NOTE: no locking required, no inter-thread state access allowed
-        s = self._qry(STATE, vmid)
-        s.state = state
-        s.save()
+        saved = self._saved_states.get(vmid)
+        if saved and saved[1] < self.snapshot_interval:
+            base, num_deltas, version = saved
+            s = self.SI(self.session_id, f"{STATE}:{vmid}")
+            try:
+                # The condition catches deltas or full saves made elsewhere
+                # since this controller last saw the State
+                s.update(
+                    actions=[
+                        self.SI.state_deltas.set(
+                            self.SI.state_deltas.append([state.delta(base)])
+                        )
+                    ],
+                    condition=(
+                        (self.SI.state_version == version)
+                        & (size(self.SI.state_deltas) == num_deltas)
+                    ),
+                )
+                self._saved_states[vmid] = (state.copy(), num_deltas + 1, version)
+                return
+            except UpdateError as exc:
+                if not db.condition_failed(exc):
+                    raise
+                LOG.info("Thread %s state changed elsewhere - saving it all", vmid)
+
+        s = self.SI(self.session_id, f"{STATE}:{vmid}")
+        s.update(
+            actions=[
+                self.SI.state.set(state),
+                self.SI.state_deltas.set([]),
+                self.SI.state_version.add(1),
+            ]
+        )
+        self._saved_states[vmid] = (state.copy(), 0, s.state_version)
 
     def get_state(self, vmid):
-        return self._qry(STATE, vmid).state
+        # Always read: the thread may have run in another controller since this
+        # one last saw it (the saved copy is only the base for deltas)
+        s = self._qry(STATE, vmid)
+        state = s.state
+        deltas = s.state_deltas or []
+        for delta in deltas:
+            state.apply_delta(delta)
+        self._saved_states[vmid] = (state.copy(), len(deltas), s.state_version)
+        return state
 
     ## controller properties
 
@@ -169,22 +299,7 @@ class DataController(Controller):
 
     @broken.setter
     def broken(self, value):
-        try:
-            with self._lock_item(META):
-                s = self._qry(META)
-                s.meta.broken = True
-                s.save()
-        except db.LockTimeout:
-            # If a thread dies while updating META, this will timeout. However,
-            # in that case, broken is True and we *should* ignore the lock and
-            # carry on. If it's broken, the lock doesn't matter anyway.
-            # Hopefully this isn't a genuine race condition.
-            if value:
-                s = self._qry(META)
-                s.meta.broken = True
-                s.save()
-            else:
-                raise
+        self._update_meta(self.SI.meta.broken.set(value))
 
     @property
     def result(self):
@@ -193,68 +308,160 @@ class DataController(Controller):
 
     @result.setter
     def result(self, value):
-        with self._lock_item(META):
-            s = self._qry(META)
-            s.meta.result = value
-            s.save()
+        self._update_meta(self.SI.meta.result.set(value))
 
     ## arecs
 
     def new_arec(self):
-        with self._lock_item(META):
-            s = self._qry(META)
-            ptr = s.meta.num_arecs
-            s.meta.num_arecs += 1
-            s.save()
-        return ptr
+        with self._arec_lock:
+            if not self._free_arec_ptrs:
+                count = self.arec_block_size
+                meta = self._update_meta(
+                    self.SI.meta.num_arecs.set(self.SI.meta.num_arecs + count)
+                )
+                first = meta.num_arecs - count
+                self._free_arec_ptrs = list(range(first, meta.num_arecs))
+            return self._free_arec_ptrs.pop(0)
 
     def set_arec(self, ptr, rec):
-        try:
-            s = self._qry(AREC, ptr)
-            s.arec = rec
-        except ControllerError:
-            s = db.new_session_item(self.session_id, f"{AREC}:{ptr}", arec=rec)
-        s.save()
+        # Saved later, with the threads that refer to it, or by flush
+        with self._arec_lock:
+            self._unsaved_arecs[ptr] = rec
+
+    def _save_unsaved(self, batch):
+        """Save the unsaved activation records with BATCH (a batch_write)
+
+        NOTE: _arec_lock must be held until the batch is written, so that the
+        records aren't changed in the meantime.
+        """
+        for ptr, rec in self._unsaved_arecs.items():
+            batch.save(db.new_session_item(self.session_id, f"{AREC}:{ptr}", arec=rec))
+        self._unsaved_arecs = {}
 
     def get_arec(self, ptr):
+        with self._arec_lock:
+            if ptr in self._unsaved_arecs:
+                return self._unsaved_arecs[ptr]
         return self._qry(AREC, ptr).arec
 
-    def increment_ref(self, ptr):
-        s = self._qry(AREC, ptr)
-        s.update(actions=[self.SI.arec.ref_count.set(self.SI.arec.ref_count + 1)])
+    def _update_arec(self, ptr, *actions):
+        s = self.SI(self.session_id, f"{AREC}:{ptr}")
+        s.update(actions=list(actions))
+        return s.arec
+
+    def increment_ref(self, ptr, count=1):
+        with self._arec_lock:
+            if ptr in self._unsaved_arecs:
+                self._unsaved_arecs[ptr].ref_count += count
+                return
+        ref_count = self.SI.arec.ref_count
+        self._update_arec(ptr, ref_count.set(ref_count + count))
 
     def decrement_ref(self, ptr):
-        s = self._qry(AREC, ptr)
-        s.update(actions=[self.SI.arec.ref_count.set(self.SI.arec.ref_count - 1)])
-        return s.arec
+        with self._arec_lock:
+            if ptr in self._unsaved_arecs:
+                self._unsaved_arecs[ptr].ref_count -= 1
+                return self._unsaved_arecs[ptr]
+        ref_count = self.SI.arec.ref_count
+        return self._update_arec(ptr, ref_count.set(ref_count - 1))
 
     def delete_arec(self, ptr):
-        s = self._qry(AREC, ptr)
-        s.arec.deleted = True
+        with self._arec_lock:
+            if ptr in self._unsaved_arecs:
+                # Still saved later, for stack traces
+                self._unsaved_arecs[ptr].deleted = True
+                return
+        self._update_arec(ptr, self.SI.arec.deleted.set(True))
 
     def lock_arec(self, ptr):
-        return self._lock_item(AREC, ptr)
-
-    ## probes
+        # Not needed: reference counts are changed with atomic updates, so only
+        # one thread sees a record's count reach zero
+        return contextlib.nullcontext()
+
+    ## output streams
+    #
+    # Standard output and probe events and logs are buffered, and written in
+    # chunks, each a separate item, so there's no limit on the total size.
+
+    def _buffer(self, group, items):
+        """Add ITEMS to the buffer of stream GROUP, flushing it if it's full"""
+        with self._buffer_lock:
+            for item in items:
+                data = item.serialise()
+                size = len(json.dumps(data, default=str))
+                self._buffers[group].append((data, size))
+                self._buffered_size += size
+            full = self._buffered_size >= self.chunk_size
+        if full:
+            self.flush()
+
+    def flush(self):
+        with self._arec_lock:
+            if self._unsaved_arecs:
+                with self.SI.batch_write() as batch:
+                    self._save_unsaved(batch)
+        with self._buffer_lock:
+            buffers = self._buffers
+            self._buffers = {group: [] for group in buffers}
+            self._buffered_size = 0
+        chunks = []
+        for group, items in buffers.items():
+            chunk, chunk_size = [], 0
+            for data, size in items:
+                chunk.append(data)
+                chunk_size += size
+                if chunk_size >= self.chunk_size:
+                    chunks.append((group, chunk))
+                    chunk, chunk_size = [], 0
+            if chunk:
+                chunks.append((group, chunk))
+        if not chunks:
+            return
+        with self.SI.batch_write() as batch:
+            for group, chunk in chunks:
+                # Chunk IDs sort in (roughly) the order they were written
+                item_id = f"{group}:{time.time_ns():020d}:{uuid.uuid4().hex[:8]}"
+                data = {group: chunk}
+                batch.save(db.new_session_item(self.session_id, item_id, **data))
+
+    def read_stream(self, group, cursor=None, limit=None) -> Tuple[list, str]:
+        """Read the (serialised) items in output stream GROUP
+
+        Return the items, and a cursor to read only items written after them
+        next time. Items are read from the chunk after CURSOR, if given, and
+        from at most LIMIT chunks.
+        """
+        start_key = None
+        if cursor is not None:
+            start_key = dict(
+                session_id={STRING_SHORT: self.session_id},
+                item_id={STRING_SHORT: cursor},
+            )
+        chunks = self.SI.query(
+            self.session_id,
+            # Includes the single item of sessions saved before chunking
+            self.SI.item_id.between(group, f"{group};"),
+            consistent_read=True,
+            limit=limit,
+            last_evaluated_key=start_key,
+        )
+        items = []
+        for chunk in chunks:
+            items += getattr(chunk, group) or []
+            cursor = chunk.item_id
+        return items, cursor
 
     def set_probe_data(self, vmid, probe):
-        # FIXME - 400k limit on item size is quite easy to break with events and
-        # logs.
-        events = [item.serialise() for item in probe.events]
-        s = self._qry(PEVENTS)
-        s.update(actions=[self.SI.pevents.set(self.SI.pevents.append(events))])
-
-        logs = [item.serialise() for item in probe.logs]
-        s = self._qry(PLOGS)
-        s.update(actions=[self.SI.plogs.set(self.SI.plogs.append(logs))])
+        self._buffer(PEVENTS, probe.events)
+        self._buffer(PLOGS, probe.logs)
 
     def get_probe_logs(self):
-        s = self._qry(PLOGS)
-        return [ProbeLog.deserialise(item) for item in s.plogs]
+        items, _ = self.read_stream(PLOGS)
+        return [ProbeLog.deserialise(item) for item in items]
 
     def get_probe_events(self):
-        s = self._qry(PEVENTS)
-        return [ProbeEvent.deserialise(item) for item in s.pevents]
+        items, _ = self.read_stream(PEVENTS)
+        return [ProbeEvent.deserialise(item) for item in items]
 
     ## futures
 
@@ -263,12 +470,10 @@ class DataController(Controller):
         return s.future
 
     def set_future(self, vmid, future: fut.Future):
-        s = self._qry(FUTURE, vmid)
-        s.future = future
-        s.save()
+        db.new_session_item(self.session_id, f"{FUTURE}:{vmid}", future=future).save()
 
     def add_continuation(self, fut_ptr, vmid):
-        s = self._qry(FUTURE, fut_ptr)
+        s = self.SI(self.session_id, f"{FUTURE}:{fut_ptr}")
         s.update(
             actions=[
                 self.SI.future.continuations.set(
@@ -278,26 +483,66 @@ class DataController(Controller):
         )
 
     def set_future_chain(self, fut_ptr, chain):
-        s = self._qry(FUTURE, fut_ptr)
+        s = self.SI(self.session_id, f"{FUTURE}:{fut_ptr}")
         s.update(actions=[self.SI.future.chain.set(chain)])
 
-    def lock_future(self, ptr):
-        return self._lock_item(FUTURE, ptr)
+    # Futures aren't locked. Instead, the compound operations are conditional
+    # updates: nothing can be added to a future once it has resolved.
+
+    def _pending_future_update(self, fut_ptr, actions) -> Optional[fut.Future]:
+        """Update future FUT_PTR if it hasn't resolved, or return it if it has"""
+        s = self.SI(self.session_id, f"{FUTURE}:{fut_ptr}")
+        try:
+            s.update(actions=actions, condition=(self.SI.future.resolved == False))
+            return None
+        except UpdateError as exc:
+            if db.condition_failed(exc):
+                return self.get_future(fut_ptr)
+            raise
+
+    def mark_resolved(self, vmid, value) -> fut.Future:
+        s = self.SI(self.session_id, f"{FUTURE}:{vmid}")
+        s.update(
+            actions=[
+                self.SI.future.resolved.set(True),
+                self.SI.future.value.set(value),
+            ]
+        )
+        return s.future
+
+    def add_continuation_unless_resolved(self, fut_ptr, item):
+        continuations = self.SI.future.continuations
+        return self._pending_future_update(
+            fut_ptr, [continuations.set(continuations.append([item]))]
+        )
+
+    def chain_unless_resolved(self, fut_ptr, vmid):
+        return self._pending_future_update(fut_ptr, [self.SI.future.chain.set(vmid)])
+
+    def new_join(self, vmid, count) -> str:
+        join = f"{JOIN}:{uuid.uuid4()}"
+        item = db.new_session_item(
+            self.session_id, join, join=db.JoinAttribute(count=count, vmid=vmid)
+        )
+        item.save()
+        return join
+
+    def decrement_join(self, join):
+        s = self.SI(self.session_id, join)
+        s.update(actions=[self.SI.join.count.set(self.SI.join.count - 1)])
+        return s.join.count, s.join.vmid
 
     ## stdout
 
     def get_stdout(self):
-        s = self._qry(STDOUT)
-        return [StdoutItem.deserialise(item) for item in s.stdout]
+        items, _ = self.read_stream(STDOUT)
+        return [StdoutItem.deserialise(item) for item in items]
 
     def write_stdout(self, item):
         # Avoid empty strings (DynamoDB can't handle them)
         if item.text:
             sys.stdout.write(item.text)
-            s = self._qry(STDOUT)
-            s.update(
-                actions=[self.SI.stdout.set(self.SI.stdout.append([item.serialise()]))]
-            )
+            self._buffer(STDOUT, [item])
 
     @property  # Legacy. TODO: remove
     def stdout(self):
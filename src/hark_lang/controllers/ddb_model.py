@@ -2,12 +2,11 @@
 
 import base64
 import dataclasses
+import json
 import logging
 import os
-import threading
 import time
 import uuid
-from contextlib import AbstractContextManager
 from datetime import datetime
 from typing import List
 
@@ -21,13 +20,15 @@ from pynamodb.attributes import (
     UnicodeAttribute,
     UTCDateTimeAttribute,
 )
+from pynamodb.constants import LIST_SHORT, MAP_SHORT, STRING_SHORT
 from pynamodb.exceptions import UpdateError, TableDoesNotExist
 from pynamodb.models import Model
 
-from ..exceptions import HarkError
+from ..machine import codec
 from ..machine.arec import ActivationRecord
 from ..machine.future import Future
-from ..machine.state import State
+from ..machine.state import State, deserialise_locals
+from ..machine.types import TlType
 
 LOG = logging.getLogger(__name__)
 
@@ -54,63 +55,141 @@ STATE = "state"
 PLOGS = "plogs"
 PEVENTS = "pevents"
 STDOUT = "stdout"
+RUN = "run"
+JOIN = "join"
+
+
+class HarkBinaryAttribute(UnicodeAttribute):
+    """Data in the compact binary format (see machine/codec.py)
+
+    Stored as base64 text rather than a DynamoDB binary, because PynamoDB
+    doesn't decode binaries nested in maps.
+
+    Items saved before the binary format was introduced have JSON strings (or
+    DynamoDB maps/lists) instead, which are converted with from_legacy.
+    """
+
+    def encode(self, value) -> bytes:
+        return codec.encode(value)
+
+    def decode(self, data: bytes):
+        return codec.decode(data)
+
+    def from_legacy(self, obj):
+        """Convert a value saved in the old (JSON-able) format"""
+        return obj
+
+    def serialize(self, value):
+        return base64.b64encode(self.encode(value)).decode()
+
+    def deserialize(self, value):
+        if isinstance(value, dict):
+            return self.from_legacy(MapAttribute().deserialize(value))
+        elif isinstance(value, list):
+            return self.from_legacy(ListAttribute().deserialize(value))
+        elif isinstance(value, str) and value[:1] in ("[", "{"):
+            # JSON -- base64 never contains brackets
+            return self.from_legacy(json.loads(value))
+        return self.decode(base64.b64decode(value))
+
+    def get_value(self, value):
+        for key in (STRING_SHORT, MAP_SHORT, LIST_SHORT):
+            if key in value:
+                return value[key]
+        return None
+
+
+class TlValueAttribute(HarkBinaryAttribute):
+    """A Hark value (TlType)"""
+
+    def from_legacy(self, obj):
+        return TlType.deserialise(obj)
+
+
+class LocalsAttribute(HarkBinaryAttribute):
+    """Local variable slots (Hark values, or None)"""
+
+    def from_legacy(self, obj):
+        return deserialise_locals(obj)
+
+
+class StateAttribute(HarkBinaryAttribute):
+    def encode(self, value):
+        return value.encode()
+
+    def decode(self, data):
+        return State.decode(data)
+
+    def from_legacy(self, obj):
+        return State.deserialise(obj)
+
+
+_DELTA = HarkBinaryAttribute()
+
+
+class StateDeltasAttribute(ListAttribute):
+    """Changes to a State since its last full snapshot (see State.delta)"""
+
+    def serialize(self, values):
+        return [{STRING_SHORT: _DELTA.serialize(v)} for v in values]
+
+    def deserialize(self, values):
+        return [_DELTA.deserialize(v[STRING_SHORT]) for v in values]
 
 
 class FutureAttribute(MapAttribute):
     resolved = BooleanAttribute(default=False)
     continuations = ListAttribute(default=list)
     chain = NumberAttribute(null=True)
-    value = JSONAttribute(null=True)
+    value = TlValueAttribute(null=True)
 
     def serialize(self, value):
-        return super().serialize(value.serialise())
+        return super().serialize(
+            dict(
+                resolved=value.resolved,
+                continuations=value.continuations,
+                chain=value.chain,
+                value=value.value,
+            )
+        )
 
     def deserialize(self, value):
-        return Future.deserialise(super().deserialize(value).as_dict())
+        return Future(**super().deserialize(value).as_dict())
 
 
 class ARecAttribute(MapAttribute):
     ref_count = NumberAttribute()
-    function = ListAttribute(null=True)
+    function = TlValueAttribute(null=True)
     dynamic_chain = NumberAttribute(null=True)
     vmid = NumberAttribute(null=True)
     call_site = NumberAttribute(null=True)
-    bindings = MapAttribute(default=dict)
+    locals = LocalsAttribute(default=list)
     deleted = BooleanAttribute(default=False)
 
     def serialize(self, value):
-        return super().serialize(value.serialise())
+        fields = dataclasses.fields(value)
+        return super().serialize({f.name: getattr(value, f.name) for f in fields})
 
     def deserialize(self, value):
-        return ActivationRecord.deserialise(super().deserialize(value).as_dict())
+        return ActivationRecord(**super().deserialize(value).as_dict())
+
+
+class JoinAttribute(MapAttribute):
+    count = NumberAttribute()
+    vmid = NumberAttribute()
 
 
 class MetaAttribute(MapAttribute):
     num_threads = NumberAttribute(default=0)
     num_arecs = NumberAttribute(default=0)
+    # Threads that are not stopped (each has a RUN item with the flag)
+    num_running = NumberAttribute(default=0)
     entrypoint = UnicodeAttribute(null=True)
-    stopped = ListAttribute(default=list)
-    exe = MapAttribute(null=True)
+    exe = HarkBinaryAttribute(null=True)
     result = JSONAttribute(null=True)
     broken = BooleanAttribute(default=False)
 
 
-class HarkDataAttribute(JSONAttribute):
-    """General purpose JSON-able Hark type"""
-
-    value_cls = None
-
-    def serialize(self, value):
-        return super().serialize(value.serialise())
-
-    def deserialize(self, value):
-        return self.value_cls.deserialise(super().deserialize(value))
-
-
-class StateAttribute(HarkDataAttribute):
-    value_cls = State
-
-
 class SessionItem(Model):
     class Meta:
         table_name = os.environ.get("DYNAMODB_TABLE", DEFAULT_TABLE_NAME)
@@ -119,7 +198,7 @@ class SessionItem(Model):
 
     session_id = UnicodeAttribute(hash_key=True)
     item_id = UnicodeAttribute(range_key=True)
-    locked = BooleanAttribute(default=False)
+    stopped = BooleanAttribute(null=True)
     # TODO create LSI on created_at
     created_at = UTCDateTimeAttribute()
     updated_at = UTCDateTimeAttribute()
@@ -134,7 +213,11 @@ class SessionItem(Model):
     pevents = ListAttribute(null=True)
     arec = ARecAttribute(null=True)
     future = FutureAttribute(null=True)
+    join = JoinAttribute(null=True)
     state = StateAttribute(null=True)
+    state_deltas = StateDeltasAttribute(null=True)
+    # Incremented by each full save of the state, which resets state_deltas
+    state_version = NumberAttribute(null=True)
 
 
 ###
@@ -187,10 +270,6 @@ def new_session() -> SessionItem:
 
     s = new_session_item(sid, META, meta=MetaAttribute())
     s.save()
-    # Create the empty placeholders for the collections
-    new_session_item(sid, PLOGS, plogs=[]).save()
-    new_session_item(sid, PEVENTS, pevents=[]).save()
-    new_session_item(sid, STDOUT, stdout=[]).save()
 
     # Record the new session for cheap retrieval later
     SessionItem(
@@ -224,82 +303,9 @@ def list_sessions(cls=SessionItem) -> List[str]:
 ###
 
 
-def try_lock(session, thread_lock) -> bool:
-    """Try to acquire a lock on an item, returning True if successful"""
-    if not thread_lock.acquire(blocking=False):
-        return False
-
-    try:
-        session.update(
-            [SessionItem.locked.set(True)], condition=(SessionItem.locked == False)
-        )
-        return True
-
-    except UpdateError as e:
-        thread_lock.release()
-        if isinstance(e.cause, ClientError):
-            code = e.cause.response["Error"].get("Code")
-            LOG.info("Failed to lock: %s", code)
-            if code == "ConditionalCheckFailedException":
-                return False
-            raise
-        raise
-
-
-class LockTimeout(HarkError):
-    """Timeout trying to lock item"""
-
-
-class SessionLocker(AbstractContextManager):
-    """Lock an item for modification (re-entrant for chain_resolve)
-
-    https://docs.python.org/3/library/contextlib.html#reentrant-context-managers
-    """
-
-    def __init__(self, session, timeout=2.0):
-        self.session = session
-        self.timeout = timeout
-        self._thread_lock = threading.Lock()
-        self.lock_count = {}
-
-    def __enter__(self):
-        tid = threading.get_native_id()
-
-        # re-lock if this thread has already got one lock
-        if self._thread_lock.locked() and self.lock_count.get(tid, 0) > 0:
-            t = time.time() % 1000.0
-            self.lock_count[tid] += 1
-            LOG.debug(f"{t:.3f} :: acquire re-entrant %d", self.lock_count[tid])
-            return
-
-        start = time.time()
-        while not try_lock(self.session, self._thread_lock):
-            time.sleep(0.01)
-            if time.time() - start > self.timeout:
-                t = time.time() % 1000.0
-                LOG.debug(f"{t:.3f} :: Timeout getting lock")
-                raise LockTimeout
-
-        self.lock_count[tid] = 1
-
-        t = time.time() % 1000.0
-        LOG.debug(f"{t:.3f} :: Thread {tid} Locked %s", self.session)
-
-    def __exit__(self, *exc):
-        """Release the lock"""
-        tid = threading.get_native_id()
-
-        if self._thread_lock.locked() and self.lock_count.get(tid, 0) > 1:
-            self.lock_count[tid] -= 1
-            t = time.time() % 1000.0
-            LOG.debug(f"{t:.3f} :: release re-entrant %d", self.lock_count[tid])
-            return
-
-        self.lock_count[tid] -= 1
-        assert self.lock_count[tid] == 0
-
-        LOG.debug(f"%d :: Releasing %s...", time.time() % 1000.0, self.session)
-        self.session.update(
-            [SessionItem.locked.set(False)], condition=(SessionItem.locked == True)
-        )
-        self._thread_lock.release()
+def condition_failed(exc: UpdateError) -> bool:
+    """Whether an update failed because its condition wasn't met"""
+    if isinstance(exc.cause, ClientError):
+        code = exc.cause.response["Error"].get("Code")
+        return code == "ConditionalCheckFailedException"
+    return False
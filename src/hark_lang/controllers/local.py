@@ -8,7 +8,7 @@ from typing import List
 
 from ..machine import future as fut
 from ..machine.arec import ARecPtr
-from ..machine.controller import Controller
+from ..machine.controller import JOIN_PREFIX, Controller
 
 # https://docs.python.org/3/library/logging.html#logging.basicConfig
 LOG = logging.getLogger(__name__)
@@ -24,6 +24,8 @@ class DataController(Controller):
         self._probe_logs = []
         self._probe_events = []
         self._arecs = {}
+        self._joins = {}  # join ID -> [count, vmid]
+        self._join_idx = 0  # always increasing, as finished joins are deleted
         self._lock = threading.RLock()
         self.session_id = 0  # constant for local
         self.executable = None
@@ -42,8 +44,17 @@ class DataController(Controller):
     def new_thread(self):
         vmid = self._machine_idx
         self._machine_idx += 1
+        self._machine_stopped[vmid] = False
         return vmid
 
+    def new_threads(self, count):
+        with self._lock:
+            vmids = list(range(self._machine_idx, self._machine_idx + count))
+            self._machine_idx += count
+            ptrs = [ARecPtr(self._arec_idx + i) for i in range(count)]
+            self._arec_idx += count
+        return vmids, ptrs
+
     def get_thread_ids(self) -> List[int]:
         return list(range(self._machine_idx))
 
@@ -78,8 +89,8 @@ class DataController(Controller):
     def get_arec(self, ptr):
         return self._arecs[ptr]
 
-    def increment_ref(self, ptr):
-        self._arecs[ptr].ref_count += 1
+    def increment_ref(self, ptr, count=1):
+        self._arecs[ptr].ref_count += count
         return self._arecs[ptr].ref_count
 
     def decrement_ref(self, ptr):
@@ -124,6 +135,21 @@ class DataController(Controller):
         # Shared thread lock
         return self._lock
 
+    def new_join(self, vmid, count) -> str:
+        with self._lock:
+            join = f"{JOIN_PREFIX}{self._join_idx}"
+            self._join_idx += 1
+            self._joins[join] = [count, vmid]
+        return join
+
+    def decrement_join(self, join):
+        with self._lock:
+            self._joins[join][0] -= 1
+            count, vmid = self._joins[join]
+            if not count:
+                del self._joins[join]
+        return count, vmid
+
     ## stdout
 
     def get_stdout(self):
@@ -0,0 +1,112 @@
+"""In-memory storage shared between processes
+
+The data lives in a local DataController in a server process (a
+multiprocessing manager). Machines in other processes use it through a
+DataController proxy, which is picklable, so it can be passed to new
+processes. Every call runs in the server, one at a time, so compound
+operations like resolve_future are atomic.
+"""
+import logging
+import threading
+from multiprocessing.managers import BaseManager
+
+from . import local
+
+LOG = logging.getLogger(__name__)
+
+
+class _Server:
+    """Serve a local DataController, serialising all access to it"""
+
+    def __init__(self):
+        self._dc = local.DataController()
+        self._lock = threading.RLock()
+
+    def call(self, name, args, kwargs):
+        with self._lock:
+            return getattr(self._dc, name)(*args, **kwargs)
+
+    def get(self, name):
+        with self._lock:
+            return getattr(self._dc, name)
+
+    def set(self, name, value):
+        with self._lock:
+            setattr(self._dc, name, value)
+
+
+class _Manager(BaseManager):
+    pass
+
+
+_Manager.register("Server", _Server)
+
+
+class DataController:
+    """Proxy for a DataController in a server process
+
+    Controller methods are forwarded to the server. The executable is cached,
+    as it doesn't change once the program is running.
+    """
+
+    @classmethod
+    def with_new_server(cls):
+        """Start a server process, and connect to it"""
+        manager = _Manager()
+        manager.start()
+        LOG.info("Started shared controller at %s", manager.address)
+        controller = cls(manager.Server())
+        controller._manager = manager  # keep the server alive
+        return controller
+
+    def __init__(self, server):
+        self._server = server
+        self._manager = None
+        self._executable = None
+
+    def __getstate__(self):
+        # The manager belongs to the process that started it
+        return dict(_server=self._server, _manager=None, _executable=None)
+
+    def shutdown(self):
+        if self._manager:
+            self._manager.shutdown()
+
+    @property
+    def executable(self):
+        if self._executable is None:
+            self._executable = self._server.get("executable")
+        return self._executable
+
+    def set_executable(self, exe):
+        self._executable = exe
+        self._server.call("set_executable", (exe,), {})
+
+    @property
+    def session_id(self):
+        return self._server.get("session_id")
+
+    @property
+    def broken(self):
+        return self._server.get("broken")
+
+    @broken.setter
+    def broken(self, value):
+        self._server.set("broken", value)
+
+    @property
+    def result(self):
+        return self._server.get("result")
+
+    @result.setter
+    def result(self, value):
+        self._server.set("result", value)
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+
+        def _call(*args, **kwargs):
+            return self._server.call(name, args, kwargs)
+
+        return _call
@@ -0,0 +1,81 @@
+"""Run Hark threads on an asyncio event loop
+
+Like scheduler.py, all machines run on one Python thread. But foreign calls
+don't block it: the machine suspends, and the call is awaited on the event
+loop (if it's a coroutine function), or run in a bounded thread pool (if it's
+a normal, blocking function). When it completes, the thread is resumed with
+the result. So many Hark threads can have calls in flight at once.
+
+NOTE: Python standard output from foreign calls is not captured (it goes
+straight to sys.stdout), as calls run concurrently.
+"""
+import asyncio
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+from ..machine.machine import TlMachine
+from .thread import exception_info
+
+LOG = logging.getLogger(__name__)
+
+
+class Invoker:
+    def __init__(self, data_controller, max_workers=10, time_slice=0.05):
+        self.data_controller = data_controller
+        self.exception = None
+        self.time_slice = time_slice  # seconds
+        self._loop = asyncio.new_event_loop()
+        self._pool = ThreadPoolExecutor(max_workers)
+        self._pending = 0  # Machine runs and foreign calls not finished yet
+
+    def close(self):
+        """Close the event loop and thread pool (when nothing is running)"""
+        self._pool.shutdown()
+        self._loop.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def invoke(self, vmid, run_async=True):
+        LOG.info(f"Scheduling {vmid}")
+        self._schedule(vmid)
+        if not self._loop.is_running():
+            # Not called from a machine - run everything now
+            self._loop.run_forever()
+
+    def await_foreign(self, vmid, fn, args):
+        """Run FN(*ARGS) and then resume thread VMID with the result"""
+        if asyncio.iscoroutinefunction(fn):
+            task = self._loop.create_task(fn(*args))
+        else:
+            task = self._loop.run_in_executor(self._pool, partial(fn, *args))
+        self._pending += 1
+        task.add_done_callback(partial(self._foreign_done, vmid))
+
+    def _foreign_done(self, vmid, task):
+        self._schedule(vmid, task.result)
+        self._done()
+
+    def _schedule(self, vmid, resume_with=None):
+        self._pending += 1
+        self._loop.call_soon(self._run_machine, vmid, resume_with)
+
+    def _run_machine(self, vmid, resume_with):
+        try:
+            m = TlMachine(vmid, self)
+            m.run(deadline=time.monotonic() + self.time_slice, resume_with=resume_with)
+        except Exception:
+            self.exception = exception_info()
+            LOG.exception(f"Thread {vmid} died")
+        finally:
+            self._done()
+
+    def _done(self):
+        self._pending -= 1
+        if not self._pending:
+            self._loop.stop()
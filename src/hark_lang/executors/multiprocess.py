@@ -1,7 +1,8 @@
 """Run with multiple processes - sort of emulates AWS Lambda"""
 import multiprocessing
 
-from ..controllers import ddb as ddb_controller
+from ..controllers import shared
+from ..machine import probe
 from ..machine.machine import TlMachine
 
 
@@ -9,22 +10,45 @@ class Invoker:
     def __init__(self, data_controller):
         self.data_controller = data_controller
         self.exception = None
+        # Passed explicitly, as child processes don't necessarily inherit the
+        # parent's probe configuration (e.g. with the "spawn" start method)
+        self.probe_settings = dict(
+            level=probe.DEFAULT_LEVEL, sample=probe.DEFAULT_SAMPLE
+        )
 
     def invoke(self, vmid, run_async=True):
-        event = dict(
-            # --
-            session_id=self.data_controller.session_id,
-            vmid=vmid,
-        )
-        p = multiprocessing.Process(target=resume_handler, args=(event,))
+        if isinstance(self.data_controller, shared.DataController):
+            # The controller proxy can be passed directly
+            target = run_shared
+            args = (self.data_controller, vmid, self.probe_settings)
+        else:
+            event = dict(
+                # --
+                session_id=self.data_controller.session_id,
+                vmid=vmid,
+            )
+            target = resume_handler
+            args = (event, self.probe_settings)
+        p = multiprocessing.Process(target=target, args=args)
         p.start()
 
 
-def resume_handler(event):
+def resume_handler(event, probe_settings):
     # TODO catch exceptions and send them back!
+    probe.configure(**probe_settings)
+    # Imported here, as it needs DynamoDB configuration
+    from ..controllers import ddb as ddb_controller
+
     session_id = event["session_id"]
     vmid = event["vmid"]
     controller = ddb_controller.DataController.with_session_id(session_id)
     invoker = Invoker(controller)
     machine = TlMachine(vmid, invoker)
     machine.run()
+
+
+def run_shared(controller, vmid, probe_settings):
+    probe.configure(**probe_settings)
+    invoker = Invoker(controller)
+    machine = TlMachine(vmid, invoker)
+    machine.run()
@@ -0,0 +1,54 @@
+"""Run all Hark threads on one Python thread, like green threads
+
+Machines are taken from a run queue and run until they stop (finish, or wait
+on a future) or use up their time slice. New threads, continuations and
+machines that were interrupted at the end of their time slice are added to the
+back of the queue, instead of starting an OS thread each. One machine runs
+them all, switching between threads, so it's only set up once.
+"""
+import logging
+import time
+from collections import deque
+
+from ..machine.machine import TlMachine
+from .thread import exception_info
+
+LOG = logging.getLogger(__name__)
+
+
+class Invoker:
+    def __init__(self, data_controller, time_slice=0.05):
+        self.data_controller = data_controller
+        self.exception = None
+        self.time_slice = time_slice  # seconds
+        self._queue = deque()
+        self._running = False
+        self._machine = None
+
+    def invoke(self, vmid, run_async=True):
+        LOG.info(f"Scheduling {vmid}")
+        self._queue.append(vmid)
+        if not self._running:
+            # Not called from a machine - run everything now
+            self._run_queue()
+
+    def _run_queue(self):
+        self._running = True
+        try:
+            while self._queue:
+                vmid = self._queue.popleft()
+                try:
+                    self._run_machine(vmid)
+                except Exception:
+                    self.exception = exception_info()
+                    LOG.exception(f"Thread {vmid} died")
+                    self._machine = None  # might be half-switched
+        finally:
+            self._running = False
+
+    def _run_machine(self, vmid):
+        if self._machine is None:
+            self._machine = TlMachine(vmid, self)
+        else:
+            self._machine.switch_thread(vmid)
+        self._machine.run(deadline=time.monotonic() + self.time_slice)
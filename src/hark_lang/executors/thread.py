@@ -1,14 +1,25 @@
 import logging
+import sys
 import threading
 import time
 import traceback
 import warnings
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
 
 from ..machine.machine import TlMachine
 
 LOG = logging.getLogger(__name__)
 
 
+def exception_info():
+    """Get the current exception, like the threading.excepthook argument"""
+    exc_type, exc_value, exc_traceback = sys.exc_info()
+    return SimpleNamespace(
+        exc_type=exc_type, exc_value=exc_value, exc_traceback=exc_traceback
+    )
+
+
 class Invoker:
     def __init__(self, data_controller):
         self.data_controller = data_controller
@@ -27,3 +38,42 @@ class Invoker:
             thread.start()
         else:
             m.run()
+
+
+class PoolInvoker:
+    """Run machines in a fixed-size pool of reusable threads
+
+    At most MAX_WORKERS machines run at once - the rest are queued. Exceptions
+    are captured per invoker, instead of with threading.excepthook.
+    """
+
+    def __init__(self, data_controller, max_workers=None):
+        self.data_controller = data_controller
+        self.exception = None
+        self._pool = ThreadPoolExecutor(
+            max_workers, thread_name_prefix=f"hark-{data_controller.session_id}"
+        )
+
+    def close(self):
+        """Shut down the thread pool, waiting for queued machines to finish"""
+        self._pool.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def invoke(self, vmid, run_async=True):
+        LOG.info(f"Invoking {vmid} (queued? {run_async})")
+        if run_async:
+            self._pool.submit(self._run, vmid)
+        else:
+            TlMachine(vmid, self).run()
+
+    def _run(self, vmid):
+        try:
+            TlMachine(vmid, self).run()
+        except Exception:
+            self.exception = exception_info()
+            LOG.exception(f"Thread {vmid} died")
@@ -1,6 +1,7 @@
 """Optimise and compile an AST into executable code"""
 import itertools
 import logging
+from dataclasses import fields
 from functools import singledispatch, singledispatchmethod, wraps
 from typing import Dict, Tuple
 
@@ -11,6 +12,7 @@ from ..machine import types as mt
 from ..machine.executable import Executable
 from ..hark_parser import nodes
 from .attributes import parse_attribute
+from . import peephole
 
 LOG = logging.getLogger(__name__)
 
@@ -69,6 +71,183 @@ def optimise_tailcall(n: nodes.N_Definition):
     return n
 
 
+## Constant folding and dead branch elimination
+
+# Operators that can be evaluated at compile time, if both operands are
+# numeric literals
+FOLDABLE_ARITHMETIC = {
+    "+": lambda a, b: a + b,
+    "-": lambda a, b: a - b,
+    "*": lambda a, b: a * b,
+    "/": lambda a, b: a / b,
+    "%": lambda a, b: a % b,
+}
+
+FOLDABLE_COMPARISON = {
+    "==": lambda a, b: a == b,
+    "!=": lambda a, b: a != b,
+    ">": lambda a, b: a > b,
+    ">=": lambda a, b: a >= b,
+    "<": lambda a, b: a < b,
+    "<=": lambda a, b: a <= b,
+}
+
+
+def is_number(n) -> bool:
+    return isinstance(n, nodes.N_Literal) and type(n.value) in (int, float)
+
+
+def is_bool(n) -> bool:
+    return isinstance(n, nodes.N_Literal) and type(n.value) is bool
+
+
+def is_truthy(n: nodes.N_Literal) -> bool:
+    """Whether a literal is "true" to JumpIf (anything but false and null)"""
+    return not (n.value is None or n.value is False)
+
+
+@singledispatch
+def fold_constants(n):
+    """Fold constant expressions and remove statically dead branches"""
+    # Nothing to fold
+    return n
+
+
+@fold_constants.register
+def _(n: nodes.N_Definition):
+    n.body = fold_constants(n.body)
+    return n
+
+
+@fold_constants.register
+def _(n: nodes.N_Lambda):
+    n.body = fold_constants(n.body)
+    return n
+
+
+@fold_constants.register
+def _(n: nodes.N_Progn):
+    return nodes.N_Progn.from_node(n, [fold_constants(e) for e in n.exprs])
+
+
+@fold_constants.register
+def _(n: nodes.N_MultipleValues):
+    return nodes.N_MultipleValues.from_node(n, [fold_constants(e) for e in n.exprs])
+
+
+@fold_constants.register
+def _(n: nodes.N_Call):
+    return nodes.N_Call.from_node(n, n.fn, [fold_constants(a) for a in n.args])
+
+
+@fold_constants.register
+def _(n: nodes.N_Argument):
+    return nodes.N_Argument.from_node(n, n.symbol, fold_constants(n.value))
+
+
+@fold_constants.register
+def _(n: nodes.N_If):
+    cond = fold_constants(n.cond)
+    then = fold_constants(n.then)
+    els = fold_constants(n.els)
+    if isinstance(cond, nodes.N_Literal):
+        return then if is_truthy(cond) else els
+    return nodes.N_If.from_node(n, cond, then, els)
+
+
+@fold_constants.register
+def _(n: nodes.N_UnaryOp):
+    rhs = fold_constants(n.rhs)
+    if n.op == "-" and is_number(rhs):
+        return nodes.N_Literal.from_node(n, -rhs.value)
+    if n.op == "!" and isinstance(rhs, nodes.N_Literal):
+        return nodes.N_Literal.from_node(n, not rhs.value)
+    return nodes.N_UnaryOp.from_node(n, n.op, rhs)
+
+
+@fold_constants.register
+def _(n: nodes.N_Binop):
+    rhs = fold_constants(n.rhs)
+    if n.op == "=":
+        return nodes.N_Binop.from_node(n, n.lhs, n.op, rhs)
+
+    lhs = fold_constants(n.lhs)
+
+    # Short-circuit boolean operators (see compile_expr for the general case).
+    # Only boolean literals are folded -- anything else fails at runtime.
+    if n.op in ("&&", "||") and is_bool(lhs):
+        # The value of lhs that decides the result without rhs
+        decisive = n.op == "||"
+        if lhs.value is decisive:
+            return lhs
+        if is_bool(rhs):
+            return rhs
+
+    if is_number(lhs) and is_number(rhs):
+        a, b = lhs.value, rhs.value
+        if n.op in FOLDABLE_COMPARISON:
+            return nodes.N_Literal.from_node(n, FOLDABLE_COMPARISON[n.op](a, b))
+        # Leave division by zero to fail at runtime
+        if n.op in FOLDABLE_ARITHMETIC and not (n.op in "/%" and b == 0):
+            value = FOLDABLE_ARITHMETIC[n.op](a, b)
+            # Same result type as the machine: float if either operand is
+            # (except modulo, which is always an int)
+            cls = float if float in (type(a), type(b)) and n.op != "%" else int
+            return nodes.N_Literal.from_node(n, cls(value))
+
+    return nodes.N_Binop.from_node(n, lhs, n.op, rhs)
+
+
+## Local variables
+
+
+def local_names(n: nodes.N_Definition) -> list:
+    """Get the names of the local variables of a function, by slot
+
+    Parameters come first, followed by every name assigned in the body.
+    """
+    names = list(n.paramlist)
+
+    def visit(node):
+        if isinstance(node, list):
+            for elt in node:
+                visit(elt)
+        elif isinstance(node, nodes.N_Lambda):
+            # Compiled separately, with its own locals (no closures yet)
+            pass
+        elif isinstance(node, nodes.Node):
+            if isinstance(node, nodes.N_Binop) and node.op == "=":
+                if isinstance(node.lhs, nodes.N_Id) and node.lhs.name not in names:
+                    names.append(node.lhs.name)
+            for f in fields(node):
+                visit(getattr(node, f.name))
+
+    visit(n.body)
+    return names
+
+
+def resolve_globals(code: list, bindings: dict) -> list:
+    """Replace PushB of global and builtin names with their values
+
+    Names that can't be resolved are left to fail at runtime. PushLB of locals
+    that don't shadow a global or builtin become plain PushL.
+    """
+    result = []
+    for instr in code:
+        if isinstance(instr, mi.PushLB):
+            name = str(instr.operands[1])
+            if name not in bindings and name not in mi.BUILTINS:
+                instr = mi.PushL(instr.operands[0], source=instr.source)
+        elif isinstance(instr, mi.PushB):
+            name = str(instr.operands[0])
+            if name in bindings:
+                instr = mi.PushV(bindings[name], source=instr.source)
+            elif name in mi.BUILTINS:
+                instr = mi.PushV(mt.TlInstruction(name), source=instr.source)
+        result.append(instr)
+    return result
+
+
 def replace_gotos(code: list):
     """Replace Labels and Gotos with Jumps"""
     labels = {}
@@ -92,12 +271,67 @@ def replace_gotos(code: list):
     return code
 
 
+def pmap_function() -> Tuple[list, list]:
+    """Make the code and local names of the function that runs pmap
+
+    See mi.PMapFork. Forks threads for the other chunks, maps the function over
+    its own chunk, and then joins the results of the forked threads onto it.
+    """
+    L = mt.TlInt
+    code = [
+        mi.BindPop(L(1)),
+        mi.BindPop(L(0)),
+        mi.PushL(L(0)),
+        mi.PushL(L(1)),
+        mi.PMapFork(),
+        mi.BindPop(L(1)),
+        mi.BindPop(L(2)),
+        mi.PushV(mt.TlList([])),
+        mi.BindPop(L(3)),
+        # loop (9): results = append(results, func(first(items)))
+        mi.PushL(L(1)),
+        mi.Nullp(),
+        mi.JumpIf(L(11)),  # to done
+        mi.PushL(L(3)),
+        mi.PushL(L(1)),
+        mi.First(),
+        mi.PushL(L(0)),
+        mi.Call(L(1)),
+        mi.Append(),
+        mi.BindPop(L(3)),
+        mi.PushL(L(1)),
+        mi.Rest(),
+        mi.BindPop(L(1)),
+        mi.Jump(L(-14)),  # to loop
+        # done (23):
+        mi.PushL(L(3)),
+        mi.PushL(L(2)),
+        mi.Wait(L(0)),
+        mi.PMapJoin(),
+        mi.Return(),
+    ]
+    return code, ["func", "items", "futures", "results"]
+
+
+def uses_builtin(code: list, name: str) -> bool:
+    """Whether CODE (with globals resolved) refers to builtin NAME"""
+    return any(
+        isinstance(instr, mi.PushV)
+        and isinstance(instr.operands[0], mt.TlInstruction)
+        and instr.operands[0] == name
+        for instr in code
+    )
+
+
 class CompileToplevel:
     def __init__(self, exprs):
         """Compile a toplevel list of expressions"""
         self.functions = {}
         self.attributes = {}
         self.bindings = {}
+        self.locals = {}
+        self.scope = {}
+        self.params = set()
         self.labels = {}
         self.instruction_idx = 0
         for e in exprs:
@@ -108,21 +342,32 @@ class CompileToplevel:
         count = len(self.functions)
         identifier = f"#{count}:{name}"
         start_label = nodes.N_Label.from_node(n, START_LABEL)
-        code = self.compile_function(optimise_tailcall(n))
+        n = optimise_tailcall(fold_constants(n))
+        names = local_names(n)
+        code = self.compile_function(n, names)
         fn_code = replace_gotos([start_label] + code)
         self.functions[identifier] = fn_code
+        self.locals[identifier] = names
         # self.attributes[identifier] = parse_attribute(n.attribute)
         return identifier
 
-    def compile_function(self, n: nodes.N_Definition) -> list:
-        """Compile a function into executable code"""
+    def compile_function(self, n: nodes.N_Definition, names: list) -> list:
+        """Compile a function into executable code
+
+        names: The function's local variable names, by slot
+        """
+        # Lambdas are compiled in the middle of their parent function
+        outer_scope, outer_params = self.scope, self.params
+        self.scope = {name: mt.TlInt(slot) for slot, name in enumerate(names)}
+        self.params = set(n.paramlist)
         bindings = flatten(
             [
-                [mi.Bind.from_node(n, mt.TlSymbol(arg)), mi.Pop.from_node(n)]
+                [mi.Bind.from_node(n, self.scope[arg]), mi.Pop.from_node(n)]
                 for arg in reversed(n.paramlist)
             ]
         )
         body = self.compile_expr(n.body)
+        self.scope, self.params = outer_scope, outer_params
         return bindings + body + [mi.Return.from_node(n)]
 
     def wrap_foreign_function(self, n, qualified_name, num_args):
@@ -136,6 +381,7 @@ class CompileToplevel:
         count = len(self.functions)
         identifier = f"#F:{qualified_name}"
         self.functions[identifier] = fn_code
+        self.locals[identifier] = []
 
     ## At the toplevel, no executable code is created - only bindings
 
@@ -218,6 +464,14 @@ class CompileToplevel:
 
     @compile_expr.register
     def _(self, n: nodes.N_Id):
+        if n.name in self.scope:
+            if n.name in self.params:
+                return [mi.PushL.from_node(n, self.scope[n.name])]
+            # May be read before it's assigned, when the global (if any) is
+            # read instead -- see resolve_globals
+            slot = self.scope[n.name]
+            return [mi.PushLB.from_node(n, slot, mt.TlSymbol(n.name))]
+        # Global or builtin -- resolved when all functions have been compiled
         return [mi.PushB.from_node(n, mt.TlSymbol(n.name))]
 
     @compile_expr.register
@@ -274,7 +528,10 @@ class CompileToplevel:
         if n.op == "=":
             if not isinstance(n.lhs, nodes.N_Id):
                 raise ValueError(f"Can't assign to non-identifier {n.lhs}")
-            return rhs + [mi.Bind.from_node(n, mt.TlSymbol(str(n.lhs.name)))]
+            return rhs + [mi.Bind.from_node(n, self.scope[n.lhs.name])]
+
+        elif n.op in ("&&", "||"):
+            return self._compile_short_circuit(n, rhs)
 
         else:
             lhs = self.compile_expr(n.lhs)
@@ -288,6 +545,27 @@ class CompileToplevel:
                 ]
             )
 
+    def _compile_short_circuit(self, n: nodes.N_Binop, rhs: list) -> list:
+        """Compile && or ||, only evaluating RHS if the result depends on it"""
+        op = mt.TlSymbol(n.op)
+        lhs = self.compile_expr(n.lhs) + [mi.CheckBool.from_node(n, op)]
+        rhs = rhs + [mi.CheckBool.from_node(n, op)]
+        if n.op == "&&":
+            return [
+                *lhs,
+                mi.JumpIf.from_node(n, mt.TlInt(2)),  # to rhs
+                mi.PushV.from_node(n, mt.TlFalse()),
+                mi.Jump.from_node(n, mt.TlInt(len(rhs))),  # to the end
+                *rhs,
+            ]
+        return [
+            *lhs,
+            mi.JumpIf.from_node(n, mt.TlInt(len(rhs) + 1)),  # to PushV
+            *rhs,
+            mi.Jump.from_node(n, mt.TlInt(1)),  # to the end
+            mi.PushV.from_node(n, mt.TlTrue()),
+        ]
+
     @compile_expr.register
     def _(self, n: nodes.N_UnaryOp):
         if n.op == "async":
@@ -325,16 +603,33 @@ class CompileToplevel:
 ###
 
 
-def tl_compile(top_nodes: list) -> Executable:
-    """Compile top-level nodes into an executable"""
+def tl_compile(top_nodes: list, optimise: bool = True) -> Executable:
+    """Compile top-level nodes into an executable
+
+    optimise: Whether to run the peephole optimiser over the bytecode
+    """
     collection = CompileToplevel(top_nodes)
 
+    functions = {
+        fn_name: resolve_globals(fn_code, collection.bindings)
+        for fn_name, fn_code in collection.functions.items()
+    }
+    if any(uses_builtin(fn_code, "pmap") for fn_code in functions.values()):
+        # Only included if it's needed
+        pmap_code, names = pmap_function()
+        functions[mi.PMAP_FUNCTION] = pmap_code
+        collection.locals[mi.PMAP_FUNCTION] = names
+
     location_offset = 0
     code = []
     locations = {}
-    for fn_name, fn_code in collection.functions.items():
+    for fn_name, fn_code in functions.items():
+        if optimise:
+            fn_code = peephole.optimise(fn_code)
         locations[fn_name] = location_offset
         location_offset += len(fn_code)
         code += fn_code
 
-    return Executable(collection.bindings, locations, code, collection.attributes)
+    return Executable(
+        collection.bindings, locations, code, collection.attributes, collection.locals
+    )
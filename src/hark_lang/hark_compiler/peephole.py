@@ -0,0 +1,110 @@
+"""Bytecode-level (peephole) optimisation
+
+Replaces common instruction sequences in a function with cheaper ones:
+
+- Bind x; Pop          -> BindPop x
+- PushV <op>; Call 2   -> the operator's instruction (e.g. Plus), for operators
+- PushV <f>; Call n    -> CallBuiltin n f, if f is a builtin
+- PushV <f>; Call n    -> CallBound n f, if f is a (global) function
+- PushV x; JumpIf d    -> Jump d if x is true-ish, or nothing if not
+- Jump 0               -> nothing
+
+Global and builtin names have already been resolved to values by the compiler,
+so functions known at compile time are pushed with PushV.
+
+Jumps are relative, so they are re-targeted after the code has been rewritten.
+"""
+
+from typing import List, Tuple
+
+from ..machine import instructionset as mi
+from ..machine import types as mt
+from ..machine.instruction import Instruction
+
+JUMPS = (mi.Jump, mi.JumpIf)
+FUNCTIONS = (mt.TlFunctionPtr, mt.TlForeignPtr)
+
+
+def is_operator(name: str) -> bool:
+    """Whether NAME is an operator (which can't be rebound by the user)"""
+    return name in mi.BUILTINS and not name.isidentifier()
+
+
+class _Rewriter:
+    """Rewrite one function's code"""
+
+    def __init__(self, code: List[Instruction]):
+        self.code = code
+        # Absolute destination of each jump, by (old) index
+        self.destinations = {
+            idx: idx + 1 + i.operands[0]
+            for idx, i in enumerate(code)
+            if isinstance(i, JUMPS)
+        }
+        self.targets = set(self.destinations.values())
+
+    def fuse(self, idx) -> Tuple[list, int]:
+        """Get the replacement for the sequence at IDX, and its length
+
+        Each replacement instruction is paired with the (old) index of the jump
+        it came from, if any, so that it can be re-targeted.
+        """
+        a = self.code[idx]
+
+        if isinstance(a, mi.Jump) and a.operands[0] == 0:
+            return [], 1
+
+        # Only fuse pairs if nothing jumps in between them
+        if idx + 1 >= len(self.code) or idx + 1 in self.targets:
+            return [(a, idx if isinstance(a, JUMPS) else None)], 1
+        b = self.code[idx + 1]
+
+        if isinstance(a, mi.Bind) and isinstance(b, mi.Pop):
+            return [(mi.BindPop(*a.operands, source=a.source), None)], 2
+
+        if isinstance(a, mi.PushV) and isinstance(b, mi.Call):
+            fn = a.operands[0]
+            num_args = b.operands[0]
+            if isinstance(fn, mt.TlInstruction):
+                name = str(fn)
+                if is_operator(name) and num_args == 2:
+                    return [(mi.BUILTINS[name](source=b.source), None)], 2
+                instr = mi.CallBuiltin(num_args, mt.TlSymbol(name), source=b.source)
+                return [(instr, None)], 2
+            elif isinstance(fn, FUNCTIONS):
+                instr = mi.CallBound(num_args, fn, source=b.source)
+                return [(instr, None)], 2
+
+        if isinstance(a, mi.PushV) and isinstance(b, mi.JumpIf):
+            if isinstance(a.operands[0], (mt.TlNull, mt.TlFalse)):
+                return [], 2
+            jump = mi.Jump(*b.operands, source=b.source)
+            return [(jump, idx + 1)], 2
+
+        return [(a, idx if isinstance(a, JUMPS) else None)], 1
+
+    def rewrite(self) -> List[Instruction]:
+        new_code = []
+        new_index = {}  # old index -> new index
+        idx = 0
+        while idx < len(self.code):
+            replacement, length = self.fuse(idx)
+            for i in range(idx, idx + length):
+                new_index[i] = len(new_code)
+            new_code += replacement
+            idx += length
+        new_index[len(self.code)] = len(new_code)
+
+        result = []
+        for pos, (instr, jump_idx) in enumerate(new_code):
+            if jump_idx is not None:
+                destination = new_index[self.destinations[jump_idx]]
+                distance = mt.TlInt(destination - (pos + 1))
+                instr = type(instr)(distance, source=instr.source)
+            result.append(instr)
+        return result
+
+
+def optimise(code: List[Instruction]) -> List[Instruction]:
+    """Optimise the code of a single function"""
+    return _Rewriter(code).rewrite()
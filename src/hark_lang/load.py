@@ -10,19 +10,23 @@ from .hark_compiler import tl_compile
 from .hark_parser.parser import HarkParseError, tl_parse
 
 
-def compile_text(text: str) -> Executable:
+def compile_text(text: str, optimise=True) -> Executable:
     "Parse and compile a Hark program"
     return tl_compile(
-        tl_parse("<unknown>", text, debug_lex=os.getenv("DEBUG_LEX", False))
+        tl_parse("<unknown>", text, debug_lex=os.getenv("DEBUG_LEX", False)),
+        optimise=optimise,
     )
 
 
-def compile_file(filename: Path) -> Executable:
+def compile_file(filename: Path, optimise=True) -> Executable:
     "Compile a Hark file, creating an Executable ready to be used"
     with open(filename, "r") as f:
         text = f.read()
 
-    return tl_compile(tl_parse(filename, text, debug_lex=os.getenv("DEBUG_LEX", False)))
+    return tl_compile(
+        tl_parse(filename, text, debug_lex=os.getenv("DEBUG_LEX", False)),
+        optimise=optimise,
+    )
 
 
 if __name__ == "__main__":
@@ -0,0 +1,144 @@
+"""Compact (packed) bytecode representation
+
+A list of Instructions is packed into parallel array columns:
+
+- opcodes:  index of each instruction's class name in `opnames`
+- nops:     number of operands of each instruction
+- operands: flattened constant pool indices of all the operands
+- srcmap:   index of each instruction's source location in `sources`
+
+Operands are deduplicated into a constant pool, and source locations
+(filename, lineno, line, column) into an interned table, with the (long)
+filename and line text strings interned again in `strings`.
+
+The arrays are stored as base64-encoded little-endian bytes, so the packed
+form is still JSON-able (and DynamoDB-able).
+"""
+
+import base64
+import sys
+from array import array
+from typing import List
+
+from ..exceptions import UnexpectedError
+from .instruction import Instruction
+from .types import TlType
+
+PACKED_VERSION = 1
+
+
+class BadPackedCode(UnexpectedError):
+    """Can't unpack the given bytecode"""
+
+
+def _pack_array(typecode: str, values) -> list:
+    arr = array(typecode, values)
+    if sys.byteorder == "big":
+        arr.byteswap()
+    return [typecode, base64.b64encode(arr.tobytes()).decode()]
+
+
+def _unpack_array(obj: list) -> array:
+    typecode, data = obj
+    arr = array(typecode)
+    arr.frombytes(base64.b64decode(data))
+    if sys.byteorder == "big":
+        arr.byteswap()
+    return arr
+
+
+def _index_typecode(values: list) -> str:
+    """Get the smallest array typecode that can hold all indices in VALUES"""
+    biggest = max(values, default=0)
+    if biggest < 2 ** 8:
+        return "B"
+    elif biggest < 2 ** 16:
+        return "H"
+    else:
+        return "I"
+
+
+class _Interner:
+    """Assign a stable index to each distinct (hashable) key"""
+
+    def __init__(self):
+        self.index = {}
+        self.values = []
+
+    def add(self, key, value=None) -> int:
+        try:
+            return self.index[key]
+        except KeyError:
+            idx = len(self.values)
+            self.index[key] = idx
+            self.values.append(key if value is None else value)
+            return idx
+
+
+def _hashable(obj):
+    """Make a (nested) serialised value hashable"""
+    if isinstance(obj, list):
+        return tuple(_hashable(o) for o in obj)
+    return (type(obj).__name__, obj)
+
+
+def pack(code: List[Instruction]) -> dict:
+    """Pack a list of instructions"""
+    opnames = _Interner()
+    constants = _Interner()
+    strings = _Interner()
+    sources = _Interner()
+
+    opcodes, nops, operands, srcmap = [], [], [], []
+    for instr in code:
+        opcodes.append(opnames.add(instr.name))
+        nops.append(len(instr.operands))
+        for o in instr.operands:
+            ser = o.serialise()
+            operands.append(constants.add(_hashable(ser), ser))
+        filename, lineno, line, column = instr.source
+        src = (strings.add(filename), lineno, strings.add(line), column)
+        srcmap.append(sources.add(src, list(src)))
+
+    return dict(
+        version=PACKED_VERSION,
+        opnames=opnames.values,
+        opcodes=_pack_array(_index_typecode(opcodes), opcodes),
+        nops=_pack_array(_index_typecode(nops), nops),
+        operands=_pack_array(_index_typecode(operands), operands),
+        constants=constants.values,
+        srcmap=_pack_array(_index_typecode(srcmap), srcmap),
+        sources=sources.values,
+        strings=strings.values,
+    )
+
+
+def unpack(obj: dict, instruction_set) -> List[Instruction]:
+    """Unpack the dict created by pack
+
+    instruction_set: Module of Instruction types
+    """
+    if obj.get("version") != PACKED_VERSION:
+        raise BadPackedCode(f"Unsupported packed code version: {obj.get('version')}")
+
+    classes = [getattr(instruction_set, name) for name in obj["opnames"]]
+    constants = [TlType.deserialise(c) for c in obj["constants"]]
+    strings = obj["strings"]
+    # Identical source locations share one list
+    sources = [
+        [strings[int(f)], lineno, strings[int(l)], column]
+        for f, lineno, l, column in obj["sources"]
+    ]
+
+    opcodes = _unpack_array(obj["opcodes"])
+    nops = _unpack_array(obj["nops"])
+    operands = _unpack_array(obj["operands"])
+    srcmap = _unpack_array(obj["srcmap"])
+
+    code = []
+    pos = 0
+    for opcode, n, src in zip(opcodes, nops, srcmap):
+        ops = tuple(constants[i] for i in operands[pos : pos + n])
+        pos += n
+        code.append(classes[opcode].from_trusted(ops, sources[src]))
+    return code
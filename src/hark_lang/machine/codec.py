@@ -0,0 +1,269 @@
+"""Compact binary encoding of machine data
+
+Encodes plain Python data (None, bool, int, float, str, list, dict) and Hark
+values (TlType) without going through TlType.serialise(). Each value is a
+one-byte type tag followed by its data:
+
+- int:          zigzag varint
+- float:        8 bytes, little-endian IEEE 754
+- str:          varint length, then the UTF-8 bytes
+- list, dict:   varint number of items (or key/value pairs), then the items
+
+The encoded data starts with a header byte: the format version, with the top
+bit set if the rest is zlib-compressed. Data is only compressed if it's
+bigger than COMPRESS_THRESHOLD bytes.
+"""
+
+import struct
+import zlib
+
+from ..exceptions import UnexpectedError
+from . import types as mt
+
+FORMAT_VERSION = 1
+COMPRESSED = 0x80
+COMPRESS_THRESHOLD = 1024
+
+# Python types
+NONE, FALSE, TRUE, INT, FLOAT, STR, LIST, DICT = range(8)
+
+# Hark types
+(
+    TL_NULL,
+    TL_TRUE,
+    TL_FALSE,
+    TL_INT,
+    TL_FLOAT,
+    TL_STRING,
+    TL_SYMBOL,
+    TL_INSTRUCTION,
+    TL_FUTURE,
+    TL_QUOTE,
+    TL_LIST,
+    TL_HASH,
+    TL_FUNCTION,
+    TL_FOREIGN,
+) = range(16, 30)
+
+_DOUBLE = struct.Struct("<d")
+
+
+class BadEncoding(UnexpectedError):
+    """Can't decode the given data"""
+
+
+## Encoding
+
+
+def _varint(buf: bytearray, n: int):
+    while n > 0x7F:
+        buf.append((n & 0x7F) | 0x80)
+        n >>= 7
+    buf.append(n)
+
+
+def _int(buf, n):
+    _varint(buf, (n << 1) if n >= 0 else ((-n << 1) - 1))
+
+
+def _double(buf, x):
+    buf.extend(_DOUBLE.pack(x))
+
+
+def _str(buf, s):
+    data = s.encode()
+    _varint(buf, len(data))
+    buf += data
+
+
+def _items(buf, tag, items):
+    buf.append(tag)
+    _varint(buf, len(items))
+    for item in items:
+        _encode(buf, item)
+
+
+def _pairs(buf, tag, pairs):
+    buf.append(tag)
+    _varint(buf, len(pairs))
+    for key, value in pairs.items():
+        _encode(buf, key)
+        _encode(buf, value)
+
+
+def _tagged(tag, write):
+    def _write(buf, value):
+        buf.append(tag)
+        write(buf, value)
+
+    return _write
+
+
+def _tag_only(tag):
+    return lambda buf, _: buf.append(tag)
+
+
+def _write_function(buf, value):
+    buf.append(TL_FUNCTION)
+    _str(buf, value.identifier)
+    _encode(buf, value.stack_ptr)
+
+
+def _write_foreign(buf, value):
+    buf.append(TL_FOREIGN)
+    _str(buf, value.identifier)
+    _str(buf, value.module)
+    _str(buf, value.qualified_name)
+
+
+def _write_quote(buf, value):
+    buf.append(TL_QUOTE)
+    _encode(buf, value.data)
+
+
+def _write_future(buf, value):
+    buf.append(TL_FUTURE)
+    _encode(buf, value.value)
+
+
+_WRITERS = {
+    type(None): _tag_only(NONE),
+    bool: lambda buf, value: buf.append(TRUE if value else FALSE),
+    int: _tagged(INT, _int),
+    float: _tagged(FLOAT, _double),
+    str: _tagged(STR, _str),
+    list: lambda buf, value: _items(buf, LIST, value),
+    tuple: lambda buf, value: _items(buf, LIST, value),
+    dict: lambda buf, value: _pairs(buf, DICT, value),
+    mt.TlNull: _tag_only(TL_NULL),
+    mt.TlTrue: _tag_only(TL_TRUE),
+    mt.TlFalse: _tag_only(TL_FALSE),
+    mt.TlInt: _tagged(TL_INT, _int),
+    mt.TlFloat: _tagged(TL_FLOAT, _double),
+    mt.TlString: _tagged(TL_STRING, _str),
+    mt.TlSymbol: _tagged(TL_SYMBOL, _str),
+    mt.TlInstruction: _tagged(TL_INSTRUCTION, _str),
+    mt.TlFuturePtr: _write_future,
+    mt.TlQuote: _write_quote,
+    mt.TlList: lambda buf, value: _items(buf, TL_LIST, value),
+    mt.TlHash: lambda buf, value: _pairs(buf, TL_HASH, value),
+    mt.TlFunctionPtr: _write_function,
+    mt.TlForeignPtr: _write_foreign,
+}
+
+
+def _encode(buf: bytearray, value):
+    try:
+        writer = _WRITERS[type(value)]
+    except KeyError:
+        # A subclass of a known type
+        for cls in type(value).__mro__[1:]:
+            if cls in _WRITERS:
+                writer = _WRITERS[cls]
+                break
+        else:
+            raise TypeError(f"Can't encode {value} ({type(value)})")
+    writer(buf, value)
+
+
+def encode(value) -> bytes:
+    """Encode VALUE, compressing it if it's big"""
+    buf = bytearray()
+    _encode(buf, value)
+    if len(buf) > COMPRESS_THRESHOLD:
+        compressed = zlib.compress(buf)
+        if len(compressed) < len(buf):
+            return bytes([FORMAT_VERSION | COMPRESSED]) + compressed
+    return bytes([FORMAT_VERSION]) + buf
+
+
+## Decoding
+
+
+class _Reader:
+    def __init__(self, data: bytes):
+        self.data = data
+        self.pos = 0
+
+    def varint(self) -> int:
+        result = shift = 0
+        while True:
+            byte = self.data[self.pos]
+            self.pos += 1
+            result |= (byte & 0x7F) << shift
+            if byte < 0x80:
+                return result
+            shift += 7
+
+    def sint(self) -> int:
+        n = self.varint()
+        return (n >> 1) if not n & 1 else -((n + 1) >> 1)
+
+    def double(self) -> float:
+        (value,) = _DOUBLE.unpack_from(self.data, self.pos)
+        self.pos += _DOUBLE.size
+        return value
+
+    def string(self) -> str:
+        length = self.varint()
+        start = self.pos
+        self.pos += length
+        return self.data[start : self.pos].decode()
+
+    def items(self) -> list:
+        return [self.value() for _ in range(self.varint())]
+
+    def pairs(self) -> list:
+        return [(self.value(), self.value()) for _ in range(self.varint())]
+
+    def value(self):
+        tag = self.data[self.pos]
+        self.pos += 1
+        try:
+            reader = _READERS[tag]
+        except KeyError:
+            raise BadEncoding(f"Unknown type tag {tag} at {self.pos - 1}")
+        return reader(self)
+
+
+_READERS = {
+    NONE: lambda r: None,
+    FALSE: lambda r: False,
+    TRUE: lambda r: True,
+    INT: _Reader.sint,
+    FLOAT: _Reader.double,
+    STR: _Reader.string,
+    LIST: _Reader.items,
+    DICT: lambda r: dict(r.pairs()),
+    TL_NULL: lambda r: mt.TlNull(),
+    TL_TRUE: lambda r: mt.TlTrue(),
+    TL_FALSE: lambda r: mt.TlFalse(),
+    TL_INT: lambda r: mt.TlInt(r.sint()),
+    TL_FLOAT: lambda r: mt.TlFloat(r.double()),
+    TL_STRING: lambda r: mt.TlString(r.string()),
+    TL_SYMBOL: lambda r: mt.TlSymbol(r.string()),
+    TL_INSTRUCTION: lambda r: mt.TlInstruction(r.string()),
+    TL_FUTURE: lambda r: mt.TlFuturePtr(r.value()),
+    TL_QUOTE: lambda r: mt.TlQuote(r.value()),
+    TL_LIST: lambda r: mt.TlList(r.items()),
+    TL_HASH: lambda r: mt.TlHash(r.pairs()),
+    TL_FUNCTION: lambda r: mt.TlFunctionPtr(r.string(), r.value()),
+    TL_FOREIGN: lambda r: mt.TlForeignPtr(r.string(), r.string(), r.string()),
+}
+
+
+def decode(data: bytes):
+    """Decode data created by encode"""
+    if not data:
+        raise BadEncoding("No data")
+    header = data[0]
+    if header & ~COMPRESSED != FORMAT_VERSION:
+        raise BadEncoding(f"Unsupported encoding version: {header & ~COMPRESSED}")
+    body = data[1:]
+    if header & COMPRESSED:
+        body = zlib.decompress(body)
+    reader = _Reader(body)
+    value = reader.value()
+    if reader.pos != len(body):
+        raise BadEncoding(f"Trailing data after position {reader.pos}")
+    return value
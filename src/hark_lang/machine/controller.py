@@ -1,7 +1,7 @@
 """Placeholder for the controller class"""
 
 import logging
-from typing import List
+from typing import List, Optional, Tuple
 
 from ..exceptions import UnexpectedError
 from . import types as mt
@@ -14,6 +14,11 @@ from .thread_failure import StackTraceItem, ThreadFailure
 LOG = logging.getLogger(__name__)
 
 
+# Continuations that start with this are joins (see get_all_or_wait), not
+# thread IDs
+JOIN_PREFIX = "join:"
+
+
 class ControllerError(UnexpectedError):
     """A general controller error"""
 
@@ -33,37 +38,73 @@ class Controller:
             dynamic_chain=None,
             vmid=vmid,
             call_site=None,
-            bindings={},
+            locals=self.executable.new_frame(fn_ptr.identifier),
             ref_count=1,
         )
         self.set_entrypoint(fn_ptr.identifier)
         self._init_thread(vmid, fn_ptr, args, arec)
+        self.flush()
         return vmid
 
     def thread_machine(self, caller_arec_ptr, caller_ip, fn_ptr, args):
         """Create a new thread machine"""
-        vmid = self.new_thread()
-        arec = ActivationRecord(
-            function=fn_ptr,
-            dynamic_chain=caller_arec_ptr,
-            vmid=vmid,
-            call_site=caller_ip - 1,
-            bindings={},
-            ref_count=1,
-        )
-        self._init_thread(vmid, fn_ptr, args, arec)
-        return vmid
+        return self.thread_machines(caller_arec_ptr, caller_ip, [(fn_ptr, args)])[0]
+
+    def thread_machines(self, caller_arec_ptr, caller_ip, calls) -> List[int]:
+        """Create several new thread machines at once
+
+        CALLS is a list of (fn_ptr, args), one for each thread. The IDs are
+        reserved together (see new_threads), and the threads stored together
+        (see init_threads). Return the new thread IDs, in order.
+        """
+        vmids, ptrs = self.new_threads(len(calls))
+        threads = []
+        for vmid, ptr, (fn_ptr, args) in zip(vmids, ptrs, calls):
+            arec = ActivationRecord(
+                function=fn_ptr,
+                dynamic_chain=caller_arec_ptr,
+                vmid=vmid,
+                call_site=caller_ip - 1,
+                locals=self.executable.new_frame(fn_ptr.identifier),
+                ref_count=1,
+            )
+            state = State(args)
+            state.current_arec_ptr = ptr
+            state.locals = arec.locals
+            state.ip = self.executable.locations[fn_ptr.identifier]
+            threads.append((vmid, ptr, arec, state))
+        # The caller's record is referred to before the threads are stored, so
+        # it can be stored with them if it isn't already
+        if caller_arec_ptr is not None:
+            self.increment_ref(caller_arec_ptr, len(calls))
+        self.init_threads(threads)
+        return vmids
+
+    def new_threads(self, count) -> Tuple[List[int], list]:
+        """Reserve the IDs of COUNT new threads, and of their entry records"""
+        vmids = [self.new_thread() for _ in range(count)]
+        ptrs = [self.new_arec() for _ in range(count)]
+        return vmids, ptrs
+
+    def init_threads(self, threads):
+        """Store new threads: a list of (vmid, arec_ptr, arec, state)"""
+        for vmid, ptr, arec, state in threads:
+            self.set_arec(ptr, arec)
+            self.set_state(vmid, state)
+            self.set_future(vmid, Future())
+            self.set_stopped(vmid, False)
 
     def _init_thread(self, vmid, fn_ptr, args, arec):
         state = State(args)
         entrypoint_ip = self.executable.locations[fn_ptr.identifier]
         ptr = self.push_arec(vmid, arec)
         state.current_arec_ptr = ptr
+        state.locals = arec.locals
         state.ip = entrypoint_ip
         self.set_state(vmid, state)
         future = Future()
         self.set_future(vmid, future)
-        self.set_stopped(vmid, False)
+        # NOTE: new_thread already marked the thread as running
         return vmid
 
     ##
@@ -116,15 +157,12 @@ class Controller:
         if isinstance(value, mt.TlFuturePtr):
             raise TypeError(value)
 
-        with self.lock_future(vmid):
-            future = self.get_future(vmid)
-            future.resolved = True
-            future.value = value
-            self.set_future(vmid, future)
-
-            continuations = future.continuations
-            if future.chain:
-                continuations += self.resolve_future(future.chain, value)
+        # Nothing can be added to the future once it has resolved, so these
+        # are all of the continuations
+        future = self.mark_resolved(vmid, value)
+        continuations = self._continue_joins(future.continuations)
+        if future.chain:
+            continuations += self.resolve_future(future.chain, value)
 
         if self.is_top_level(vmid):
             self.result = mt.to_py_type(value)
@@ -147,15 +185,11 @@ class Controller:
         # Otherwise, VALUE is another future, and we can only resolve this machine's
         # future if VALUE has also resolved. If VALUE hasn't resolved, we "chain"
         # this machine's future to it.
-        next_future_id = value.vmid
-        with self.lock_future(next_future_id):
-            next_future = self.get_future(next_future_id)
-            if next_future.resolved:
-                return (next_future.value, self.resolve_future(vmid, next_future.value))
-            else:
-                LOG.info("Chaining %s to %s", vmid, value)
-                self.set_future_chain(next_future_id, vmid)
-                return None, []
+        next_future = self.chain_unless_resolved(value.vmid, vmid)
+        if next_future is not None:
+            return (next_future.value, self.resolve_future(vmid, next_future.value))
+        LOG.info("Chained %s to %s", vmid, value)
+        return None, []
 
     def get_or_wait(self, vmid, future_ptr):
         """Get the value of a future in the stack, or add a continuation
@@ -170,21 +204,102 @@ class Controller:
         if type(vmid) is not int:
             raise TypeError(vmid)
 
-        with self.lock_future(future_ptr.vmid):
-            future = self.get_future(future_ptr.vmid)
+        future = self.add_continuation_unless_resolved(future_ptr.vmid, vmid)
+        if future is not None:
+            LOG.info("%s has resolved: %s", future_ptr, future.value)
+            return True, future.value
+        LOG.info("%d waiting on %s", vmid, future_ptr)
+        return False, None
+
+    def get_all_or_wait(self, vmid, future_ptrs):
+        """Get the values of several futures, or wait for all of them
+
+        If any haven't resolved, VMID is continued once, when the last one
+        resolves: a "join" with a count of unresolved futures is added to their
+        continuations, and resolve_future decrements it.
+
+        Return tuple:
+        - resolved (bool): whether all of the futures have resolved
+        - values: Their values, or None if not resolved
+        """
+        if type(vmid) is not int:
+            raise TypeError(vmid)
+        for ptr in future_ptrs:
+            if not isinstance(ptr, mt.TlFuturePtr):
+                raise TypeError(ptr)
+
+        futures = [self.get_future(ptr.vmid) for ptr in future_ptrs]
+        pending = [ptr for ptr, f in zip(future_ptrs, futures) if not f.resolved]
+        if not pending:
+            return True, [f.value for f in futures]
+
+        # The extra count stops the join completing until all pending futures
+        # are checked again (they may resolve in the meantime)
+        join = self.new_join(vmid, len(pending) + 1)
+        for ptr in pending:
+            if self.add_continuation_unless_resolved(ptr.vmid, join) is not None:
+                self.decrement_join(join)
+
+        remaining, _ = self.decrement_join(join)
+        if remaining:
+            LOG.info("%d waiting on %d futures", vmid, remaining)
+            return False, None
+        # Everything resolved, so nothing else will continue VMID
+        return True, [self.get_future(ptr.vmid).value for ptr in future_ptrs]
+
+    ## Atomic future operations. Override these if the controller can do them
+    ## without locking the future.
+
+    def mark_resolved(self, vmid, value) -> Future:
+        """Resolve future VMID to VALUE, returning it (with its continuations)"""
+        with self.lock_future(vmid):
+            future = self.get_future(vmid)
+            future.resolved = True
+            future.value = value
+            self.set_future(vmid, future)
+        return future
+
+    def add_continuation_unless_resolved(self, fut_ptr, item) -> Optional[Future]:
+        """Add ITEM to the continuations of future FUT_PTR if it hasn't resolved
+
+        Return the future if it has resolved (and ITEM wasn't added).
+        """
+        with self.lock_future(fut_ptr):
+            future = self.get_future(fut_ptr)
             if future.resolved:
-                value = future.value
-                LOG.info("%s has resolved: %s", future_ptr, value)
-            else:
-                value = None
-                self.add_continuation(future_ptr.vmid, vmid)
-                LOG.info("%d waiting on %s", vmid, future_ptr)
-                future = self.get_future(future_ptr.vmid)
+                return future
+            self.add_continuation(fut_ptr, item)
+        return None
 
-        return future.resolved, value
+    def chain_unless_resolved(self, fut_ptr, vmid) -> Optional[Future]:
+        """Chain future VMID to future FUT_PTR if it hasn't resolved
+
+        Return the future if it has resolved (and VMID wasn't chained).
+        """
+        with self.lock_future(fut_ptr):
+            future = self.get_future(fut_ptr)
+            if future.resolved:
+                return future
+            self.set_future_chain(fut_ptr, vmid)
+        return None
+
+    def _continue_joins(self, continuations: list) -> list:
+        """Replace joins with the threads that can now be continued"""
+        result = []
+        for item in continuations:
+            if isinstance(item, str) and item.startswith(JOIN_PREFIX):
+                remaining, vmid = self.decrement_join(item)
+                if not remaining:
+                    result.append(vmid)
+            else:
+                result.append(item)
+        return result
 
     ##
 
+    def flush(self):
+        """Write any buffered data (output, probe data and unsaved records)"""
+
     def stop(self, vmid, finished_ok):
         """Signal that a machine has stopped running"""
         if not finished_ok:
@@ -217,14 +332,17 @@ class Controller:
         arec_ptr = state.current_arec_ptr
         arec = self.get_arec(arec_ptr)
 
-        # Push the current frame
-        trace.append(
-            StackTraceItem(
-                caller_thread=vmid,
-                caller_ip=state.ip - 1,  # minus 1: IP is pre-advanced
-                caller_fn=arec.function.identifier,
+        # The frames in this thread (innermost last). Each frame's call site
+        # is in the function of the frame before it.
+        functions = [arec.function] + [frame.function for frame in state.frames]
+        call_sites = [frame.call_site for frame in state.frames]
+        call_sites.append(state.ip - 1)  # minus 1: IP is pre-advanced
+        for fn, ip in reversed(list(zip(functions, call_sites))):
+            trace.append(
+                StackTraceItem(
+                    caller_thread=vmid, caller_ip=ip, caller_fn=fn.identifier,
+                )
             )
-        )
 
         # And then all parents
         while True:
@@ -1,13 +1,22 @@
 """The Hark Machine Executable class"""
 
-from dataclasses import dataclass
-from typing import Any, Dict, List
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional
 
 from ..cli import interface as ui
-from . import instructionset
+from ..exceptions import UserResolvableError
+from . import bytecode, instructionset
 from .instruction import Instruction
 from .types import TlType
 
+# Instructions whose first operand is a local variable slot
+SLOT_INSTRUCTIONS = (
+    instructionset.Bind,
+    instructionset.BindPop,
+    instructionset.PushL,
+    instructionset.PushLB,
+)
+
 
 @dataclass
 class Executable:
@@ -17,6 +26,32 @@ class Executable:
     locations: Dict[str, int]
     code: List[Instruction]
     attributes: dict
+    # Local variable names of each function, by slot (None in executables
+    # compiled before slots were introduced)
+    locals: Optional[Dict[str, List[str]]] = field(default_factory=dict)
+
+    def check_runnable(self):
+        """Check that the code uses local variable slots, so it can be run"""
+        if self.locals is None:
+            raise UserResolvableError(
+                "The executable was compiled by an older version of Hark",
+                "Compile (or deploy) the program again.",
+            )
+
+    def new_frame(self, identifier: str) -> list:
+        """Get empty local variable slots for a function"""
+        self.check_runnable()
+        return [None] * len(self.locals[identifier])
+
+    def function_at(self, ip: int) -> str:
+        """Get the identifier of the function that contains IP"""
+        return max(
+            (loc, name) for name, loc in self.locations.items() if loc <= ip
+        )[1]
+
+    def local_name(self, ip: int, slot: int) -> str:
+        """Get the name of a local variable slot in the function at IP"""
+        return self.locals[self.function_at(ip)][slot]
 
     def listing(self) -> str:
         """Get a pretty assembly listing string"""
@@ -27,7 +62,11 @@ class Executable:
                     k for k in self.locations.keys() if self.locations[k] == i
                 )
                 print(" | " + ui.primary(f";; {funcname}:"))
-            print(f" | {i:4} | {instr}")
+            if isinstance(instr, SLOT_INSTRUCTIONS) and self.locals is not None:
+                name = self.local_name(i, instr.operands[0])
+                print(f" | {i:4} | {instr}" + ui.dim(f" ; {name}"))
+            else:
+                print(f" | {i:4} | {instr}")
         print(" \\")
 
     def bindings_table(self):
@@ -41,19 +80,43 @@ class Executable:
             print(f" {k} {dots} {v}")
 
     def serialise(self) -> dict:
-        """Serialise the executable into a JSON-able dict"""
-        code = [i.serialise() for i in self.code]
+        """Serialise the executable into a JSON-able dict
+
+        The code is packed into a compact form - see bytecode.py.
+        """
+        code = bytecode.pack(self.code)
         bindings = {name: val.serialise() for name, val in self.bindings.items()}
-        return dict(locations=self.locations, bindings=bindings, code=code)
+        return dict(
+            locations=self.locations, bindings=bindings, code=code, locals=self.locals
+        )
 
     @classmethod
     def deserialise(cls, obj: dict):
-        """Deserialise the dict created by serialise"""
-        code = [Instruction.deserialise(i, instructionset) for i in obj["code"]]
+        """Deserialise the dict created by serialise
+
+        Executables saved before local variable slots (with no locals) can
+        still be read and listed, but not run -- see check_runnable. Their
+        instructions have the old operands (e.g. BIND takes a symbol), so
+        they're loaded without checking them against the current
+        instruction set.
+        """
+        legacy = "locals" not in obj
+        if isinstance(obj["code"], list):
+            # Legacy format: a list of serialised Instructions
+            code = [
+                Instruction.deserialise(i, instructionset, trusted=legacy)
+                for i in obj["code"]
+            ]
+        else:
+            code = bytecode.unpack(obj["code"], instructionset)
         bindings = {
             name: TlType.deserialise(val) for name, val in obj["bindings"].items()
         }
         # FIXME attributes
         return cls(
-            locations=obj["locations"], bindings=bindings, code=code, attributes=None
+            locations=obj["locations"],
+            bindings=bindings,
+            code=code,
+            attributes=None,
+            locals=obj.get("locals"),
         )
@@ -0,0 +1,185 @@
+"""Persistent (immutable, structurally shared) hash map
+
+A hash array mapped trie (HAMT): each node holds a 32-bit bitmap of which of
+its 32 slots are used, and a compact tuple of just the used slots. Each slot is
+either an entry, or a child node for the next 5 bits of the hash. Keys with
+identical hashes share a collision node.
+
+set() copies only the nodes on the path to the key -- O(log32 n) -- and the
+original map is unchanged.
+
+Iteration is in insertion order (like dict): the (key, value) pairs are also
+kept in a persistent vector, in the order the keys were first added, and each
+entry records its position in it.
+"""
+
+from typing import Iterable, Tuple
+
+from . import pvector
+
+BITS = 5
+MASK = (1 << BITS) - 1
+HASH_MASK = 0xFFFFFFFF
+
+# Entries are tuples: (hash, key, value, index in the insertion order vector)
+_HASH, _KEY, _VALUE, _IDX = range(4)
+
+_MISSING = object()
+
+
+def _bit(h: int, shift: int) -> int:
+    return 1 << ((h >> shift) & MASK)
+
+
+def _index(bitmap: int, bit: int) -> int:
+    """Position of BIT's slot in the compact items tuple"""
+    return bin(bitmap & (bit - 1)).count("1")
+
+
+def _same_key(entry: tuple, h: int, key) -> bool:
+    return entry[_HASH] == h and (entry[_KEY] is key or entry[_KEY] == key)
+
+
+def _pair_node(shift: int, a: tuple, b: tuple):
+    """Make a node containing entries A and B"""
+    if a[_HASH] == b[_HASH]:
+        return _CollisionNode(a[_HASH], (a, b))
+    node, _ = _BitmapNode(0, ()).set(a, shift)
+    node, _ = node.set(b, shift)
+    return node
+
+
+class _BitmapNode:
+    __slots__ = ("bitmap", "items")
+
+    def __init__(self, bitmap: int, items: tuple):
+        self.bitmap = bitmap
+        self.items = items
+
+    def get(self, h: int, key, shift: int):
+        bit = _bit(h, shift)
+        if not self.bitmap & bit:
+            return _MISSING
+        item = self.items[_index(self.bitmap, bit)]
+        if type(item) is tuple:
+            return item[_VALUE] if _same_key(item, h, key) else _MISSING
+        return item.get(h, key, shift + BITS)
+
+    def set(self, entry: tuple, shift: int):
+        """Get (new node, the entry replaced, or None if the key was added)"""
+        h = entry[_HASH]
+        bit = _bit(h, shift)
+        idx = _index(self.bitmap, bit)
+        if not self.bitmap & bit:
+            items = self.items[:idx] + (entry,) + self.items[idx:]
+            return _BitmapNode(self.bitmap | bit, items), None
+
+        item = self.items[idx]
+        if type(item) is not tuple:
+            new, old = item.set(entry, shift + BITS)
+        elif _same_key(item, h, entry[_KEY]):
+            if item[_VALUE] is entry[_VALUE]:
+                return self, item
+            # Keep the original key and position
+            new, old = (h, item[_KEY], entry[_VALUE], item[_IDX]), item
+        else:
+            new, old = _pair_node(shift + BITS, item, entry), None
+        if new is item:
+            return self, old
+        items = self.items[:idx] + (new,) + self.items[idx + 1 :]
+        return _BitmapNode(self.bitmap, items), old
+
+    def entries(self):
+        for item in self.items:
+            if type(item) is tuple:
+                yield item
+            else:
+                yield from item.entries()
+
+
+class _CollisionNode:
+    __slots__ = ("hash", "items")
+
+    def __init__(self, h: int, items: tuple):
+        self.hash = h
+        self.items = items
+
+    def get(self, h: int, key, shift: int):
+        for item in self.items:
+            if _same_key(item, h, key):
+                return item[_VALUE]
+        return _MISSING
+
+    def set(self, entry: tuple, shift: int):
+        h = entry[_HASH]
+        if h != self.hash:
+            node = _BitmapNode(_bit(self.hash, shift), (self,))
+            return node.set(entry, shift)
+        for idx, item in enumerate(self.items):
+            if _same_key(item, h, entry[_KEY]):
+                if item[_VALUE] is entry[_VALUE]:
+                    return self, item
+                new = (h, item[_KEY], entry[_VALUE], item[_IDX])
+                items = self.items[:idx] + (new,) + self.items[idx + 1 :]
+                return _CollisionNode(h, items), item
+        return _CollisionNode(h, self.items + (entry,)), None
+
+    def entries(self):
+        yield from self.items
+
+
+class PMap:
+    """An immutable map. Don't construct directly - use from_items"""
+
+    __slots__ = ("_root", "_order")
+
+    def __init__(self, root=None, order=pvector.EMPTY):
+        self._root = _BitmapNode(0, ()) if root is None else root
+        self._order = order  # (key, value) pairs, in insertion order
+
+    @classmethod
+    def from_items(cls, items: Iterable[Tuple]) -> "PMap":
+        result = EMPTY
+        for key, value in items:
+            result = result.set(key, value)
+        return result
+
+    def __len__(self):
+        return len(self._order)
+
+    def __getitem__(self, key):
+        value = self._root.get(hash(key) & HASH_MASK, key, 0)
+        if value is _MISSING:
+            raise KeyError(key)
+        return value
+
+    def get(self, key, default=None):
+        value = self._root.get(hash(key) & HASH_MASK, key, 0)
+        return default if value is _MISSING else value
+
+    def __contains__(self, key):
+        return self._root.get(hash(key) & HASH_MASK, key, 0) is not _MISSING
+
+    def set(self, key, value) -> "PMap":
+        """Get a new map with KEY set to VALUE"""
+        entry = (hash(key) & HASH_MASK, key, value, len(self._order))
+        root, old = self._root.set(entry, 0)
+        if root is self._root:
+            return self
+        if old is None:
+            return PMap(root, self._order.push((key, value)))
+        return PMap(root, self._order.assoc(old[_IDX], (old[_KEY], value)))
+
+    def items(self):
+        """(key, value) pairs, in insertion order"""
+        return iter(self._order)
+
+    def __iter__(self):
+        for key, _ in self._order:
+            yield key
+
+    def __repr__(self):
+        return f"PMap({dict(self.items())})"
+
+
+EMPTY = PMap()
@@ -43,6 +43,19 @@ class Instruction:
         ]
         return cls(*operands, source=source)
 
+    @classmethod
+    def from_trusted(cls, operands: tuple, source: list):
+        """Make an instruction without checking the operands
+
+        Only for operands that are known to be valid already, e.g. when
+        unpacking an executable.
+        """
+        instr = cls.__new__(cls)
+        instr.name = cls.__name__
+        instr.source = source
+        instr.operands = operands
+        return instr
+
     def __init__(self, *operands, source: list = None):
         self.name = type(self).__name__
         self.source = source or [None, None, None, None]
@@ -71,15 +84,19 @@ class Instruction:
         return [self.name, operands, self.source]
 
     @classmethod
-    def deserialise(cls, obj: list, instruction_set):
+    def deserialise(cls, obj: list, instruction_set, trusted: bool = False):
         """Deserialise an Instruction
 
         instruction_set: Module of Instruction types
+        trusted: Don't check the operands (see from_trusted)
         """
         name = obj[0]
         operands = [TlType.deserialise(o) for o in obj[1]]
         source = obj[2]
-        return getattr(instruction_set, name)(*operands, source=source)
+        instr_cls = getattr(instruction_set, name)
+        if trusted:
+            return instr_cls.from_trusted(tuple(operands), source)
+        return instr_cls(*operands, source=source)
 
     def __repr__(self):
         ops = ", ".join(map(str, self.operands))
@@ -87,6 +104,8 @@ class Instruction:
         return f"{name:8} {ops}"
 
     def __eq__(self, other):
-        return type(self) == type(other) and all(
-            a == b for a, b in zip(self.operands, other.operands)
+        return (
+            type(self) == type(other)
+            and len(self.operands) == len(other.operands)
+            and all(a == b for a, b in zip(self.operands, other.operands))
         )
@@ -90,6 +90,33 @@ class ACall(I):
     op_types = [int]
 
 
+class PMap(I):
+    """Map a function over a list in parallel (see PMAP_FUNCTION)
+
+    Splits the list into chunks, and calls PMAP_FUNCTION with them.
+    """
+
+    num_ops = 1
+
+
+class PMapFork(I):
+    """Fork threads for all but the first of a list of chunks
+
+    Threads are forked in a tree: the second half of the chunks is given to a
+    new thread running PMAP_FUNCTION, which forks more threads itself, and so
+    on with the first half, until only one chunk is left. Pushes the futures
+    (in list order), and then the remaining chunk.
+    """
+
+
+class PMapJoin(I):
+    """Concatenate a list of lists onto the list below it on the stack"""
+
+
+# The function (created by the compiler) that runs one node of a pmap tree
+PMAP_FUNCTION = "#pmap"
+
+
 ##± Conditions ±################################################################
 
 # Like Exceptions, but a bit more powerful
@@ -141,19 +168,41 @@ class PushV(I):
 
 
 class Bind(I):
-    """Take the top value off the stack and bind it to a register
+    """Bind the top value on the stack to a local variable slot
 
-    Maybe - if the given binding doesn't exist in the current binding stack,
-    each parent stack will be searched until a matching binding is found. That'd
-    make this machine far more dynamic! And make compilation harder.
+    Slots are assigned by the compiler - see Executable.locals for the names.
 
     """
 
-    op_types = [mt.TlSymbol]
+    op_types = [int]
+
+
+class PushL(I):
+    """Push the value of a local variable slot onto the stack"""
+
+    op_types = [int]
+
+
+class PushLB(I):
+    """Push a local variable slot, or the bound value of the same name if unset
+
+    For reads of a name that is assigned in the function, and is also a global
+    or builtin. Until the assignment runs, the global or builtin is read.
+
+    Operands:
+      - [0] int: The slot
+      - [1] TlSymbol: The name
+    """
+
+    op_types = [int, mt.TlSymbol]
 
 
 class PushB(I):
-    """Push a bound value onto the stack"""
+    """Push a (global or builtin) bound value onto the stack
+
+    The compiler resolves known names to values, so this is only needed for
+    names that weren't known at compile time.
+    """
 
     op_types = [mt.TlSymbol]
 
@@ -162,6 +211,39 @@ class Pop(I):
     """Remove top value from the stack and discard it"""
 
 
+##± Superinstructions ±#########################################################
+
+# Created by the peephole optimiser, each one replaces a common sequence
+
+
+class BindPop(I):
+    """Bind the top value on the stack to a local slot, and pop it (Bind; Pop)"""
+
+    op_types = [int]
+
+
+class CallBound(I):
+    """Call a function known at compile time (PushV f; Call n)
+
+    Operands:
+      - [0] int: The number of arguments
+      - [1] TlFunctionPtr or TlForeignPtr: The function
+    """
+
+    op_types = [int, mt.TlType]
+
+
+class CallBuiltin(I):
+    """Call a builtin, skipping the handler lookup (PushV builtin; Call n)
+
+    Operands:
+      - [0] int: The number of arguments
+      - [1] TlSymbol: The builtin name (a key of BUILTINS)
+    """
+
+    op_types = [int, mt.TlSymbol]
+
+
 ##± Data Manipulation ±#########################################################
 
 
@@ -189,6 +271,19 @@ class LessThanOrEqual(I):
     pass
 
 
+class CheckBool(I):
+    """Check that the top value on the stack is a boolean, leaving it there
+
+    Used by the short-circuit code for && and ||, which must still only be
+    given booleans.
+
+    Operands:
+      - [0] TlSymbol: The operator (for the error message)
+    """
+
+    op_types = [mt.TlSymbol]
+
+
 class OpAnd(I):
     pass
 
@@ -308,3 +403,44 @@ class GetSessionId(I):
 
 class GetThreadId(I):
     """Get the current thread ID"""
+
+
+##± Builtins ±##################################################################
+
+# Builtin functions, by name, and the instructions that implement them
+BUILTINS = {
+    "future": Future,
+    "print": Print,
+    "sleep": Sleep,
+    "atomp": Atomp,
+    "nullp": Nullp,
+    "list": List,
+    "conc": Conc,
+    "append": Append,
+    "first": First,
+    "rest": Rest,
+    "length": Length,
+    "hash": Hash,
+    "get": HGet,
+    "set": HSet,
+    "nth": Nth,
+    "==": Eq,
+    "!=": NEq,
+    "+": Plus,
+    "-": Minus,
+    "*": Multiply,
+    "%": Modulo,
+    "/": Divide,
+    ">": GreaterThan,
+    ">=": GreaterThanOrEqual,
+    "<": LessThan,
+    "<=": LessThanOrEqual,
+    "&&": OpAnd,
+    "||": OpOr,
+    "!": BooloeanNeg,
+    "parse_float": ParseFloat,
+    "signal": Signal,
+    "sid": GetSessionId,
+    "tid": GetThreadId,
+    "pmap": PMap,
+}
@@ -7,12 +7,14 @@ definitions, or let-bindings.
 
 """
 
+import asyncio
+import dataclasses
 import logging
 import os
 import sys
 import time
 import traceback
-from functools import singledispatchmethod
+from collections.abc import Mapping
 from io import StringIO
 from typing import Any, Dict, List
 
@@ -24,7 +26,7 @@ from .executable import Executable
 from .instruction import Instruction
 from .instructionset import *
 from .probe import Probe
-from .state import State
+from .state import Frame, State
 from .stdout_item import StdoutItem
 from .foreign import import_python_function
 
@@ -48,9 +50,9 @@ class ForeignError(UserResolvableError):
 
 
 def traverse(o, tree_types=(list, tuple)):
-    """Traverse an arbitrarily nested list"""
+    """Traverse an arbitrarily nested list (or the values of nested mappings)"""
     if isinstance(o, tree_types):
-        for value in o:
+        for value in o.values() if isinstance(o, Mapping) else o:
             for subvalue in traverse(value, tree_types):
                 yield subvalue
     else:
@@ -63,6 +65,27 @@ def shortstr(obj, maxl=20) -> str:
     return (s[:maxl] + "...") if len(s) > maxl else s
 
 
+# How many steps to run between checks of the run() deadline
+STEPS_PER_DEADLINE_CHECK = 1000
+
+
+# Instruction class -> (unbound) TlMachine method that evaluates it
+_EVALUATORS = {}
+
+
+def evaluates(instr_cls):
+    """Register the decorated method as the evaluator for INSTR_CLS
+
+    The method is called with the instruction operands tuple.
+    """
+
+    def _register(fn):
+        _EVALUATORS[instr_cls] = fn
+        return fn
+
+    return _register
+
+
 class TlMachine:
     """Virtual Machine to execute Hark bytecode.
 
@@ -77,61 +100,60 @@ class TlMachine:
 
     """
 
-    builtins = {
-        "future": Future,
-        "print": Print,
-        "sleep": Sleep,
-        "atomp": Atomp,
-        "nullp": Nullp,
-        "list": List,
-        "conc": Conc,
-        "append": Append,
-        "first": First,
-        "rest": Rest,
-        "length": Length,
-        "hash": Hash,
-        "get": HGet,
-        "set": HSet,
-        "nth": Nth,
-        "==": Eq,
-        "!=": NEq,
-        "+": Plus,
-        "-": Minus,
-        "*": Multiply,
-        "%": Modulo,
-        "/": Divide,
-        ">": GreaterThan,
-        ">=": GreaterThanOrEqual,
-        "<": LessThan,
-        "<=": LessThanOrEqual,
-        "&&": OpAnd,
-        "||": OpOr,
-        "!": BooloeanNeg,
-        "parse_float": ParseFloat,
-        "signal": Signal,
-        "sid": GetSessionId,
-        "tid": GetThreadId,
-    }
+    builtins = BUILTINS
 
     def __init__(self, vmid, invoker):
         self._steps = 0
         self.vmid = vmid
         self.invoker = invoker
         self.dc = invoker.data_controller
+        # Executors with an event loop run foreign calls themselves
+        self._await_foreign = getattr(invoker, "await_foreign", None)
+        self._awaiting = None  # (foreign function, args) to run asynchronously
+        self._takeover = None  # waiting thread to continue when this one finishes
         self.state = self.dc.get_state(self.vmid)
         self.probe = Probe(self.vmid)
         self.exe = self.dc.executable
         if not self.exe:
             raise UnexpectedError("No executable, can't start thread.")
+        self.exe.check_runnable()
         self._foreign = {
             name: import_python_function(val.identifier, val.module)
             for name, val in self.exe.bindings.items()
             if isinstance(val, mt.TlForeignPtr)
         }
+        # Resolve every instruction to its evaluator once, up front, so that
+        # step() is just an index into a table of bound methods.
+        self._evaluators = {
+            cls: fn.__get__(self, TlMachine) for cls, fn in _EVALUATORS.items()
+        }
+        self._builtin_handlers = {
+            name: self._evaluator(cls) for name, cls in TlMachine.builtins.items()
+        }
+        self._handlers = [self._handler(instr) for instr in self.exe.code]
+        self._frame_sizes = {name: len(l) for name, l in self.exe.locals.items()}
         LOG.debug("locations %s", self.exe.locations.keys())
         LOG.debug("foreign %s", self._foreign.keys())
         # No entrypoint argument - just set the IP in the state
 
+    def _handler(self, instr):
+        """Get the bound evaluator for a particular instruction"""
+        if isinstance(instr, CallBuiltin):
+            # The builtin is known - no need to look it up at runtime
+            return self._builtin_handlers[instr.operands[1]]
+        return self._evaluator(type(instr))
+
+    def _evaluator(self, instr_cls):
+        """Get the bound evaluator for an instruction class"""
+        try:
+            return self._evaluators[instr_cls]
+        except KeyError:
+            # Only fail if (when) the instruction is actually executed
+            def _not_implemented(ops):
+                raise NotImplementedError(instr_cls)
+
+            return _not_implemented
+
     @property
     def stopped(self):
         return self.state.stopped
@@ -142,23 +164,47 @@ class TlMachine:
 
     def step(self):
         """Execute the current instruction and increment the IP"""
-        if self.state.ip >= len(self.exe.code):
+        if self.probe.steps:
+            self._step_traced()
+        else:
+            self._step()
+
+    def _step(self):
+        ip = self.state.ip
+        if ip >= len(self.exe.code):
             raise UnexpectedError("Instruction Pointer out of bounds")
-        instr = self.exe.code[self.state.ip]
-        self.probe.event(
-            "step",
-            ip=self.state.ip,
-            instr=str(instr),
-            ops=str(instr.operands),
-            top_of_stack=shortstr(self.state._ds[-3:]),
-        )
-        self.state.ip += 1  # NOTE - IP incremented before evaluation
-        self.evali(instr)
+        self.state.ip = ip + 1  # NOTE - IP incremented before evaluation
+        self._handlers[ip](self.exe.code[ip].operands)
         self._steps += 1  # Counts successfully completed steps
 
-    def run(self):
+    def _step_traced(self):
+        ip = self.state.ip
+        if ip >= len(self.exe.code):
+            raise UnexpectedError("Instruction Pointer out of bounds")
+        instr = self.exe.code[ip]
+        if self._steps % self.probe.sample == 0:
+            self.probe.event(
+                "step",
+                ip=ip,
+                instr=str(instr),
+                ops=str(instr.operands),
+                top_of_stack=shortstr(self.state._ds[-3:]),
+            )
+        self.state.ip = ip + 1
+        self._handlers[ip](instr.operands)
+        self._steps += 1
+
+    def run(self, deadline=None, clock=time.monotonic, resume_with=None):
         """Step through instructions until stopped, or an error occurs
 
+        If DEADLINE (compared with CLOCK()) is given, and passes before the
+        thread stops, save the state and invoke a new machine to continue. This
+        lets long-running threads survive the Lambda timeout.
+
+        RESUME_WITH continues after a foreign call run by the executor (see
+        await_foreign in executors/aio.py): it is called to get the call's
+        result (or raise its exception).
+
         ERRORS: If one occurs, then:
         - store it in the data controller for analysis later
         - stop execution
@@ -166,47 +212,104 @@ class TlMachine:
 
         There are two "expected" kinds of errors - a Foreign function error, and
         a Rust "panic!" style error (general error).
+
+        When the thread finishes, this machine continues one of the threads
+        that were waiting for it (see Return), if the deadline allows, instead
+        of invoking a new machine.
         """
+        self._run_thread(deadline, clock, resume_with)
+        while self._takeover is not None:
+            vmid, self._takeover = self._takeover, None
+            if deadline is not None and clock() >= deadline:
+                self.invoker.invoke(vmid)
+                return
+            self.switch_thread(vmid)
+            self._run_thread(deadline, clock, None)
+
+    def switch_thread(self, vmid):
+        """Continue thread VMID in this machine (instead of making a new one)"""
+        LOG.info(f"Machine for {self.vmid} continuing {vmid}")
+        self.vmid = vmid
+        self.state = self.dc.get_state(vmid)
+        self.probe = Probe(vmid)
+        self._steps = 0
+
+    def _run_thread(self, deadline, clock, resume_with):
+        """Run the current thread (see run)"""
         self.probe.event("run")
         broken = False
+        checkpoint = False
 
         self.state.stopped = False
-        while not self.state.stopped:
-            try:
-                self.step()
-            except HarkError as exc:
-                broken = True
-                self.state.stopped = True
-                self.state.error_msg = str(exc)
-                # TODO maybe dump the "core"
-                break
-            except Exception as exc:
-                # It's important to catch *all* errors so that other threads
-                # don't continue waiting for this to return.
-                broken = True
-                self.state.stopped = True
-                msg = f"Unexpected Exception:\n\n" + "".join(
-                    traceback.format_exception(*sys.exc_info())
-                )
-                self.state.error_msg = msg
-                break
+        # Only pay for step tracing if it's enabled
+        step = self._step_traced if self.probe.steps else self._step
+        try:
+            if resume_with is not None:
+                self._push_foreign_result(resume_with)
+            # NOTE: the try is outside the loop - entering it on every step is
+            # not free.
+            if deadline is None:
+                while not self.state.stopped:
+                    step()
+            else:
+                checkpoint = self._run_until(step, deadline, clock)
+        except HarkError as exc:
+            broken = True
+            self.state.stopped = True
+            self.state.error_msg = str(exc)
+            # TODO maybe dump the "core"
+        except Exception as exc:
+            # It's important to catch *all* errors so that other threads
+            # don't continue waiting for this to return.
+            broken = True
+            self.state.stopped = True
+            msg = f"Unexpected Exception:\n\n" + "".join(
+                traceback.format_exception(*sys.exc_info())
+            )
+            self.state.error_msg = msg
+
+        if not broken and (checkpoint or self._awaiting):
+            # Not stopped - continue in a fresh machine
+            event = "checkpoint" if checkpoint else "await_foreign"
+            self.probe.event(event, steps=self._steps)
+            self.dc.set_state(self.vmid, self.state)
+            self.dc.set_probe_data(self.vmid, self.probe)
+            self.dc.flush()
+            if checkpoint:
+                self.invoker.invoke(self.vmid)
+            else:
+                self._await_foreign(self.vmid, *self._awaiting)
+            return
 
         self.probe.event("stop", steps=self._steps)
         self.dc.set_state(self.vmid, self.state)
         self.dc.set_probe_data(self.vmid, self.probe)
+        self.dc.flush()
         # This order is important. dc.stop must come last to avoid race
         # conditions in us setting/the user reading the state and probe data
         self.dc.stop(self.vmid, finished_ok=not broken)
 
-    @singledispatchmethod
+    def _run_until(self, step, deadline, clock) -> bool:
+        """Step until stopped or DEADLINE passes, returning whether it passed
+
+        Always makes some progress, even if the deadline has already passed.
+        """
+        state = self.state
+        while True:
+            for _ in range(STEPS_PER_DEADLINE_CHECK):
+                step()
+                if state.stopped:
+                    return False
+            if clock() >= deadline:
+                return True
+
     def evali(self, i: Instruction):
         """Evaluate instruction"""
-        raise NotImplementedError(i)
+        self._evaluator(type(i))(i.operands)
 
-    @evali.register
-    def _(self, i: Bind):
-        """Bind the top value on the data stack to a name"""
-        ptr = str(i.operands[0])
+    @evaluates(Bind)
+    def _(self, ops):
+        """Bind the top value on the data stack to a local variable slot"""
         try:
             val = self.state.ds_peek(0)
         except IndexError as exc:
@@ -218,102 +321,136 @@ class TlMachine:
             )
         if not isinstance(val, mt.TlType):
             raise UnexpectedError(f"Bad value to Bind: {val} ({type(val)})")
-        self.state.bindings[ptr] = val
+        self.state.locals[ops[0]] = val
 
-    @evali.register
-    def _(self, i: PushB):
-        """Push the value bound to a name onto the data stack"""
-        # The value on the stack must be a Symbol, which is used to find a
-        # function to call. Binding precedence:
+    @evaluates(BindPop)
+    def _(self, ops):
+        """Bind the top value on the data stack to a local slot, and pop it"""
+        self._evaluators[Bind](ops)
+        self.state.ds_pop()
+
+    @evaluates(PushL)
+    def _(self, ops):
+        """Push the value of a local variable slot onto the stack"""
+        val = self.state.locals[ops[0]]
+        if val is None:
+            name = self.exe.local_name(self.state.ip - 1, ops[0])
+            raise UserResolvableError(
+                f"'{name}' is not defined", "It is used before it is assigned."
+            )
+        self.state.ds_push(val)
+
+    def _lookup(self, sym):
+        """Get the value bound to a (non-local) name"""
+        # Locals are resolved to slots at compile time. Binding precedence:
         #
-        # local binding -> exe global bindings -> builtins
-        sym = i.operands[0]
+        # exe global bindings -> builtins
         if not isinstance(sym, mt.TlSymbol):
             raise UnexpectedError(str(ValueError(sym, type(sym))))
 
         ptr = str(sym)
-        if ptr in self.state.bindings:
-            val = self.state.bindings[ptr]
-        elif ptr in self.exe.bindings:
-            val = self.exe.bindings[ptr]
+        if ptr in self.exe.bindings:
+            return self.exe.bindings[ptr]
         elif ptr in TlMachine.builtins:
-            val = mt.TlInstruction(ptr)
+            return mt.TlInstruction(ptr)
         else:
             # FIXME should be a compile time check
             raise UserResolvableError(f"'{ptr}' is not defined", "")
 
+    @evaluates(PushLB)
+    def _(self, ops):
+        """Push a local variable slot, or the global/builtin if it's unset"""
+        val = self.state.locals[ops[0]]
+        if val is None:
+            val = self._lookup(ops[1])
         self.state.ds_push(val)
 
-    @evali.register
-    def _(self, i: PushV):
-        val = i.operands[0]
+    @evaluates(PushB)
+    def _(self, ops):
+        """Push the value bound to a name onto the data stack"""
+        self.state.ds_push(self._lookup(ops[0]))
+
+    @evaluates(PushV)
+    def _(self, ops):
+        val = ops[0]
         self.state.ds_push(val)
 
-    @evali.register
-    def _(self, i: Pop):
+    @evaluates(Pop)
+    def _(self, ops):
         self.state.ds_pop()
 
-    @evali.register
-    def _(self, i: Jump):
-        distance = i.operands[0]
+    @evaluates(Jump)
+    def _(self, ops):
+        distance = ops[0]
         self.state.ip += distance
 
-    @evali.register
-    def _(self, i: JumpIf):
-        distance = i.operands[0]
+    @evaluates(JumpIf)
+    def _(self, ops):
+        distance = ops[0]
         a = self.state.ds_pop()
         # "true" means anything that's not False or Null
         if not isinstance(a, (mt.TlNull, mt.TlFalse)):
             self.state.ip += distance
 
-    @evali.register
-    def _(self, i: Return):
-        # Only return if there's somewhere to go to, and it's in the same thread
-        current_arec = self.dc.pop_arec(self.state.current_arec_ptr)
-        if current_arec.dynamic_chain is not None:
-            new_arec = self.dc.get_arec(current_arec.dynamic_chain)
-            if new_arec.vmid == self.vmid:
-                self.probe.event("return")
-                self.state.current_arec_ptr = current_arec.dynamic_chain  # the new AR
-                self.state.ip = current_arec.call_site + 1
-                self.state.bindings = new_arec.bindings
-                return
+    @evaluates(Return)
+    def _(self, ops):
+        # Only return if there's somewhere to go to in this thread
+        if self.state.frames:
+            frame = self.state.frames.pop()
+            if frame.arec_ptr is not None:
+                # A forked thread may still refer to it
+                self.dc.pop_arec(frame.arec_ptr)
+            self.probe.event("return")
+            self.state.ip = frame.call_site + 1
+            self.state.locals = frame.caller_locals
+            return
 
         # Otherwise, this thread has finished!
+        self.dc.pop_arec(self.state.current_arec_ptr)
         self.state.stopped = True
         value = self.state.ds_peek(0)
-        self.probe.log(f"Returning value: {shortstr(value)}")
+        if self.probe.lifecycle:
+            self.probe.log(f"Returning value: {shortstr(value)}")
         value, continuations = self.dc.finish(self.vmid, value)
         for machine in continuations:
             self.dc.set_stopped(machine, False)
-            # FIXME - invoke all of the machines except the last one. That
-            # one, just run in this context. Save one invocation. Caution:
-            # tricky with Lambda timeouts.
-            self.invoker.invoke(machine)
-
-    @evali.register
-    def _(self, i: Call):
+        if continuations:
+            # Continue the last one in this machine (after saving this thread),
+            # saving an invocation. See run().
+            *others, self._takeover = continuations
+            for machine in others:
+                self.invoker.invoke(machine)
+
+    @evaluates(Call)
+    def _(self, ops):
         # Arguments for the function must already be on the stack
-        num_args = i.operands[0]
         # The value to call will have been retrieved earlier by PushB.
-        fn = self.state.ds_pop()
+        self._call(self.state.ds_pop(), ops)
+
+    @evaluates(CallBound)
+    def _(self, ops):
+        self._call(ops[1], ops)
+
+    @evaluates(CallBuiltin)
+    def _(self, ops):
+        self._builtin_handlers[ops[1]](ops)
+
+    def _call(self, fn, ops):
+        """Call FN with the arguments on the stack. ops[0] is the arg count."""
+        num_args = ops[0]
 
         if isinstance(fn, mt.TlFunctionPtr):
-            self.probe.event("call", function=str(fn))
-            self.state.bindings = {}
-            arec = ActivationRecord(
-                function=fn,
-                vmid=self.vmid,
-                dynamic_chain=self.state.current_arec_ptr,
-                call_site=self.state.ip - 1,
-                bindings=self.state.bindings,
-                ref_count=1,
-            )
-            self.state.current_arec_ptr = self.dc.push_arec(self.vmid, arec)
+            if self.probe.calls:
+                self.probe.event("call", function=str(fn))
+            # The frame stays in the State -- no controller access needed
+            frame = Frame(fn, self.state.ip - 1, self.state.locals)
+            self.state.frames.append(frame)
+            self.state.locals = [None] * self._frame_sizes[fn.identifier]
             self.state.ip = self.exe.locations[fn.identifier]
 
         elif isinstance(fn, mt.TlForeignPtr):
-            self.probe.event("call_foreign", function=str(fn))
+            if self.probe.calls:
+                self.probe.event("call_foreign", function=str(fn))
             foreign_f = self._foreign[fn.identifier]
             args = tuple(reversed([self.state.ds_pop() for _ in range(num_args)]))
             # TODO automatically wait for the args? Somehow mark which one we're
@@ -321,10 +458,19 @@ class TlMachine:
 
             py_args = list(map(mt.to_py_type, args))
 
+            if self._await_foreign:
+                # Suspend, and let the executor resume with the result
+                self._awaiting = (foreign_f, py_args)
+                self.state.stopped = True
+                return
+
             # capture Python's standard output
             sys.stdout = capstdout = StringIO()
             try:
                 py_result = foreign_f(*py_args)
+                if asyncio.iscoroutine(py_result):
+                    # No event loop to share - run it to completion here
+                    py_result = asyncio.run(py_result)
             except Exception as e:
                 out = capstdout.getvalue()
                 self.dc.write_stdout(StdoutItem(self.vmid, out))
@@ -341,19 +487,29 @@ class TlMachine:
             self.state.ds_push(result)
 
         elif isinstance(fn, mt.TlInstruction):
-            self.probe.event("call_builtin", function=str(fn))
-            instr = TlMachine.builtins[fn](num_args)
-            self.evali(instr)
+            if self.probe.calls:
+                self.probe.event("call_builtin", function=str(fn))
+            # The builtin's only (possible) operand is the number of arguments,
+            # which is exactly ops[0].
+            self._builtin_handlers[fn](ops)
 
         else:
             # FIXME this should be a compile time check
             raise UnexpectedError(f"Don't know how to call `{fn}' of type {type(fn)}.")
 
-    @evali.register
-    def _(self, i: ACall):
+    def _push_foreign_result(self, get_result):
+        """Push the result of a foreign call run by the executor"""
+        try:
+            py_result = get_result()
+        except Exception as e:
+            raise ForeignError(e) from e
+        self.state.ds_push(mt.to_hark_type(py_result))
+
+    @evaluates(ACall)
+    def _(self, ops):
         # Arguments for the function must already be on the stack
         # ACall can *only* call functions in self.locations (unlike Call)
-        num_args = i.operands[0]
+        num_args = ops[0]
         fn_ptr = self.state.ds_pop()
 
         # FIXME ugh.
@@ -369,23 +525,64 @@ class TlMachine:
             )
 
         args = reversed([self.state.ds_pop() for _ in range(num_args)])
-        machine = self.dc.thread_machine(
-            self.state.current_arec_ptr, self.state.ip, fn_ptr, args
+        self.state.ds_push(self._fork(fn_ptr, args))
+
+    def _fork(self, fn_ptr, args) -> mt.TlFuturePtr:
+        """Start a new thread to call FN_PTR with ARGS"""
+        return self._fork_all([(fn_ptr, args)])[0]
+
+    def _fork_all(self, calls) -> list:
+        """Start a new thread for each (fn_ptr, args) in CALLS
+
+        The threads are created together, which is much cheaper than one at a
+        time with some controllers (see Controller.thread_machines).
+        """
+        machines = self.dc.thread_machines(
+            self._materialise_frames(), self.state.ip, calls
         )
-        self.invoker.invoke(machine)
-        future = mt.TlFuturePtr(machine)
+        for machine, (fn_ptr, _) in zip(machines, calls):
+            self.invoker.invoke(machine)
+            self.probe.event("fork", to_function=fn_ptr.identifier, to_thread=machine)
+        return [mt.TlFuturePtr(machine) for machine in machines]
+
+    def _materialise_frames(self) -> int:
+        """Push the in-memory call frames to the controller as ActivationRecords
 
-        self.probe.event("fork", to_function=fn_ptr.identifier, to_thread=machine)
-        self.state.ds_push(future)
+        Only frames that haven't already been pushed are pushed. Return the
+        pointer to the current (innermost) frame's record.
+        """
+        ptr = self.state.current_arec_ptr
+        frames = self.state.frames
+        for idx, frame in enumerate(frames):
+            if frame.arec_ptr is None:
+                # The locals of FRAME's function are saved by the next frame
+                if idx + 1 < len(frames):
+                    fn_locals = frames[idx + 1].caller_locals
+                else:
+                    fn_locals = self.state.locals
+                arec = ActivationRecord(
+                    function=frame.function,
+                    vmid=self.vmid,
+                    dynamic_chain=ptr,
+                    call_site=frame.call_site,
+                    locals=fn_locals,
+                    ref_count=1,
+                )
+                ptr = self.dc.push_arec(self.vmid, arec)
+                frames[idx] = dataclasses.replace(frame, arec_ptr=ptr)
+            else:
+                ptr = frame.arec_ptr
+        return ptr
 
-    @evali.register
-    def _(self, i: Wait):
+    @evaluates(Wait)
+    def _(self, ops):
         val = self.state.ds_peek(0)
 
         if isinstance(val, mt.TlFuturePtr):
             resolved, result = self.dc.get_or_wait(self.vmid, val)
             if resolved:
-                self.probe.log(f"{val} resolved, got {shortstr(result)}")
+                if self.probe.lifecycle:
+                    self.probe.log(f"{val} resolved, got {shortstr(result)}")
                 self.state.ds_set(0, result)
             else:
                 self.probe.log(f"Waiting for {val}")
@@ -396,18 +593,44 @@ class TlMachine:
                 self.state.ip -= 1
                 self.state.stopped = True
 
-        elif isinstance(val, list) and any(
-            isinstance(elt, mt.TlFuturePtr) for elt in traverse(val)
-        ):
-            # The programmer is responsible for waiting on all elements
-            # of lists.
+        elif isinstance(val, mt.TlList):
+            # Only futures in the list itself are waited for, so check that
+            # there are none in nested lists or hashes before waiting.
+            #
             # NOTE - we don't try to detect futures hidden in other
             # kinds of structured data, which could cause runtime bugs!
-            raise UserResolvableError(
-                "Waiting on a list that contains futures!",
-                "For now, you (the programmer) are responsible for waiting on all "
-                "elements of structured data. For example, use map and await.",
-            )
+            containers = (mt.TlList, mt.TlHash)
+            if any(
+                isinstance(sub, mt.TlFuturePtr)
+                for elt in val
+                if isinstance(elt, containers)
+                for sub in traverse(elt, containers)
+            ):
+                raise UserResolvableError(
+                    "Waiting on a list that contains futures in nested lists "
+                    "or hashes!",
+                    "Only futures in the list itself are waited for. For example, "
+                    "use map to await each nested list.",
+                )
+
+            futures = [elt for elt in val if isinstance(elt, mt.TlFuturePtr)]
+            if not futures:
+                return
+
+            # Wait for all of them at once, to be continued just once
+            resolved, values = self.dc.get_all_or_wait(self.vmid, futures)
+            if resolved:
+                values = iter(values)
+                result = mt.TlList(
+                    next(values) if isinstance(elt, mt.TlFuturePtr) else elt
+                    for elt in val
+                )
+                self.state.ds_set(0, result)
+            else:
+                self.probe.log(f"Waiting for {len(futures)} futures")
+                # repeat the Wait instruction again (see above)
+                self.state.ip -= 1
+                self.state.stopped = True
 
         else:
             # Not an exception. This can happen if a wait is generated for a
@@ -416,8 +639,8 @@ class TlMachine:
 
     ## "builtins":
 
-    @evali.register
-    def _(self, i: Future):
+    @evaluates(Future)
+    def _(self, ops):
         wrapped = str(self.state.ds_pop())
         plugin_name = str(self.state.ds_pop())
 
@@ -432,25 +655,78 @@ class TlMachine:
             self.probe.log("Skipping call to plugin - controller doesn't support it")
             self.state.ds_push(wrapped)
 
-    @evali.register
-    def _(self, i: Atomp):
+    @evaluates(PMap)
+    def _(self, ops):
+        num_args = ops[0]
+        if num_args not in (2, 3):
+            raise UserResolvableError(
+                f"pmap takes 2 or 3 arguments, got {num_args}",
+                "Usage: pmap(function, list, [chunk_size])",
+            )
+        chunk = self.state.ds_pop() if num_args == 3 else 1
+        items = self.state.ds_pop()
+        func = self.state.ds_pop()
+        items = mt.TlList([]) if isinstance(items, mt.TlNull) else items
+        if not isinstance(items, mt.TlList):
+            raise UserResolvableError(f"{items} ({type(items)}) is not a list", "")
+        if not isinstance(chunk, int) or chunk < 1:
+            raise UserResolvableError(
+                f"Bad pmap chunk size: {chunk}", "It must be a positive integer."
+            )
+        if not items:
+            self.state.ds_push(mt.TlList([]))
+            return
+        items = list(items)
+        chunks = mt.TlList(
+            mt.TlList(items[i : i + chunk]) for i in range(0, len(items), chunk)
+        )
+        self.state.ds_push(func)
+        self.state.ds_push(chunks)
+        self._call(mt.TlFunctionPtr(PMAP_FUNCTION, None), (2,))
+
+    @evaluates(PMapFork)
+    def _(self, ops):
+        chunks = list(self.state.ds_pop())
+        func = self.state.ds_pop()
+        fn_ptr = mt.TlFunctionPtr(PMAP_FUNCTION, None)
+        calls = []
+        end = len(chunks)
+        while end > 1:
+            # Give the second half to a new thread, and split the first again
+            mid = (end + 1) // 2
+            calls.append((fn_ptr, [func, mt.TlList(chunks[mid:end])]))
+            end = mid
+        futures = self._fork_all(calls[::-1]) if calls else []
+        self.state.ds_push(mt.TlList(futures))
+        self.state.ds_push(chunks[0])
+
+    @evaluates(PMapJoin)
+    def _(self, ops):
+        lists = self.state.ds_pop()
+        result = self.state.ds_pop()
+        for lst in lists:
+            result = result.concat(lst)
+        self.state.ds_push(result)
+
+    @evaluates(Atomp)
+    def _(self, ops):
         val = self.state.ds_pop()
         self.state.ds_push(tl_bool(not isinstance(val, list)))
 
-    @evali.register
-    def _(self, i: Nullp):
+    @evaluates(Nullp)
+    def _(self, ops):
         val = self.state.ds_pop()
         isnull = isinstance(val, mt.TlNull) or len(val) == 0
         self.state.ds_push(tl_bool(isnull))
 
-    @evali.register
-    def _(self, i: List):
-        num_args = i.operands[0]
+    @evaluates(List)
+    def _(self, ops):
+        num_args = ops[0]
         elts = [self.state.ds_pop() for _ in range(num_args)]
         self.state.ds_push(mt.TlList(reversed(elts)))
 
-    @evali.register
-    def _(self, i: Conc):
+    @evaluates(Conc)
+    def _(self, ops):
         b = self.state.ds_pop()
         a = self.state.ds_pop()
 
@@ -462,12 +738,12 @@ class TlMachine:
             raise UserResolvableError(f"b ({b}, {type(b)}) is not a list", "")
 
         if isinstance(a, mt.TlList):
-            self.state.ds_push(mt.TlList(a + b))
+            self.state.ds_push(a.concat(b))
         else:
-            self.state.ds_push(mt.TlList([a] + b))
+            self.state.ds_push(b.prepended(a))
 
-    @evali.register
-    def _(self, i: Append):
+    @evaluates(Append)
+    def _(self, ops):
         b = self.state.ds_pop()
         a = self.state.ds_pop()
 
@@ -477,47 +753,47 @@ class TlMachine:
             # TODO compile time checks...
             raise UserResolvableError(f"{a} ({type(a)}) is not a list", "")
 
-        self.state.ds_push(mt.TlList(a + [b]))
+        self.state.ds_push(a.appended(b))
 
-    @evali.register
-    def _(self, i: First):
+    @evaluates(First)
+    def _(self, ops):
         lst = self.state.ds_pop()
         if not isinstance(lst, mt.TlList):
             raise UserResolvableError(f"{lst} ({type(lst)}) is not a list", "")
         self.state.ds_push(lst[0])
 
-    @evali.register
-    def _(self, i: Rest):
+    @evaluates(Rest)
+    def _(self, ops):
         lst = self.state.ds_pop()
         if not isinstance(lst, mt.TlList):
             raise UserResolvableError(f"{lst} ({type(lst)}) is not a list", "")
-        self.state.ds_push(lst[1:])
+        self.state.ds_push(lst.rest())
 
-    @evali.register
-    def _(self, i: Nth):
+    @evaluates(Nth)
+    def _(self, ops):
         n = self.state.ds_pop()
         lst = self.state.ds_pop()
         if not isinstance(lst, mt.TlList):
             raise UserResolvableError(f"{lst} ({type(lst)}) is not a list", "")
         self.state.ds_push(lst[n])
 
-    @evali.register
-    def _(self, i: Length):
+    @evaluates(Length)
+    def _(self, ops):
         lst = self.state.ds_pop()
         if not isinstance(lst, mt.TlList):
             raise UserResolvableError(f"{lst} ({type(lst)}) is not a list", "")
         self.state.ds_push(mt.TlInt(len(lst)))
 
-    @evali.register
-    def _(self, i: Hash):
-        num_args = i.operands[0]
+    @evaluates(Hash)
+    def _(self, ops):
+        num_args = ops[0]
         # convert list [a, b, c, d] (reversed) -> dict {a: b, c: d}
         elts = [self.state.ds_pop() for _ in range(num_args)][::-1]
         pairs = zip(elts[::2], elts[1::2])
         self.state.ds_push(mt.TlHash(pairs))
 
-    @evali.register
-    def _(self, i: HGet):
+    @evaluates(HGet)
+    def _(self, ops):
         key = self.state.ds_pop()
         obj = self.state.ds_pop()
         if not isinstance(obj, mt.TlHash):
@@ -528,64 +804,64 @@ class TlMachine:
             res = mt.TlNull()
         self.state.ds_push(res)
 
-    @evali.register
-    def _(self, i: HSet):
+    @evaluates(HSet)
+    def _(self, ops):
         value = self.state.ds_pop()
         key = self.state.ds_pop()
         obj = self.state.ds_pop()
         if not isinstance(obj, mt.TlHash):
             raise UserResolvableError(f"{obj} ({type(obj)}) is not a hash", "")
         # Create a new object, overwriting the old key
-        self.state.ds_push(mt.TlHash({**obj, key: value}))
+        self.state.ds_push(obj.set(key, value))
 
-    @evali.register
-    def _(self, i: Plus):
+    @evaluates(Plus)
+    def _(self, ops):
         a = self.state.ds_pop()
         b = self.state.ds_pop()
         cls = new_number_type(a, b)
         self.state.ds_push(cls(a + b))
 
-    @evali.register
-    def _(self, i: Minus):
+    @evaluates(Minus)
+    def _(self, ops):
         a = self.state.ds_pop()
         b = self.state.ds_pop()
         cls = new_number_type(a, b)
         self.state.ds_push(cls(a - b))
 
-    @evali.register
-    def _(self, i: Multiply):
+    @evaluates(Multiply)
+    def _(self, ops):
         a = self.state.ds_pop()
         b = self.state.ds_pop()
         cls = new_number_type(a, b)
         self.state.ds_push(cls(a * b))
 
-    @evali.register
-    def _(self, i: Divide):
+    @evaluates(Divide)
+    def _(self, ops):
         a = self.state.ds_pop()
         b = self.state.ds_pop()
         cls = new_number_type(a, b)
         self.state.ds_push(cls(a / b))
 
-    @evali.register
-    def _(self, i: Modulo):
+    @evaluates(Modulo)
+    def _(self, ops):
         a = self.state.ds_pop()
         b = self.state.ds_pop()
         self.state.ds_push(mt.TlInt(a % b))
 
-    @evali.register
-    def _(self, i: Eq):
+    @evaluates(Eq)
+    def _(self, ops):
         a = self.state.ds_pop()
         b = self.state.ds_pop()
         self.state.ds_push(tl_bool(a == b))
 
-    @evali.register
-    def _(self, i: GreaterThan):
+    @evaluates(GreaterThan)
+    def _(self, ops):
         a = self.state.ds_pop()
         b = self.state.ds_pop()
         self.state.ds_push(tl_bool(a > b))
 
-    @evali.register
-    def _(self, i: LessThan):
+    @evaluates(LessThan)
+    def _(self, ops):
         a = self.state.ds_pop()
         b = self.state.ds_pop()
         self.state.ds_push(tl_bool(a < b))
@@ -597,9 +873,19 @@ class TlMachine:
                 f"Got {a.__tlname__} and {b.__tlname__}",
             )
 
-    @evali.register
-    def _(self, i: OpAnd):
-        # FIXME no short-circuit behaviour
+    @evaluates(CheckBool)
+    def _(self, ops):
+        a = self.state.ds_peek(0)
+        if not isinstance(a, mt.BOOLEANS):
+            raise UserResolvableError(
+                f"Operands to {ops[0]} must both be booleans", f"Got {a.__tlname__}"
+            )
+
+    @evaluates(OpAnd)
+    def _(self, ops):
+        # NOTE: The compiler short-circuits && and || with JumpIf (and
+        # CheckBool), so this is only evaluated if the operator is called as a
+        # function
         a = self.state.ds_pop()
         b = self.state.ds_pop()
         self._check_bools("&&", a, b)
@@ -607,9 +893,11 @@ class TlMachine:
             tl_bool(isinstance(a, mt.TlTrue) and isinstance(b, mt.TlTrue))
         )
 
-    @evali.register
-    def _(self, i: OpOr):
-        # FIXME no short-circuit behaviour
+    @evaluates(OpOr)
+    def _(self, ops):
+        # NOTE: The compiler short-circuits && and || with JumpIf (and
+        # CheckBool), so this is only evaluated if the operator is called as a
+        # function
         a = self.state.ds_pop()
         b = self.state.ds_pop()
         self._check_bools("||", a, b)
@@ -617,13 +905,13 @@ class TlMachine:
             tl_bool(isinstance(a, mt.TlTrue) or isinstance(b, mt.TlTrue))
         )
 
-    @evali.register
-    def _(self, i: BooloeanNeg):
+    @evaluates(BooloeanNeg)
+    def _(self, ops):
         a = self.state.ds_pop()
         self.state.ds_push(tl_bool(not mt.to_py_type(a)))
 
-    @evali.register
-    def _(self, i: UnaryMinus):
+    @evaluates(UnaryMinus)
+    def _(self, ops):
         a = self.state.ds_pop()
         if isinstance(a, float):
             self.state.ds_push(mt.TlFloat(-a))
@@ -632,44 +920,44 @@ class TlMachine:
         else:
             raise UnexpectedError("cannot negate non-numeric types")
 
-    @evali.register
-    def _(self, i: NEq):
+    @evaluates(NEq)
+    def _(self, ops):
         a = self.state.ds_pop()
         b = self.state.ds_pop()
         self.state.ds_push(tl_bool(a != b))
 
-    @evali.register
-    def _(self, i: GreaterThanOrEqual):
+    @evaluates(GreaterThanOrEqual)
+    def _(self, ops):
         a = self.state.ds_pop()
         b = self.state.ds_pop()
         self.state.ds_push(tl_bool(a >= b))
 
-    @evali.register
-    def _(self, i: LessThanOrEqual):
+    @evaluates(LessThanOrEqual)
+    def _(self, ops):
         a = self.state.ds_pop()
         b = self.state.ds_pop()
         self.state.ds_push(tl_bool(a <= b))
 
-    @evali.register
-    def _(self, i: ParseFloat):
+    @evaluates(ParseFloat)
+    def _(self, ops):
         x = self.state.ds_pop()
         self.state.ds_push(mt.TlFloat(float(x)))
 
-    @evali.register
-    def _(self, i: Sleep):
+    @evaluates(Sleep)
+    def _(self, ops):
         t = self.state.ds_peek(0)
         time.sleep(t)
 
-    @evali.register
-    def _(self, i: Print):
+    @evaluates(Print)
+    def _(self, ops):
         # Leave the value in the stack - print() 'returns' the value printed
         val = self.state.ds_peek(0)
         # This should take a vmid - data stored is a tuple (vmid, str)
         # Could also store a timestamp...
         self.dc.write_stdout(StdoutItem(self.vmid, str(val) + "\n"))
 
-    @evali.register
-    def _(self, i: Signal):
+    @evaluates(Signal)
+    def _(self, ops):
         msg = self.state.ds_peek(0)
         val = self.state.ds_peek(1)
         self.dc.write_stdout(StdoutItem(self.vmid, f"\n[signal {val}]: {msg}\n"))
@@ -677,12 +965,12 @@ class TlMachine:
             raise UnhandledError(msg)
         # other kinds of signals don't need special handling
 
-    @evali.register
-    def _(self, i: GetSessionId):
+    @evaluates(GetSessionId)
+    def _(self, ops):
         self.state.ds_push(mt.TlString(self.dc.session_id))
 
-    @evali.register
-    def _(self, i: GetThreadId):
+    @evaluates(GetThreadId)
+    def _(self, ops):
         self.state.ds_push(mt.TlInt(self.vmid))
 
     def __repr__(self):
@@ -1,19 +1,25 @@
 """Machine Probe"""
 
+import logging
+import os
 from dataclasses import dataclass
+from enum import IntEnum
 
+from ..exceptions import UserResolvableError
 from .types import TlType
 from .hark_serialisable import HarkSerialisable, now_str
 
+LOG = logging.getLogger(__name__)
 
-@dataclass(frozen=True)
+
+@dataclass
 class ProbeLog(HarkSerialisable):
     thread: int
     time: int
     text: str
 
 
-@dataclass(frozen=True)
+@dataclass
 class ProbeEvent(HarkSerialisable):
     thread: int
     time: int
@@ -23,18 +29,108 @@ class ProbeEvent(HarkSerialisable):
     # TODO deserialise?
 
 
+class ProbeLevel(IntEnum):
+    """How much a Probe records. Each level includes everything below it."""
+
+    OFF = 0
+    LIFECYCLE = 1  # thread run, stop and fork events, and logs
+    CALLS = 2  # function calls and returns
+    STEPS = 3  # every (sampled) instruction step
+
+    @classmethod
+    def parse(cls, name: str) -> "ProbeLevel":
+        try:
+            return cls[name.upper()]
+        except KeyError:
+            options = " | ".join(l.name.lower() for l in cls)
+            raise UserResolvableError(
+                f"Bad probe level: {name}", f"Supported levels: {options}"
+            )
+
+
+# The level required to record each kind of event. Anything else is LIFECYCLE.
+EVENT_LEVELS = {
+    "step": ProbeLevel.STEPS,
+    "call": ProbeLevel.CALLS,
+    "call_foreign": ProbeLevel.CALLS,
+    "call_builtin": ProbeLevel.CALLS,
+    "return": ProbeLevel.CALLS,
+}
+
+
+def check_sample(sample: int) -> int:
+    """Check a step sampling period, returning it"""
+    if not isinstance(sample, int) or sample < 1:
+        raise UserResolvableError(
+            f"Bad probe sample period: {sample}", "It must be at least 1."
+        )
+    return sample
+
+
+def level_from_env() -> ProbeLevel:
+    """Get the level set by HARK_PROBE_LEVEL (warning and ignoring it if bad)"""
+    name = os.getenv("HARK_PROBE_LEVEL", "calls")
+    try:
+        return ProbeLevel.parse(name)
+    except UserResolvableError:
+        LOG.warning("Ignoring bad HARK_PROBE_LEVEL: %s", name)
+        return ProbeLevel.CALLS
+
+
+def sample_from_env() -> int:
+    """Get the period set by HARK_PROBE_SAMPLE (warning and ignoring it if bad)"""
+    value = os.getenv("HARK_PROBE_SAMPLE", "1")
+    try:
+        return check_sample(int(value))
+    except (ValueError, UserResolvableError):
+        LOG.warning("Ignoring bad HARK_PROBE_SAMPLE: %s", value)
+        return 1
+
+
+# Defaults for new probes. Set per deployment with environment variables, or
+# per run with configure().
+DEFAULT_LEVEL = level_from_env()
+DEFAULT_SAMPLE = sample_from_env()
+
+
+def configure(level: ProbeLevel = None, sample: int = None):
+    """Set the level and step sampling period of new probes"""
+    global DEFAULT_LEVEL
+    global DEFAULT_SAMPLE
+    if level is not None:
+        DEFAULT_LEVEL = level
+    if sample is not None:
+        DEFAULT_SAMPLE = check_sample(sample)
+
+
 class Probe:
-    """A small interface for storing machine logs and events"""
+    """A small interface for storing machine logs and events
+
+    level: What to record (see ProbeLevel)
+    sample: Only record every Nth step event
+
+    Recording is cheap to skip but not free to prepare, so callers in hot paths
+    should check the `calls` and `steps` flags before building event data.
+    """
 
-    def __init__(self, vmid):
+    def __init__(self, vmid, level: ProbeLevel = None, sample: int = None):
         self.vmid = vmid
+        self.level = DEFAULT_LEVEL if level is None else level
+        self.sample = DEFAULT_SAMPLE if sample is None else check_sample(sample)
+        self.lifecycle = self.level >= ProbeLevel.LIFECYCLE
+        self.calls = self.level >= ProbeLevel.CALLS
+        self.steps = self.level >= ProbeLevel.STEPS
         self.logs = []
         self.events = []
 
     def event(self, etype: str, **data):
+        if self.level < EVENT_LEVELS.get(etype, ProbeLevel.LIFECYCLE):
+            return
         e = ProbeEvent(thread=self.vmid, time=now_str(), event=etype, data=data)
         self.events.append(e)
 
     def log(self, text):
+        if not self.lifecycle:
+            return
         l = ProbeLog(thread=self.vmid, time=now_str(), text=text)
         self.logs.append(l)
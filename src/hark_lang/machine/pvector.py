@@ -0,0 +1,183 @@
+"""Persistent (immutable, structurally shared) vector
+
+A 32-way trie with a "tail" leaf, like Clojure's PersistentVector. Nodes are
+tuples, and every operation returns a new vector that shares all unchanged
+nodes with the original.
+
+- push (append), pop (drop the last item), nth: O(log32 n), effectively O(1)
+- assoc (replace an item): O(log32 n)
+- rest (drop the first item): O(1) -- only the start offset changes
+
+NOTE: rest() keeps the dropped items alive until the vector is garbage
+collected, like a slice view would.
+"""
+
+from typing import Iterable
+
+BITS = 5
+WIDTH = 1 << BITS
+MASK = WIDTH - 1
+
+
+def _new_path(level: int, node: tuple) -> tuple:
+    """Wrap NODE in single-child nodes up to LEVEL"""
+    while level > 0:
+        node = (node,)
+        level -= BITS
+    return node
+
+
+class PVector:
+    """An immutable sequence. Don't construct directly - use from_iterable"""
+
+    __slots__ = ("_start", "_count", "_shift", "_root", "_tail")
+
+    def __init__(self, start=0, count=0, shift=BITS, root=(), tail=()):
+        self._start = start  # ..... Index of the first (visible) item
+        self._count = count  # ..... Total number of items, including hidden
+        self._shift = shift  # ..... Depth of the trie, in bits
+        self._root = root  # ....... Trie of full leaves
+        self._tail = tail  # ....... The last (partial) leaf
+
+    @classmethod
+    def from_iterable(cls, items: Iterable) -> "PVector":
+        """Build a vector from ITEMS, in one go"""
+        items = tuple(items)
+        count = len(items)
+        if not count:
+            return EMPTY
+        tailoff = _tailoff(count)
+        nodes = [items[i : i + WIDTH] for i in range(0, tailoff, WIDTH)]
+        shift = BITS
+        while len(nodes) > WIDTH:
+            nodes = [tuple(nodes[i : i + WIDTH]) for i in range(0, len(nodes), WIDTH)]
+            shift += BITS
+        return cls(0, count, shift, tuple(nodes), items[tailoff:])
+
+    def __len__(self):
+        return self._count - self._start
+
+    def nth(self, idx: int):
+        """Get the item at IDX (which must be in range)"""
+        return self._leaf_for(self._start + idx)[(self._start + idx) & MASK]
+
+    def __iter__(self):
+        idx = self._start
+        tailoff = _tailoff(self._count)
+        while idx < tailoff:
+            leaf = self._leaf_for(idx)
+            for i in range(idx & MASK, WIDTH):
+                yield leaf[i]
+            idx = (idx | MASK) + 1
+        for i in range(idx - tailoff, len(self._tail)):
+            yield self._tail[i]
+
+    def __reversed__(self):
+        for idx in range(len(self) - 1, -1, -1):
+            yield self.nth(idx)
+
+    def push(self, item) -> "PVector":
+        """Get a new vector with ITEM added to the end"""
+        count = self._count
+        if count - _tailoff(count) < WIDTH:
+            return PVector(
+                self._start, count + 1, self._shift, self._root, self._tail + (item,)
+            )
+
+        # The tail is full -- move it into the trie
+        shift = self._shift
+        if (count >> BITS) > (1 << shift):
+            # The root is full too -- add a level
+            root = (self._root, _new_path(shift, self._tail))
+            shift += BITS
+        else:
+            root = self._push_tail(shift, self._root, self._tail)
+        return PVector(self._start, count + 1, shift, root, (item,))
+
+    def assoc(self, idx: int, item) -> "PVector":
+        """Get a new vector with the item at IDX (which must be in range) replaced"""
+        idx += self._start
+        if idx >= _tailoff(self._count):
+            i = idx & MASK
+            tail = self._tail[:i] + (item,) + self._tail[i + 1 :]
+            return PVector(self._start, self._count, self._shift, self._root, tail)
+        root = self._assoc(self._shift, self._root, idx, item)
+        return PVector(self._start, self._count, self._shift, root, self._tail)
+
+    def pop(self) -> "PVector":
+        """Get a new vector without the last item"""
+        count = self._count
+        if len(self) <= 1:
+            return EMPTY
+        if count - _tailoff(count) > 1:
+            return PVector(
+                self._start, count - 1, self._shift, self._root, self._tail[:-1]
+            )
+
+        # The tail would be empty -- the last leaf in the trie becomes the tail
+        tail = self._leaf_for(count - 2)
+        root = self._pop_tail(self._shift, self._root)
+        shift = self._shift
+        if root is None:
+            root = ()
+        if shift > BITS and len(root) == 1:
+            root = root[0]
+            shift -= BITS
+        return PVector(self._start, count - 1, shift, root, tail)
+
+    def rest(self) -> "PVector":
+        """Get a new vector without the first item"""
+        if len(self) <= 1:
+            return EMPTY
+        return PVector(
+            self._start + 1, self._count, self._shift, self._root, self._tail
+        )
+
+    def _leaf_for(self, idx: int) -> tuple:
+        """Get the leaf containing (absolute index) IDX"""
+        if idx >= _tailoff(self._count):
+            return self._tail
+        node = self._root
+        level = self._shift
+        while level > 0:
+            node = node[(idx >> level) & MASK]
+            level -= BITS
+        return node
+
+    def _push_tail(self, level: int, parent: tuple, tail: tuple) -> tuple:
+        subidx = ((self._count - 1) >> level) & MASK
+        if level == BITS:
+            child = tail
+        elif subidx < len(parent):
+            child = self._push_tail(level - BITS, parent[subidx], tail)
+        else:
+            child = _new_path(level - BITS, tail)
+        return parent[:subidx] + (child,)
+
+    def _assoc(self, level: int, node: tuple, idx: int, item) -> tuple:
+        subidx = (idx >> level) & MASK
+        if level > 0:
+            item = self._assoc(level - BITS, node[subidx], idx, item)
+        return node[:subidx] + (item,) + node[subidx + 1 :]
+
+    def _pop_tail(self, level: int, node: tuple):
+        subidx = ((self._count - 2) >> level) & MASK
+        if level > BITS:
+            child = self._pop_tail(level - BITS, node[subidx])
+            if child is None:
+                return node[:subidx] if subidx else None
+            return node[:subidx] + (child,)
+        return node[:subidx] if subidx else None
+
+    def __repr__(self):
+        return f"PVector({list(self)})"
+
+
+def _tailoff(count: int) -> int:
+    """Index of the first item in the tail"""
+    if count < WIDTH:
+        return 0
+    return ((count - 1) >> BITS) << BITS
+
+
+EMPTY = PVector()
@@ -1,6 +1,66 @@
 """Machine state representation"""
 
-from .types import TlType
+from dataclasses import dataclass
+from typing import List, Optional
+
+from . import codec
+from .types import TlFunctionPtr, TlType
+
+
+def serialise_locals(values: list) -> list:
+    """Serialise local variable slots (None for unassigned slots)"""
+    return [None if v is None else v.serialise() for v in values]
+
+
+def deserialise_locals(data: list) -> list:
+    return [None if v is None else TlType.deserialise(v) for v in data]
+
+
+@dataclass(frozen=True)
+class Frame:
+    """A synchronous call frame, kept in the thread's State
+
+    Frames only become ActivationRecords in the controller if something in
+    another thread needs to refer to them (see TlMachine ACall). They're
+    immutable (replace them to change them), so State.delta can compare them
+    by identity.
+    """
+
+    function: TlFunctionPtr  # ..... The called function
+    call_site: int  # .............. IP of the Call in the caller
+    caller_locals: List[Optional[TlType]]  # restored on Return
+    arec_ptr: Optional[int] = None  # ActivationRecord, if materialised
+
+    def serialise(self):
+        return dict(
+            function=self.function.serialise(),
+            call_site=self.call_site,
+            caller_locals=serialise_locals(self.caller_locals),
+            arec_ptr=self.arec_ptr,
+        )
+
+    @classmethod
+    def deserialise(cls, data: dict):
+        return cls(
+            function=TlType.deserialise(data["function"]),
+            call_site=data["call_site"],
+            caller_locals=deserialise_locals(data["caller_locals"]),
+            arec_ptr=data["arec_ptr"],
+        )
+
+
+def _frame_data(frame: Frame) -> list:
+    return [frame.function, frame.call_site, frame.caller_locals, frame.arec_ptr]
+
+
+def _common_prefix(a: list, b: list) -> int:
+    """Number of leading items that are identical (not just equal) in A and B"""
+    n = min(len(a), len(b))
+    for i in range(n):
+        if a[i] is not b[i]:
+            return i
+    return n
+
 
 # TODO convert this class to HarkSerialisable, there's duplicated logic. Sorry -
 # it came earlier in the design, and is slightly non-trivial to change.
@@ -13,9 +73,10 @@ class State:
         self.ip = 0
         self._ds = list(data)
         self.stopped = False
-        self.bindings = {}
+        self.locals = []  # local variable slots of the current frame
+        self.frames = []  # synchronous call stack (above current_arec_ptr)
         self.error_msg = None
-        self.current_arec_ptr = None
+        self.current_arec_ptr = None  # the thread's entry activation record
 
     def ds_push(self, val):
         if not isinstance(val, TlType):
@@ -40,13 +101,21 @@ class State:
 
     def to_table(self):
         return (
-            "Bind: "
-            + ", ".join(f"{k}->{v}" for k, v in self.bindings.items())
+            "Locals: "
+            + ", ".join(f"{k}->{v}" for k, v in enumerate(self.locals))
             + f"\nData: {self._ds}"
         )
 
     def __eq__(self, other):
-        return self.serialise() == other.serialise()
+        return (
+            self.ip == other.ip
+            and self.stopped == other.stopped
+            and self._ds == other._ds
+            and self.locals == other.locals
+            and self.frames == other.frames
+            and self.error_msg == other.error_msg
+            and self.current_arec_ptr == other.current_arec_ptr
+        )
 
     def __str__(self):
         return f"<State {id(self)} ip={self.ip}>"
@@ -56,7 +125,8 @@ class State:
             ip=self.ip,
             stopped=self.stopped,
             ds=[value.serialise() for value in self._ds],
-            bindings={name: value.serialise() for name, value in self.bindings.items()},
+            locals=serialise_locals(self.locals),
+            frames=[frame.serialise() for frame in self.frames],
             error_msg=self.error_msg,
             current_arec_ptr=self.current_arec_ptr,
         )
@@ -67,9 +137,97 @@ class State:
         s.ip = data["ip"]
         s.stopped = data["stopped"]
         s._ds = [TlType.deserialise(obj) for obj in data["ds"]]
-        s.bindings = {
-            name: TlType.deserialise(val) for name, val in data["bindings"].items()
-        }
+        s.locals = deserialise_locals(data["locals"])
+        s.frames = [Frame.deserialise(obj) for obj in data["frames"]]
         s.error_msg = data["error_msg"]
         s.current_arec_ptr = data["current_arec_ptr"]
         return s
+
+    def encode(self) -> bytes:
+        """Encode in the compact binary format (see codec.py)"""
+        return codec.encode(
+            [
+                self.ip,
+                self.stopped,
+                self._ds,
+                self.locals,
+                [_frame_data(f) for f in self.frames],
+                self.error_msg,
+                self.current_arec_ptr,
+            ]
+        )
+
+    @classmethod
+    def decode(cls, data: bytes):
+        s = cls([])
+        (
+            s.ip,
+            s.stopped,
+            s._ds,
+            s.locals,
+            frames,
+            s.error_msg,
+            s.current_arec_ptr,
+        ) = codec.decode(data)
+        s.frames = [Frame(*f) for f in frames]
+        return s
+
+    def copy(self) -> "State":
+        """Get a shallow copy (values are immutable, so that's enough)"""
+        s = State(self._ds)
+        s.ip = self.ip
+        s.stopped = self.stopped
+        s.locals = list(self.locals)
+        s.frames = list(self.frames)
+        s.error_msg = self.error_msg
+        s.current_arec_ptr = self.current_arec_ptr
+        return s
+
+    def delta(self, base: "State") -> list:
+        """Get the changes since BASE, an earlier copy of this State
+
+        Values are compared by identity, which is cheap and enough, because
+        values on the stack and frames are replaced, never modified.
+        """
+        ds_keep = _common_prefix(base._ds, self._ds)
+        frames_keep = _common_prefix(base.frames, self.frames)
+        old_locals = base.locals
+        locals_changes = [
+            [idx, value]
+            for idx, value in enumerate(self.locals)
+            if idx >= len(old_locals) or value is not old_locals[idx]
+        ]
+        return [
+            self.ip,
+            self.stopped,
+            self.error_msg,
+            self.current_arec_ptr,
+            ds_keep,
+            self._ds[ds_keep:],
+            len(self.locals),
+            locals_changes,
+            frames_keep,
+            [_frame_data(f) for f in self.frames[frames_keep:]],
+        ]
+
+    def apply_delta(self, delta: list):
+        """Apply changes from delta() to this State (in place)"""
+        (
+            self.ip,
+            self.stopped,
+            self.error_msg,
+            self.current_arec_ptr,
+            ds_keep,
+            ds_tail,
+            num_locals,
+            locals_changes,
+            frames_keep,
+            frames_tail,
+        ) = delta
+        self._ds = self._ds[:ds_keep] + list(ds_tail)
+        new_locals = self.locals[:num_locals]
+        new_locals += [None] * (num_locals - len(new_locals))
+        for idx, value in locals_changes:
+            new_locals[idx] = value
+        self.locals = new_locals
+        self.frames = self.frames[:frames_keep] + [Frame(*f) for f in frames_tail]
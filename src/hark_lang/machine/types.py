@@ -6,7 +6,10 @@ See https://docs.python.org/3/library/json.html#py-to-json-table
 """
 
 from typing import Optional
-from collections import UserList, UserDict
+from collections.abc import Mapping, Sequence
+
+from . import hamt
+from .pvector import EMPTY, PVector
 
 # TODO Convert these to dataclasses
 
@@ -25,7 +28,20 @@ class TlType:
         return [type(self).__name__, self.serialise_data()]
 
     def __eq__(self, other):
-        return self.serialise() == other.serialise()
+        # Structural equality, without serialising. Literal types (TlInt etc)
+        # use their Python base type's __eq__ and __hash__ instead.
+        if self is other:
+            return True
+        if not isinstance(other, TlType):
+            return NotImplemented
+        return type(self) is type(other) and self._data_eq(other)
+
+    def __hash__(self):
+        return hash(type(self).__name__)
+
+    def _data_eq(self, other) -> bool:
+        """Compare the data of SELF and OTHER, which have the same type"""
+        return True
 
     @classmethod
     def deserialise(cls, obj: list):
@@ -87,7 +103,29 @@ class TlLiteral(TlType):
         return f"<{kind} {self.value}>"
 
 
-class TlSymbol(str, TlLiteral):
+class _TlStr(str, TlLiteral):
+    """Base of the literal types with an underlying str
+
+    These are never equal to each other (a string is not a symbol), only to
+    values of the same type or plain Python strings. Numbers (TlInt and
+    TlFloat) still compare numerically.
+    """
+
+    def __eq__(self, other):
+        if isinstance(other, TlType) and type(other) is not type(self):
+            return False
+        return str.__eq__(self, other)
+
+    def __ne__(self, other):
+        if isinstance(other, TlType) and type(other) is not type(self):
+            return True
+        return str.__ne__(self, other)
+
+    # Equal to the plain str's hash, as they compare equal
+    __hash__ = str.__hash__
+
+
+class TlSymbol(_TlStr):
     pass
 
 
@@ -99,11 +137,11 @@ class TlInt(int, TlLiteral):
     pass
 
 
-class TlString(str, TlLiteral):
+class TlString(_TlStr):
     pass
 
 
-class TlInstruction(str, TlLiteral):
+class TlInstruction(_TlStr):
     """A Hark machine instruction"""
 
 
@@ -116,6 +154,12 @@ class TlFuturePtr(TlLiteral):
         super().__init__(future_id)
         self.vmid = future_id
 
+    def _data_eq(self, other):
+        return self.value == other.value
+
+    def __hash__(self):
+        return hash((TlFuturePtr, self.value))
+
 
 ### Complex types
 
@@ -126,6 +170,12 @@ class TlQuote(TlType):
     def __init__(self, data):
         self.data = data
 
+    def _data_eq(self, other):
+        return self.data == other.data
+
+    def __hash__(self):
+        return hash((TlQuote, self.data))
+
     def serialise_data(self):
         # self.data is another TlType that needs to be serialised
         return self.data.serialise()
@@ -135,22 +185,145 @@ class TlQuote(TlType):
         return cls(TlType.deserialise(data))
 
 
-class TlList(UserList, TlType):
+class TlList(Sequence, TlType):
+    """An immutable list
+
+    Backed by persistent vectors, so the list operations (appended, prepended,
+    rest...) share structure with the original list instead of copying it.
+    """
+
+    def __init__(self, items=()):
+        self._front = EMPTY  # prepended items, in reverse order
+        self._back = PVector.from_iterable(items)
+
+    @classmethod
+    def _make(cls, front: PVector, back: PVector) -> "TlList":
+        lst = cls.__new__(cls)
+        lst._front = front
+        lst._back = back
+        return lst
+
+    def __len__(self):
+        return len(self._front) + len(self._back)
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return TlList([self[i] for i in range(*idx.indices(len(self)))])
+        if idx < 0:
+            idx += len(self)
+        if not 0 <= idx < len(self):
+            raise IndexError("list index out of range")
+        num_front = len(self._front)
+        if idx < num_front:
+            return self._front.nth(num_front - 1 - idx)
+        return self._back.nth(idx - num_front)
+
+    def __iter__(self):
+        yield from reversed(self._front)
+        yield from self._back
+
+    def __eq__(self, other):
+        if self is other:
+            return True
+        if not isinstance(other, (TlList, list)):
+            return NotImplemented
+        return len(self) == len(other) and all(a == b for a, b in zip(self, other))
+
+    def __hash__(self):
+        return hash((TlList, tuple(self)))
+
+    def __repr__(self):
+        return repr(list(self))
+
+    def appended(self, item) -> "TlList":
+        """Get a new list with ITEM at the end"""
+        return TlList._make(self._front, self._back.push(item))
+
+    def prepended(self, item) -> "TlList":
+        """Get a new list with ITEM at the start"""
+        return TlList._make(self._front.push(item), self._back)
+
+    def rest(self) -> "TlList":
+        """Get a new list without the first item"""
+        if self._front:
+            return TlList._make(self._front.pop(), self._back)
+        return TlList._make(EMPTY, self._back.rest())
+
+    def concat(self, other: "TlList") -> "TlList":
+        """Get a new list with the items of OTHER at the end
+
+        This is O(len(other)) -- only OTHER's items are added to the vector.
+        """
+        if not self:
+            return other
+        back = self._back
+        for item in other:
+            back = back.push(item)
+        return TlList._make(self._front, back)
+
     def serialise_data(self):
-        return [a.serialise() for a in self.data]
+        return [a.serialise() for a in self]
 
     @classmethod
     def from_data(cls, data):
         return cls([TlType.deserialise(a) for a in data])
 
 
-class TlHash(UserDict, TlType):
+class TlHash(Mapping, TlType):
+    """An immutable hash (map)
+
+    Backed by a persistent hash array mapped trie, so set() shares structure
+    with the original hash instead of copying it.
+    """
+
+    def __init__(self, items=()):
+        if isinstance(items, Mapping):
+            items = items.items()
+        self._map = hamt.PMap.from_items(items)
+
+    def __getitem__(self, key):
+        return self._map[key]
+
+    def __contains__(self, key):
+        return key in self._map
+
+    def __iter__(self):
+        return iter(self._map)
+
+    def __len__(self):
+        return len(self._map)
+
+    def items(self):
+        return self._map.items()
+
+    def __repr__(self):
+        return repr(dict(self._map.items()))
+
+    def __eq__(self, other):
+        if self is other:
+            return True
+        if not isinstance(other, (TlHash, dict)):
+            return NotImplemented
+        if len(self) != len(other):
+            return False
+        missing = object()
+        return all(other.get(k, missing) == v for k, v in self.items())
+
+    def __hash__(self):
+        return hash((TlHash, frozenset(self.items())))
+
+    def set(self, key, value) -> "TlHash":
+        """Get a new hash with KEY set to VALUE"""
+        result = TlHash.__new__(TlHash)
+        result._map = self._map.set(key, value)
+        return result
+
     def serialise_data(self):
-        return [[k.serialise(), v.serialise()] for k, v in self.data.items()]
+        return [[k.serialise(), v.serialise()] for k, v in self.items()]
 
     @classmethod
     def from_data(cls, data):
-        return cls({TlType.deserialise(k): TlType.deserialise(v) for k, v in data})
+        return cls((TlType.deserialise(k), TlType.deserialise(v)) for k, v in data)
 
 
 class TlFunctionPtr(TlType):
@@ -165,6 +338,12 @@ class TlFunctionPtr(TlType):
         self.identifier = identifier
         self.stack_ptr = stack_ptr
 
+    def _data_eq(self, other):
+        return self.identifier == other.identifier and self.stack_ptr == other.stack_ptr
+
+    def __hash__(self):
+        return hash((TlFunctionPtr, self.identifier))
+
     def serialise_data(self):
         return [self.identifier, self.stack_ptr]
 
@@ -190,6 +369,16 @@ class TlForeignPtr(TlType):
         self.module = module
         self.qualified_name = qualified_name
 
+    def _data_eq(self, other):
+        return (
+            self.identifier == other.identifier
+            and self.module == other.module
+            and self.qualified_name == other.qualified_name
+        )
+
+    def __hash__(self):
+        return hash((TlForeignPtr, self.identifier, self.module))
+
     def serialise_data(self):
         return [self.identifier, self.module, self.qualified_name]
 
@@ -26,6 +26,16 @@ root_logger = logging.getLogger("hark_lang")
 root_logger.setLevel(level=logging.INFO)
 
 
+# Seconds before the Lambda timeout to save the thread state and continue in
+# a fresh Lambda
+CHECKPOINT_MARGIN = float(os.getenv("HARK_CHECKPOINT_MARGIN", 10))
+
+# The most of the remaining time the margin can take. Otherwise, with short
+# Lambda timeouts, every Lambda would checkpoint straight away, and a thread
+# would use any number of them.
+MAX_MARGIN_FRACTION = 0.5
+
+
 # TODO structure return values and document. See cloud/api.py
 
 
@@ -44,14 +54,31 @@ def resume(event, context):
     # a result to. So all exceptions must appear in the AWS console.
     #
     # However, any waiting machines need to find out about this.
-    _run_machine(controller, vmid)
-
-
-def _run_machine(controller, vmid):
+    _run_machine(controller, vmid, context)
+
+
+def _deadline(context, clock=time.monotonic):
+    """Get the time (on CLOCK) by which a machine should checkpoint"""
+    if context is None:
+        return None
+    remaining = context.get_remaining_time_in_millis() / 1000.0
+    margin = CHECKPOINT_MARGIN
+    if margin > remaining * MAX_MARGIN_FRACTION:
+        margin = remaining * MAX_MARGIN_FRACTION
+        LOG.warning(
+            "Checkpoint margin (%ss) is too long for the time left (%ss), using %ss",
+            CHECKPOINT_MARGIN,
+            remaining,
+            margin,
+        )
+    return clock() + remaining - margin
+
+
+def _run_machine(controller, vmid, context=None):
     try:
         invoker = Invoker(controller)
         machine = TlMachine(vmid, invoker)
-        machine.run()
+        machine.run(deadline=_deadline(context))
 
     # One of those rare times when we really do want to catch and record any
     # possible exception.
@@ -71,7 +98,8 @@ def event_handler(event, context):
     for h in lambda_handlers.ALL_HANDLERS:
         if h.can_handle(event):
             LOG.info("Handling with %s", str(h))
-            return h.handle(event, _new_session, UserResolvableError)
+            new_session = functools.partial(_new_session, context=context)
+            return h.handle(event, new_session, UserResolvableError)
 
     raise ValueError(f"Can't handle event {event}")
 
@@ -129,7 +157,13 @@ def getevents(event, context) -> dict:
 
 
 def _new_session(
-    function, args, check_period, wait_for_finish, timeout, code_override=None
+    function,
+    args,
+    check_period,
+    wait_for_finish,
+    timeout,
+    code_override=None,
+    context=None,
 ):
     """Create a new hark session"""
     LOG.info("Creating new session and running function: %s", function)
@@ -161,7 +195,7 @@ def _new_session(
         msg = "".join(traceback.format_exception(*sys.exc_info()))
         raise UserResolvableError("Error initialising Hark", msg) from exc
 
-    _run_machine(controller, vmid)
+    _run_machine(controller, vmid, context)
 
     # TODO reduce duplication - this is all similar to common.py
     if wait_for_finish:
@@ -10,15 +10,21 @@ from .common import run_and_wait, wait_for_finish
 import pynamodb
 
 
-def run_ddb_local(filename, function, args, timeout=10):
-    """Run with dynamodb and python threading"""
+def run_ddb_local(filename, function, args, timeout=10, workers=None):
+    """Run with dynamodb and python threading (at most WORKERS at once)"""
     controller = ddb_controller.DataController.with_new_session()
-    invoker = hark_thread.Invoker(controller)
+    if workers:
+        invoker = hark_thread.PoolInvoker(controller, workers)
+    else:
+        invoker = hark_thread.Invoker(controller)
     waiter = partial(wait_for_finish, 1, timeout)
     try:
         return run_and_wait(controller, invoker, waiter, filename, function, args)
     except pynamodb.exceptions.PynamoDBException as exc:
         raise ControllerError("Database error: {exc}") from exc
+    finally:
+        if workers:
+            invoker.close()
 
 
 def run_ddb_processes(filename, function, args, timeout=10):
@@ -3,15 +3,56 @@ import os
 from functools import partial
 
 from ..controllers import local as local
+from ..controllers import shared
+from ..executors import aio, scheduler
+from ..executors import multiprocess as mp
 from ..executors import thread as hark_thread
 from ..machine.types import to_py_type
 from .common import LOG, run_and_wait, wait_for_finish
 
 
-def run_local(filename, function, args, timeout_s=10):
+def run_local(filename, function, args, timeout_s=10, workers=None):
+    """Run with Python threads (at most WORKERS at once, if given)"""
     LOG.debug(f"PYTHONPATH: {os.getenv('PYTHONPATH')}")
     controller = local.DataController()
-    invoker = hark_thread.Invoker(controller)
+    if workers:
+        invoker = hark_thread.PoolInvoker(controller, workers)
+    else:
+        invoker = hark_thread.Invoker(controller)
+    check_period = 0.1
+    waiter = partial(wait_for_finish, check_period, timeout_s)
+    try:
+        return run_and_wait(controller, invoker, waiter, filename, function, args)
+    finally:
+        if workers:
+            invoker.close()
+
+
+def run_local_green(filename, function, args, timeout_s=10):
+    """Run with all Hark threads scheduled on this Python thread"""
+    controller = local.DataController()
+    invoker = scheduler.Invoker(controller)
     check_period = 0.1
     waiter = partial(wait_for_finish, check_period, timeout_s)
     return run_and_wait(controller, invoker, waiter, filename, function, args)
+
+
+def run_local_async(filename, function, args, timeout_s=10):
+    """Run with Hark threads and foreign calls on an asyncio event loop"""
+    controller = local.DataController()
+    check_period = 0.1
+    waiter = partial(wait_for_finish, check_period, timeout_s)
+    with aio.Invoker(controller) as invoker:
+        return run_and_wait(controller, invoker, waiter, filename, function, args)
+
+
+def run_local_processes(filename, function, args, timeout_s=10):
+    """Run with Python processes, sharing in-memory storage"""
+    controller = shared.DataController.with_new_server()
+    invoker = mp.Invoker(controller)
+    check_period = 0.1
+    waiter = partial(wait_for_finish, check_period, timeout_s)
+    try:
+        return run_and_wait(controller, invoker, waiter, filename, function, args)
+    finally:
+        controller.shutdown()
@@ -1,3 +1,4 @@
+import asyncio
 import time
 import random
 
@@ -10,6 +11,11 @@ def format(x, *args):
     return x.format(*args)
 
 
+async def async_format(x, *args):
+    await asyncio.sleep(0.01)
+    return x.format(*args)
+
+
 def random_sleep(min_ms=10, max_ms=1000):
     """Sleep for some random time between MIN_MS and MAX_MS"""
     duration_ms = min_ms + random.random() * (max_ms - min_ms)
@@ -27,6 +27,14 @@ def test_asm():
     assert "BINDINGS" in stdout
 
 
+def test_asm_optimised():
+    """Test optimised bytecode listing"""
+    path = EXAMPLES_SUBDIR / "hello_world.hk"
+    stdout, stderr, code = hark_cli("asm", "-O", path)
+    assert not code
+    assert "CALLBUILTIN" in stdout
+
+
 def test_run():
     """Test just running a file"""
     path = EXAMPLES_SUBDIR / "hello_world.hk"
@@ -0,0 +1,94 @@
+"""Test the compact binary codec"""
+import json
+
+import pytest
+
+import hark_lang.controllers.ddb_model as db
+import hark_lang.machine.codec as codec
+from hark_lang.machine.state import Frame, State
+from hark_lang.machine.types import *
+
+
+VALUES = [
+    None,
+    True,
+    False,
+    0,
+    -1,
+    2 ** 70,
+    -(2 ** 40),
+    1.5,
+    "",
+    "hello ☃",
+    [1, "two", [3.0, None]],
+    {"a": 1, "b": [True, {"c": None}]},
+    TlNull(),
+    TlTrue(),
+    TlFalse(),
+    TlInt(-300),
+    TlFloat(0.25),
+    TlString("hi"),
+    TlSymbol("foo"),
+    TlInstruction("Call"),
+    TlFuturePtr(3),
+    TlQuote(TlSymbol("x")),
+    TlList([TlInt(1), TlList([TlString("nested")])]),
+    TlHash([(TlString("k"), TlInt(1)), (TlSymbol("s"), TlNull())]),
+    TlFunctionPtr("main", None),
+    TlFunctionPtr("f", TlInt(2)),
+    TlForeignPtr("f", "mod.path", "the.f"),
+]
+
+
+@pytest.mark.parametrize("value", VALUES, ids=repr)
+def test_round_trip(value):
+    result = codec.decode(codec.encode(value))
+    assert result == value
+    assert type(result) == type(value)
+
+
+def test_compression():
+    big = TlList([TlString("aaaa")] * 1000)
+    data = codec.encode(big)
+    assert data[0] == codec.FORMAT_VERSION | codec.COMPRESSED
+    assert len(data) < 1000
+    assert codec.decode(data) == big
+
+
+def test_smaller_than_json():
+    value = TlList([TlHash([(TlString("x"), TlInt(i))]) for i in range(20)])
+    assert len(codec.encode(value)) < len(json.dumps(value.serialise()))
+
+
+def test_bad_data():
+    with pytest.raises(codec.BadEncoding):
+        codec.decode(b"")
+    with pytest.raises(codec.BadEncoding):
+        codec.decode(bytes([codec.FORMAT_VERSION + 1]) + codec.encode(1)[1:])
+    with pytest.raises(codec.BadEncoding):
+        codec.decode(codec.encode(1) + b"\x00")
+    with pytest.raises(TypeError):
+        codec.encode(object())
+
+
+def test_state():
+    state = State([TlInt(1), TlString("x")])
+    state.ip = 12
+    state.locals = [TlInt(5), None]
+    state.frames = [Frame(TlFunctionPtr("f", None), 3, [TlNull()], 7)]
+    state.current_arec_ptr = 2
+    assert State.decode(state.encode()) == state
+
+
+def test_legacy_attributes():
+    """Data saved in the old JSON format can still be read"""
+    state = State([TlInt(1)])
+    state.locals = [TlString("a")]
+    attr = db.StateAttribute()
+    assert attr.deserialize(json.dumps(state.serialise())) == state
+    assert attr.deserialize(attr.serialize(state)) == state
+
+    value = TlList([TlInt(1)])
+    attr = db.TlValueAttribute()
+    assert attr.deserialize(json.dumps(value.serialise())) == value
+    assert attr.deserialize(attr.serialize(value)) == value
@@ -0,0 +1,183 @@
+import pytest
+
+import hark_lang.machine.instructionset as mi
+import hark_lang.machine.types as mt
+from hark_lang.controllers.local import DataController as LocalController
+from hark_lang.executors.thread import Invoker
+from hark_lang.load import compile_text
+from hark_lang.run.local import run_local
+
+from .test_peephole import function_code
+
+
+SOURCE = """
+fn side_effect() {
+  print("evaluated");
+  true
+}
+
+fn arith() {
+  1 + 2 * 3 - 8 / 3
+}
+
+fn floats() {
+  7.0 / 2
+}
+
+fn modulo() {
+  7.5 % 2
+}
+
+fn compare() {
+  2 * 3 >= 6
+}
+
+fn div_zero() {
+  1 / 0
+}
+
+fn dead_branch() {
+  if 1 < 2 {
+    "yes"
+  }
+  else {
+    side_effect()
+  }
+}
+
+fn and_false() {
+  false && side_effect()
+}
+
+fn or_true() {
+  true || side_effect()
+}
+
+fn and_dynamic(x) {
+  parse_float(x) > 1 && side_effect()
+}
+
+fn locals(x, y) {
+  z = parse_float(x) + parse_float(y);
+  x = side_effect();
+  [x, y, z]
+}
+
+fn unassigned() {
+  if false {
+    a = 1
+  };
+  b
+}
+
+fn and_checked(x) {
+  parse_float(x) > 1 && 2
+}
+
+fn or_checked(x) {
+  x || true
+}
+
+fn shadowed() {
+  y = side_effect();
+  side_effect = 2;
+  [y, side_effect]
+}
+"""
+
+
+def single_value(exe, name):
+    code = function_code(exe, name)
+    assert [type(i) for i in code] == [mi.PushV, mi.Return]
+    return code[0].operands[0]
+
+
+@pytest.mark.parametrize(
+    "name,value",
+    [
+        ("arith", mt.TlInt(5)),
+        ("floats", mt.TlFloat(3.5)),
+        ("modulo", mt.TlInt(1)),
+        ("compare", mt.TlTrue()),
+        ("dead_branch", mt.TlString("yes")),
+        ("and_false", mt.TlFalse()),
+        ("or_true", mt.TlTrue()),
+    ],
+)
+def test_folded(name, value):
+    exe = compile_text(SOURCE)
+    result = single_value(exe, name)
+    assert type(result) == type(value)
+    assert result == value
+
+
+def test_div_zero_not_folded():
+    exe = compile_text(SOURCE)
+    assert any(isinstance(i, mi.Divide) for i in function_code(exe, "div_zero"))
+
+
+def test_short_circuit(tmp_path, capsys):
+    exe = compile_text(SOURCE)
+    code = function_code(exe, "and_dynamic")
+    assert any(isinstance(i, mi.JumpIf) for i in code)
+    assert not any(isinstance(i, mi.OpAnd) for i in code)
+
+    path = tmp_path / "short.hk"
+    path.write_text(SOURCE)
+    assert run_local(path, "and_dynamic", ["0"]) is False
+    assert "evaluated" not in capsys.readouterr().out
+    assert run_local(path, "and_dynamic", ["2"]) is True
+    assert "evaluated" in capsys.readouterr().out
+
+
+def _run(exe, name, args):
+    controller = LocalController()
+    controller.set_executable(exe)
+    args = [mt.TlString(a) for a in args]
+    vmid = controller.toplevel_machine(exe.bindings[name], args)
+    Invoker(controller).invoke(vmid, run_async=False)
+    return controller
+
+
+def test_short_circuit_operands_checked():
+    """Operands of && and || must still be booleans (if they're evaluated)"""
+    exe = compile_text(SOURCE)
+    assert _run(exe, "and_checked", ["0"]).result is False
+    for name, arg in [("and_checked", "2"), ("or_checked", "1")]:
+        controller = _run(exe, name, [arg])
+        assert controller.broken
+        assert "must both be booleans" in controller.get_state(0).error_msg
+
+
+def test_local_slots(tmp_path):
+    exe = compile_text(SOURCE)
+    identifier = exe.bindings["locals"].identifier
+    assert exe.locals[identifier] == ["x", "y", "z"]
+    code = function_code(exe, "locals")
+    assert not any(isinstance(i, mi.PushB) for i in code)
+
+    path = tmp_path / "locals.hk"
+    path.write_text(SOURCE)
+    assert run_local(path, "locals", ["1", "2"]) == [True, "2", 3.0]
+
+
+def test_unresolved_name():
+    exe = compile_text(SOURCE)
+    identifier = exe.bindings["unassigned"].identifier
+    # `a` is only assigned in a dead branch
+    assert exe.locals[identifier] == []
+    code = function_code(exe, "unassigned")
+    assert [str(i.operands[0]) for i in code if isinstance(i, mi.PushB)] == ["b"]
+
+
+def test_local_shadows_global(tmp_path):
+    """The global is read until a local of the same name is assigned"""
+    exe = compile_text(SOURCE)
+    code = function_code(exe, "shadowed")
+    assert any(isinstance(i, mi.PushLB) for i in code)
+    # Other locals are plain slot reads
+    assert not any(isinstance(i, mi.PushLB) for i in function_code(exe, "locals"))
+
+    path = tmp_path / "shadowed.hk"
+    path.write_text(SOURCE)
+    assert run_local(path, "shadowed", []) == [True, 2]
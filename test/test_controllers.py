@@ -2,12 +2,18 @@
 import pytest
 import hark_lang.controllers.ddb_model as db
 import hark_lang.machine.types as mt
+from hark_lang import load
 from hark_lang.controllers.ddb import DataController as DdbController
 from hark_lang.controllers.local import DataController as LocalController
+from hark_lang.controllers.shared import DataController as SharedController
+from hark_lang.executors.thread import Invoker
 from hark_lang.machine.arec import ActivationRecord
+from hark_lang.machine.controller import ControllerError
 from hark_lang.machine.future import Future
+from hark_lang.machine.machine import TlMachine
 from hark_lang.machine.probe import Probe
-from hark_lang.machine.state import State
+from hark_lang.machine.state import Frame, State
+from hark_lang.machine.stdout_item import StdoutItem
 
 pytestmark = pytest.mark.ddblocal
 
@@ -27,6 +33,7 @@ def NewDdbSession():
 
 CONTROLLERS = [
     LocalController,
+    SharedController.with_new_server,
     pytest.param(NewDdbSession, marks=[pytest.mark.ddblocal]),
 ]
 
@@ -39,6 +46,40 @@ def test_new_thread(Controller):
     assert ctrl.is_top_level(t)
 
 
+@pytest.mark.parametrize("Controller", CONTROLLERS)
+def test_stopped(Controller):
+    ctrl = Controller()
+    a, b = ctrl.new_thread(), ctrl.new_thread()
+    # New threads are running
+    assert not ctrl.all_stopped()
+
+    ctrl.set_stopped(a, True)
+    # Setting the same flag twice doesn't count twice
+    ctrl.set_stopped(a, True)
+    assert not ctrl.all_stopped()
+    ctrl.set_stopped(b, True)
+    assert ctrl.all_stopped()
+
+    ctrl.set_stopped(a, False)
+    ctrl.set_stopped(a, False)
+    assert not ctrl.all_stopped()
+    ctrl.set_stopped(a, True)
+    assert ctrl.all_stopped()
+
+
+@pytest.mark.parametrize("Controller", [LocalController, NewDdbSession])
+def test_toplevel_machine_running(Controller):
+    """New threads are already running, so aren't marked as running again"""
+    ctrl = Controller()
+    exe = load.compile_text("fn f(x) { x }")
+    ctrl.set_executable(exe)
+    calls = []
+    ctrl.set_stopped = lambda *args: calls.append(args)
+    ctrl.toplevel_machine(exe.bindings["f"], [mt.TlInt(0)])
+    assert not ctrl.all_stopped()
+    assert calls == []
+
+
 @pytest.mark.parametrize("Controller", CONTROLLERS)
 def test_result(Controller):
     ctrl = Controller()
@@ -59,7 +100,7 @@ def test_arec(Controller):
         vmid=0,
         ref_count=0,
         call_site=0,
-        bindings={"foo": mt.TlString("hello")},
+        locals=[mt.TlString("hello"), None],
     )
     ctrl.set_arec(r, rec)
     rec2 = ctrl.get_arec(r)
@@ -89,6 +130,81 @@ def test_state(Controller):
     ctrl.set_state(t, state)
     assert state == ctrl.get_state(t)
 
+    state.frames.append(
+        Frame(mt.TlFunctionPtr("foo"), 3, [mt.TlInt(1), None], arec_ptr=0)
+    )
+    ctrl.set_state(t, state)
+    assert state == ctrl.get_state(t)
+
+
+def test_state_deltas():
+    ctrl = NewDdbSession()
+    t = ctrl.new_thread()
+    state = ctrl.get_state(t)
+    big = mt.TlList([mt.TlInt(i) for i in range(1000)])
+    state.ds_push(big)
+    ctrl.set_state(t, state)
+
+    for i in range(DdbController.snapshot_interval + 2):
+        state.ip = i
+        state.ds_push(mt.TlInt(i))
+        state.locals = [None, mt.TlInt(i)]
+        ctrl.set_state(t, state)
+        # Only the changes are saved, not the big list
+        item = db.SessionItem.get(ctrl.session_id, f"{db.STATE}:{t}")
+        if item.state_deltas:
+            assert item.state_deltas[-1][5] == [mt.TlInt(i)]
+        other = DdbController.with_session_id(ctrl.session_id)
+        assert other.get_state(t) == state
+
+    # Another controller saves deltas -- this one must notice
+    other = DdbController.with_session_id(ctrl.session_id)
+    other_state = other.get_state(t)
+    other_state.ds_pop()
+    other.set_state(t, other_state)
+    state.ip = 100
+    ctrl.set_state(t, state)
+    assert DdbController.with_session_id(ctrl.session_id).get_state(t) == state
+
+
+def test_state_deltas_after_full_save():
+    """A full save elsewhere resets the deltas -- stale deltas aren't applied"""
+    ctrl = NewDdbSession()
+    t = ctrl.new_thread()
+    # Neither controller has loaded the state, so both save all of it
+    state = State([mt.TlInt(7)])
+    ctrl.set_state(t, state)
+    other = DdbController.with_session_id(ctrl.session_id)
+    other.set_state(t, State([mt.TlInt(1), mt.TlInt(2)]))
+    # This controller's delta is against the old state
+    state.ip = 5
+    ctrl.set_state(t, state)
+    assert DdbController.with_session_id(ctrl.session_id).get_state(t) == state
+
+
+def test_state_deltas_materialised_frames():
+    """Frames materialised after the State is loaded are saved"""
+    ctrl = NewDdbSession()
+    exe = load.compile_text("fn f(x) { x }")
+    ctrl.set_executable(exe)
+    fn_ptr = exe.bindings["f"]
+    top = ctrl.toplevel_machine(fn_ptr, [mt.TlInt(0)])
+    invoker = Invoker(ctrl)
+    m = TlMachine(top, invoker)
+    m.state.frames.append(Frame(fn_ptr, 3, [None]))
+    ctrl.set_state(top, m.state)
+
+    # Resumed (reloaded), and then forks
+    m = TlMachine(top, invoker)
+    ptr = m._materialise_frames()
+    ctrl.set_state(top, m.state)
+
+    state = DdbController.with_session_id(ctrl.session_id).get_state(top)
+    assert state.frames[0].arec_ptr == ptr
+    # Forking again doesn't make another record
+    m = TlMachine(top, invoker)
+    assert m._materialise_frames() == ptr
+
 
 @pytest.mark.parametrize("Controller", CONTROLLERS)
 def test_probe(Controller):
@@ -98,6 +214,7 @@ def test_probe(Controller):
     probe.log("foobar")
 
     ctrl.set_probe_data(t, probe)
+    ctrl.flush()
     logs = ctrl.get_probe_logs()
     assert len(logs) == 1
     assert logs[0].text == "foobar"
@@ -122,3 +239,142 @@ def test_future(Controller):
     ctrl.add_continuation(t, 5)
     f2 = ctrl.get_future(t)
     assert f2.continuations == [5]
+
+
+@pytest.mark.parametrize("Controller", CONTROLLERS)
+def test_wait_and_chain(Controller):
+    ctrl = Controller()
+    waiter, a, b = [ctrl.new_thread() for _ in range(3)]
+    for t in (waiter, a, b):
+        ctrl.set_future(t, Future())
+
+    assert ctrl.get_or_wait(waiter, mt.TlFuturePtr(a)) == (False, None)
+    # B finishes with A's future, so it resolves when A does
+    assert ctrl.finish(b, mt.TlFuturePtr(a)) == (None, [])
+    assert ctrl.resolve_future(a, mt.TlInt(1)) == [waiter]
+    assert ctrl.get_future(b).value == mt.TlInt(1)
+
+    # Nothing waits on a resolved future
+    assert ctrl.get_or_wait(waiter, mt.TlFuturePtr(b)) == (True, mt.TlInt(1))
+    assert ctrl.get_future(b).continuations == []
+    assert ctrl.finish(waiter, mt.TlFuturePtr(a)) == (mt.TlInt(1), [])
+
+
+@pytest.mark.parametrize("Controller", CONTROLLERS)
+def test_wait_all(Controller):
+    ctrl = Controller()
+    waiter, a, b, c = [ctrl.new_thread() for _ in range(4)]
+    for t in (a, b, c):
+        ctrl.set_future(t, Future())
+    ptrs = [mt.TlFuturePtr(t) for t in (a, b, c)]
+
+    ctrl.resolve_future(a, mt.TlInt(1))
+    assert ctrl.get_all_or_wait(waiter, ptrs) == (False, None)
+
+    # The waiter is only continued when the last future resolves
+    assert ctrl.resolve_future(c, mt.TlInt(3)) == []
+    assert ctrl.resolve_future(b, mt.TlInt(2)) == [waiter]
+
+    values = [mt.TlInt(1), mt.TlInt(2), mt.TlInt(3)]
+    assert ctrl.get_all_or_wait(waiter, ptrs) == (True, values)
+
+
+@pytest.mark.parametrize("Controller", CONTROLLERS)
+def test_thread_machines(Controller):
+    ctrl = Controller()
+    exe = load.compile_text("fn f(x) { x }")
+    ctrl.set_executable(exe)
+    fn_ptr = exe.bindings["f"]
+    top = ctrl.toplevel_machine(fn_ptr, [mt.TlInt(0)])
+    parent_ptr = ctrl.get_state(top).current_arec_ptr
+
+    calls = [(fn_ptr, [mt.TlInt(i)]) for i in range(1, 4)]
+    vmids = ctrl.thread_machines(parent_ptr, 5, calls)
+
+    assert vmids == [1, 2, 3]
+    assert ctrl.get_thread_ids() == [0, 1, 2, 3]
+    assert not ctrl.all_stopped()
+    assert ctrl.get_arec(parent_ptr).ref_count == 4
+    ptrs = set()
+    for vmid, (_, args) in zip(vmids, calls):
+        state = ctrl.get_state(vmid)
+        assert state._ds == args
+        assert state.ip == exe.locations[fn_ptr.identifier]
+        arec = ctrl.get_arec(state.current_arec_ptr)
+        assert arec.vmid == vmid
+        assert arec.dynamic_chain == parent_ptr
+        assert arec.call_site == 4
+        assert not ctrl.get_future(vmid).resolved
+        ptrs.add(state.current_arec_ptr)
+    assert len(ptrs) == 3
+
+
+def test_output_chunks():
+    ctrl = NewDdbSession()
+    ctrl.chunk_size = 200
+    # Sessions saved before output was chunked have a single item
+    db.new_session_item(
+        ctrl.session_id, db.STDOUT, stdout=[StdoutItem(0, "old\n").serialise()]
+    ).save()
+
+    for i in range(20):
+        ctrl.write_stdout(StdoutItem(0, f"line {i}\n"))
+    ctrl.flush()
+    texts = [item.text for item in ctrl.get_stdout()]
+    assert texts == ["old\n"] + [f"line {i}\n" for i in range(20)]
+    # Read a few chunks at a time
+    items, cursor = ctrl.read_stream(db.STDOUT, limit=2)
+    assert len(items) < 21
+    rest, cursor = ctrl.read_stream(db.STDOUT, cursor)
+    assert [item["text"] for item in items + rest] == texts
+
+    # Only new output is read after the cursor
+    ctrl.write_stdout(StdoutItem(1, "new\n"))
+    ctrl.flush()
+    items, _ = ctrl.read_stream(db.STDOUT, cursor)
+    assert [item["text"] for item in items] == ["new\n"]
+
+
+def test_unsaved_arecs():
+    ctrl = NewDdbSession()
+    exe = load.compile_text("fn f(x) { x }")
+    ctrl.set_executable(exe)
+    fn_ptr = exe.bindings["f"]
+    top = ctrl.toplevel_machine(fn_ptr, [mt.TlInt(0)])
+    # Saved by toplevel_machine, so other controllers can run the thread
+    other = DdbController.with_session_id(ctrl.session_id)
+    top_ptr = other.get_state(top).current_arec_ptr
+    assert other.get_arec(top_ptr).vmid == top
+
+    # New records are only in memory...
+    rec = ActivationRecord(
+        function=fn_ptr,
+        dynamic_chain=top_ptr,
+        vmid=top,
+        ref_count=1,
+        call_site=0,
+        locals=[None],
+    )
+    ptr = ctrl.push_arec(top, rec)
+    ctrl.increment_ref(ptr)
+    assert ctrl.get_arec(ptr).ref_count == 2
+    with pytest.raises(ControllerError):
+        other.get_arec(ptr)
+
+    # ...until a thread is forked, as it may refer to them
+    ctrl.thread_machine(ptr, 5, fn_ptr, [mt.TlInt(1)])
+    assert other.get_arec(ptr).ref_count == 3
+    assert other.get_arec(ptr).dynamic_chain == top_ptr
+
+    # Or they're flushed
+    rec2 = ActivationRecord(
+        function=fn_ptr,
+        dynamic_chain=None,
+        vmid=top,
+        ref_count=1,
+        call_site=0,
+        locals=[mt.TlInt(2)],
+    )
+    ptr2 = ctrl.push_arec(top, rec2)
+    ctrl.flush()
+    assert other.get_arec(ptr2) == rec2
@@ -1,6 +1,7 @@
 import logging
 import random
 import sys
+from functools import partial
 from pathlib import Path
 
 import pytest
@@ -8,12 +9,21 @@ import hark_lang.controllers.ddb_model as db
 import hark_lang.examples as hark_examples
 from hark_lang.machine.types import TlType, to_py_type, to_hark_type
 from hark_lang.run.dynamodb import run_ddb_local, run_ddb_processes
-from hark_lang.run.local import run_local
+from hark_lang.run.local import (
+    run_local,
+    run_local_async,
+    run_local_green,
+    run_local_processes,
+)
 
 LOG = logging.getLogger(__name__)
 
 CALL_METHODS = [
     run_local,
+    pytest.param(partial(run_local, workers=2), id="run_local_pool"),
+    run_local_green,
+    run_local_async,
+    pytest.param(run_local_processes, marks=[pytest.mark.slow]),
     pytest.param(run_ddb_local, marks=[pytest.mark.slow, pytest.mark.ddblocal]),
     pytest.param(run_ddb_processes, marks=[pytest.mark.slow, pytest.mark.ddblocal]),
 ]
@@ -0,0 +1,67 @@
+import json
+from pathlib import Path
+
+import pytest
+
+from hark_lang.cli import interface as ui
+from hark_lang.exceptions import UserResolvableError
+from hark_lang.load import compile_file
+from hark_lang.machine.executable import Executable
+from hark_lang.machine.types import TlInt, TlSymbol
+
+EXAMPLES_SUBDIR = Path(__file__).parent / "examples"
+
+
+def to_json_and_back(exe: Executable) -> Executable:
+    return Executable.deserialise(json.loads(json.dumps(exe.serialise())))
+
+
+def test_packed_roundtrip():
+    exe = compile_file(EXAMPLES_SUBDIR / "kitchen_sink.hk")
+    deser = to_json_and_back(exe)
+    assert deser.code == exe.code
+    assert [i.source for i in deser.code] == [i.source for i in exe.code]
+    assert deser.locations == exe.locations
+    assert deser.bindings == exe.bindings
+
+
+def test_packed_is_smaller():
+    exe = compile_file(EXAMPLES_SUBDIR / "kitchen_sink.hk")
+    legacy = dict(exe.serialise(), code=[i.serialise() for i in exe.code])
+    assert len(json.dumps(exe.serialise())) < len(json.dumps(legacy))
+
+
+def test_legacy_format():
+    exe = compile_file(EXAMPLES_SUBDIR / "kitchen_sink.hk")
+    legacy = dict(exe.serialise(), code=[i.serialise() for i in exe.code])
+    deser = Executable.deserialise(json.loads(json.dumps(legacy)))
+    assert deser.code == exe.code
+
+
+def test_no_locals(monkeypatch):
+    """Executables saved before local variable slots can be read, not run"""
+    old = {
+        "locations": {"main": 0},
+        "bindings": {},
+        "code": [
+            ["PushV", [TlInt(1).serialise()], [None, None, None, None]],
+            ["Bind", [TlSymbol("x").serialise()], [None, None, None, None]],
+            ["PushB", [TlSymbol("x").serialise()], [None, None, None, None]],
+            ["Return", [], [None, None, None, None]],
+        ],
+    }
+    deser = Executable.deserialise(json.loads(json.dumps(old)))
+    assert deser.code[1].operands == (TlSymbol("x"),)
+    monkeypatch.setattr(ui, "primary", str)
+    deser.listing()
+    with pytest.raises(UserResolvableError):
+        deser.check_runnable()
+    with pytest.raises(UserResolvableError):
+        deser.new_frame("main")
+
+
+def test_no_functions_runnable():
+    exe = Executable(bindings={}, locations={}, code=[], attributes=None)
+    exe = to_json_and_back(exe)
+    assert exe.locals == {}
+    exe.check_runnable()
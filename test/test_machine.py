@@ -0,0 +1,469 @@
+"""Test TlMachine features"""
+import threading
+import time
+
+import pytest
+
+import hark_lang.machine.machine as machine
+import hark_lang.machine.probe as probe
+from hark_lang import load
+from hark_lang.controllers.local import DataController as LocalController
+from hark_lang.exceptions import UserResolvableError
+from hark_lang.executors import aio, multiprocess, scheduler
+from hark_lang.executors.thread import Invoker, PoolInvoker
+from hark_lang.machine.probe import ProbeLevel
+from hark_lang.machine.types import TlInt
+
+
+COUNT = """
+fn count(n, acc) {
+  if n == 0 {
+    acc
+  }
+  else {
+    count(n - 1, acc + 1)
+  }
+}
+"""
+
+
+class RecordingInvoker(Invoker):
+    def __init__(self, data_controller):
+        super().__init__(data_controller)
+        self.invoked = []
+
+    def invoke(self, vmid, run_async=True):
+        self.invoked.append(vmid)
+        super().invoke(vmid, run_async=False)
+
+
+class FakeClock:
+    """A clock that advances by one second every time it is read"""
+
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        self.now += 1
+        return self.now
+
+
+def _new_machine(n):
+    controller = LocalController()
+    exe = load.compile_text(COUNT)
+    controller.set_executable(exe)
+    vmid = controller.toplevel_machine(exe.bindings["count"], [TlInt(n), TlInt(0)])
+    invoker = RecordingInvoker(controller)
+    return controller, invoker, machine.TlMachine(vmid, invoker)
+
+
+def test_run_without_deadline():
+    controller, invoker, m = _new_machine(3000)
+    m.run()
+    assert controller.result == 3000
+    assert invoker.invoked == []
+
+
+def test_checkpoint_before_deadline():
+    controller, invoker, m = _new_machine(3000)
+    m.run(deadline=2, clock=FakeClock())
+    # Checkpointed after the 2nd check, and continued in a new machine
+    assert invoker.invoked == [m.vmid]
+    assert m._steps == 2 * machine.STEPS_PER_DEADLINE_CHECK
+    assert controller.result == 3000
+    events = [e.event for e in controller.get_probe_events()]
+    assert events.count("checkpoint") == 1
+
+
+def test_deadline_already_passed():
+    """Some progress is made even if there's no time left"""
+    controller, invoker, m = _new_machine(3000)
+    m.run(deadline=-1, clock=FakeClock())
+    assert m._steps == machine.STEPS_PER_DEADLINE_CHECK
+    assert invoker.invoked == [m.vmid]
+    assert controller.result == 3000
+
+
+def test_finish_before_deadline():
+    controller, invoker, m = _new_machine(3)
+    m.run(deadline=2, clock=FakeClock())
+    assert invoker.invoked == []
+    assert controller.result == 3
+
+
+FANOUT = """
+fn double(x) {
+  x * 2
+}
+
+fn spawn(n, acc) {
+  if n == 0 {
+    acc
+  }
+  else {
+    spawn(n - 1, append(acc, async double(n)))
+  }
+}
+
+fn total(futures, acc) {
+  if nullp(futures) {
+    acc
+  }
+  else {
+    total(rest(futures), acc + await first(futures))
+  }
+}
+
+fn fanout(n) {
+  total(spawn(n, []), 0)
+}
+"""
+
+
+def test_scheduler_fanout():
+    """Lots of Hark threads run on one Python thread"""
+    n = 2000
+    controller = LocalController()
+    exe = load.compile_text(FANOUT)
+    controller.set_executable(exe)
+    vmid = controller.toplevel_machine(exe.bindings["fanout"], [TlInt(n)])
+    invoker = scheduler.Invoker(controller)
+    threads_before = threading.active_count()
+
+    invoker.invoke(vmid, run_async=False)
+
+    assert threading.active_count() <= threads_before
+    assert controller.all_stopped()
+    assert not controller.broken
+    assert controller.result == n * (n + 1)
+
+
+def test_scheduler_reuses_machine(monkeypatch):
+    made = []
+
+    class CountingMachine(machine.TlMachine):
+        def __init__(self, *args):
+            made.append(self)
+            super().__init__(*args)
+
+    monkeypatch.setattr(scheduler, "TlMachine", CountingMachine)
+    controller = LocalController()
+    exe = load.compile_text(FANOUT)
+    controller.set_executable(exe)
+    vmid = controller.toplevel_machine(exe.bindings["fanout"], [TlInt(10)])
+    scheduler.Invoker(controller).invoke(vmid, run_async=False)
+    assert controller.result == 10 * 11
+    assert len(made) == 1
+
+
+def test_scheduler_records_exceptions():
+    controller = LocalController()
+    exe = load.compile_text(FANOUT)
+    controller.set_executable(exe)
+    invoker = scheduler.Invoker(controller)
+    invoker.invoke(99, run_async=False)  # no such thread
+    assert invoker.exception is not None
+    # And it carries on
+    vmid = controller.toplevel_machine(exe.bindings["fanout"], [TlInt(3)])
+    invoker.invoke(vmid, run_async=False)
+    assert controller.result == 3 * 4
+
+
+SLEEPS = """
+import(sleep, :python asyncio, 1);
+import(sqrt, :python math, 1);
+
+fn nap(x) {
+  sleep(0.2);
+  x
+}
+
+fn naps() {
+  a = async nap(1);
+  b = async nap(2);
+  c = async nap(3);
+  await a + await b + await c
+}
+
+fn bad_sqrt() {
+  sqrt(-1)
+}
+"""
+
+
+def _run_async(function):
+    controller = LocalController()
+    exe = load.compile_text(SLEEPS)
+    controller.set_executable(exe)
+    vmid = controller.toplevel_machine(exe.bindings[function], [])
+    with aio.Invoker(controller) as invoker:
+        invoker.invoke(vmid, run_async=False)
+    assert controller.all_stopped()
+    return controller
+
+
+def test_async_foreign_calls_are_concurrent():
+    start = time.time()
+    controller = _run_async("naps")
+    assert time.time() - start < 0.5
+    assert controller.result == 6
+
+
+def test_async_foreign_error():
+    controller = _run_async("bad_sqrt")
+    assert controller.broken
+    assert "math domain error" in controller.get_state(0).error_msg
+
+
+NESTED_FUTURES = """
+fn one() {
+  1
+}
+
+fn nested_list() {
+  futures = list(async one(), list(async one()));
+  await futures
+}
+
+fn nested_hash() {
+  futures = list(async one(), hash("a", async one()));
+  await futures
+}
+
+fn top_level() {
+  futures = list(async one(), list(2));
+  await futures
+}
+"""
+
+
+@pytest.mark.parametrize("function", ["nested_list", "nested_hash"])
+def test_wait_mixed_nested_futures(function):
+    """Futures in nested data are an error, even with top-level futures too"""
+    controller = LocalController()
+    exe = load.compile_text(NESTED_FUTURES)
+    controller.set_executable(exe)
+    vmid = controller.toplevel_machine(exe.bindings[function], [])
+    scheduler.Invoker(controller).invoke(vmid, run_async=False)
+    assert controller.broken
+    assert "nested" in controller.get_state(0).error_msg
+
+
+def test_wait_top_level_futures():
+    controller = LocalController()
+    exe = load.compile_text(NESTED_FUTURES)
+    controller.set_executable(exe)
+    vmid = controller.toplevel_machine(exe.bindings["top_level"], [])
+    scheduler.Invoker(controller).invoke(vmid, run_async=False)
+    assert not controller.broken
+    assert controller.result == [1, [2]]
+
+
+def test_pool_invoker_fanout():
+    """Only a few Python threads are used, however many Hark threads there are"""
+    n = 500
+    controller = LocalController()
+    exe = load.compile_text(FANOUT)
+    controller.set_executable(exe)
+    vmid = controller.toplevel_machine(exe.bindings["fanout"], [TlInt(n)])
+    threads_before = threading.active_count()
+
+    with PoolInvoker(controller, max_workers=3) as invoker:
+        invoker.invoke(vmid, run_async=False)
+        start = time.time()
+        while not controller.all_stopped() and time.time() - start < 10:
+            time.sleep(0.05)
+        assert threading.active_count() <= threads_before + 3
+
+    assert threading.active_count() <= threads_before
+    assert invoker.exception is None
+    assert controller.result == n * (n + 1)
+
+
+JOIN = """
+fn child(x) {
+  x + 1
+}
+
+fn parent() {
+  a = async child(1);
+  b = async child(2);
+  await a + await b
+}
+"""
+
+
+class QueueInvoker(Invoker):
+    """Only run machines when asked to"""
+
+    def __init__(self, data_controller):
+        super().__init__(data_controller)
+        self.queue = []
+        self.invoked = []
+
+    def invoke(self, vmid, run_async=True):
+        self.invoked.append(vmid)
+        self.queue.append(vmid)
+
+    def run_all(self):
+        while self.queue:
+            machine.TlMachine(self.queue.pop(0), self).run()
+
+
+def test_continue_waiting_thread_inline():
+    controller = LocalController()
+    exe = load.compile_text(JOIN)
+    controller.set_executable(exe)
+    vmid = controller.toplevel_machine(exe.bindings["parent"], [])
+    invoker = QueueInvoker(controller)
+    invoker.invoke(vmid)
+    invoker.run_all()
+    assert controller.all_stopped()
+    assert controller.result == 5
+    # The parent waits for each child, but is continued by the child machine
+    # each time, not invoked again
+    assert invoker.invoked == [vmid, 1, 2]
+
+
+PMAP = """
+fn double(x) {
+  x * 2
+}
+
+fn range(n, acc) {
+  if n == 0 {
+    acc
+  }
+  else {
+    range(n - 1, conc(n, acc))
+  }
+}
+
+fn doubles(n, chunk) {
+  pmap(double, range(n, []), chunk)
+}
+"""
+
+
+def _run_pmap(n, chunk):
+    controller = LocalController()
+    exe = load.compile_text(PMAP)
+    controller.set_executable(exe)
+    args = [TlInt(n), TlInt(chunk)]
+    vmid = controller.toplevel_machine(exe.bindings["doubles"], args)
+    scheduler.Invoker(controller).invoke(vmid, run_async=False)
+    assert controller.all_stopped()
+    assert not controller.broken
+    return controller
+
+
+def test_pmap_tree():
+    n = 100
+    controller = _run_pmap(n, 5)
+    assert controller.result == [2 * i for i in range(1, n + 1)]
+    # One thread per chunk, forked in a tree - the top-level thread only forks
+    # ceil(log2(20)) of them
+    assert len(controller.get_thread_ids()) == n // 5
+    forks = [e for e in controller.get_probe_events() if e.event == "fork"]
+    assert len(forks) == n // 5 - 1
+    assert len([e for e in forks if e.thread == 0]) == 5
+
+
+def test_pmap_empty():
+    controller = _run_pmap(0, 1)
+    assert controller.result == []
+    assert len(controller.get_thread_ids()) == 1
+
+
+CALLS = """
+fn double(x) {
+  x * 2
+}
+
+fn main() {
+  double(1) + double(2)
+}
+"""
+
+
+def _probed_run(monkeypatch, level, sample=1):
+    monkeypatch.setattr(probe, "DEFAULT_LEVEL", level)
+    monkeypatch.setattr(probe, "DEFAULT_SAMPLE", sample)
+    controller = LocalController()
+    exe = load.compile_text(CALLS)
+    controller.set_executable(exe)
+    vmid = controller.toplevel_machine(exe.bindings["main"], [])
+    m = machine.TlMachine(vmid, Invoker(controller))
+    m.run()
+    assert controller.result == 6
+    return controller, m
+
+
+@pytest.mark.parametrize(
+    "level,events",
+    [
+        (ProbeLevel.OFF, set()),
+        (ProbeLevel.LIFECYCLE, {"run", "stop"}),
+        (ProbeLevel.CALLS, {"run", "stop", "call", "return"}),
+        (ProbeLevel.STEPS, {"run", "stop", "call", "return", "step"}),
+    ],
+)
+def test_probe_levels(monkeypatch, level, events):
+    controller, m = _probed_run(monkeypatch, level)
+    recorded = [e.event for e in controller.get_probe_events()]
+    assert set(recorded) == events
+    if level >= ProbeLevel.STEPS:
+        assert recorded.count("step") == m._steps
+    assert bool(controller.get_probe_logs()) == (level >= ProbeLevel.LIFECYCLE)
+
+
+def test_probe_sampling(monkeypatch):
+    controller, m = _probed_run(monkeypatch, ProbeLevel.STEPS, sample=4)
+    steps = [e for e in controller.get_probe_events() if e.event == "step"]
+    assert len(steps) == (m._steps + 3) // 4
+
+
+class FakeProcess:
+    started = []
+
+    def __init__(self, target, args):
+        self.target = target
+        self.args = args
+
+    def start(self):
+        FakeProcess.started.append(self)
+
+
+def test_probe_settings_passed_to_processes(monkeypatch):
+    monkeypatch.setattr(multiprocess.multiprocessing, "Process", FakeProcess)
+    monkeypatch.setattr(probe, "DEFAULT_LEVEL", ProbeLevel.STEPS)
+    monkeypatch.setattr(probe, "DEFAULT_SAMPLE", 4)
+    controller = LocalController()
+    exe = load.compile_text(CALLS)
+    controller.set_executable(exe)
+    vmid = controller.toplevel_machine(exe.bindings["main"], [])
+    multiprocess.Invoker(controller).invoke(vmid)
+    # Run the "child" with fresh defaults, as a spawned process would have
+    probe.DEFAULT_LEVEL = ProbeLevel.OFF
+    probe.DEFAULT_SAMPLE = 1
+    child = FakeProcess.started.pop()
+    multiprocess.run_shared(controller, vmid, child.args[-1])
+    assert controller.result == 6
+    events = [e.event for e in controller.get_probe_events()]
+    assert "step" in events
+    assert probe.DEFAULT_SAMPLE == 4
+
+
+def test_probe_settings_from_env(monkeypatch):
+    monkeypatch.setenv("HARK_PROBE_LEVEL", "steps")
+    monkeypatch.setenv("HARK_PROBE_SAMPLE", "5")
+    assert probe.level_from_env() == ProbeLevel.STEPS
+    assert probe.sample_from_env() == 5
+    # Bad settings are ignored, not fatal (they're read on import)
+    monkeypatch.setenv("HARK_PROBE_LEVEL", "everything")
+    assert probe.level_from_env() == ProbeLevel.CALLS
+    for bad in ["0", "-2", "often"]:
+        monkeypatch.setenv("HARK_PROBE_SAMPLE", bad)
+        assert probe.sample_from_env() == 1
+    with pytest.raises(UserResolvableError):
+        probe.configure(sample=0)
@@ -0,0 +1,91 @@
+import hark_lang.machine.instructionset as mi
+from hark_lang.load import compile_text
+from hark_lang.run.local import run_local
+
+
+def function_code(exe, name):
+    """Get the code of a single function"""
+    identifier = exe.bindings[name].identifier
+    start = exe.locations[identifier]
+    ends = sorted(loc for loc in exe.locations.values() if loc > start)
+    end = ends[0] if ends else len(exe.code)
+    return exe.code[start:end]
+
+
+SOURCE = """
+fn add(x, y) {
+  x + y
+}
+
+fn shadowed(length) {
+  length(1)
+}
+
+fn cond(x) {
+  if true {
+    print(x)
+  }
+  else {
+    x
+  }
+}
+
+fn loop(n, acc) {
+  if n == 0 {
+    acc
+  }
+  else {
+    loop(n - 1, acc + n)
+  }
+}
+
+fn main(n) {
+  loop(parse_float(n), 0)
+}
+"""
+
+
+def test_superinstructions():
+    exe = compile_text(SOURCE)
+    code = function_code(exe, "add")
+    assert [type(i) for i in code] == [
+        mi.BindPop,
+        mi.BindPop,
+        mi.PushL,
+        mi.PushL,
+        mi.Plus,
+        mi.Return,
+    ]
+
+
+def test_shadowed_builtin():
+    exe = compile_text(SOURCE)
+    code = function_code(exe, "shadowed")
+    assert not any(isinstance(i, mi.CallBuiltin) for i in code)
+    assert [type(i) for i in code[-3:]] == [mi.PushL, mi.Call, mi.Return]
+
+
+def test_global_call():
+    exe = compile_text(SOURCE)
+    code = function_code(exe, "main")
+    calls = [i for i in code if isinstance(i, mi.CallBound)]
+    assert len(calls) == 1
+    assert calls[0].operands[1] == exe.bindings["loop"]
+
+
+def test_constant_condition():
+    exe = compile_text(SOURCE)
+    code = function_code(exe, "cond")
+    assert not any(isinstance(i, mi.JumpIf) for i in code)
+
+
+def test_fewer_instructions():
+    assert len(compile_text(SOURCE).code) < len(
+        compile_text(SOURCE, optimise=False).code
+    )
+
+
+def test_jumps_retargeted(tmp_path):
+    path = tmp_path / "loop.hk"
+    path.write_text(SOURCE)
+    assert run_local(path, "main", ["10"]) == 55
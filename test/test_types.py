@@ -1,6 +1,7 @@
 import pytest
 import json
 
+from hark_lang.machine.pvector import PVector
 from hark_lang.machine.types import *
 
 
@@ -53,7 +54,7 @@ def test_lists():
 def test_list():
     list_a = TlList([TlInt(1), TlInt(2), TlInt(3)])
     assert len(list_a) == 3
-    list_a.append(TlInt(789))
+    list_a = list_a.appended(TlInt(789))
     assert len(list_a) == 4
     deser = to_json_and_back(list_a)
     print(deser)
@@ -61,6 +62,131 @@ def test_list():
     assert deser[3] == TlInt(789)
 
 
+def test_list_persistence():
+    original = TlList([TlInt(i) for i in range(5)])
+    appended = original.appended(TlInt(5))
+    prepended = original.prepended(TlInt(-1))
+    rest = original.rest()
+    assert list(original) == list(range(5))
+    assert list(appended) == list(range(6))
+    assert list(prepended) == list(range(-1, 5))
+    assert list(rest) == list(range(1, 5))
+    assert prepended.rest() == original
+    assert original.concat(rest) == [0, 1, 2, 3, 4, 1, 2, 3, 4]
+    assert TlList([]).rest() == []
+
+
+@pytest.mark.parametrize("size", [0, 1, 31, 32, 33, 1024, 1057, 40000])
+def test_list_large(size):
+    lst = TlList()
+    for i in range(size):
+        lst = lst.appended(TlInt(i))
+    assert len(lst) == size
+    assert list(lst) == list(range(size))
+    assert lst == TlList([TlInt(i) for i in range(size)])
+    if size:
+        assert lst[size // 2] == size // 2
+        assert lst[-1] == size - 1
+    for _ in range(min(size, 100)):
+        lst = lst.rest()
+    assert list(lst) == list(range(min(size, 100), size))
+
+
+def test_pvector_pop():
+    vec = PVector.from_iterable(range(2000))
+    for size in range(1999, -1, -1):
+        vec = vec.pop()
+        assert len(vec) == size
+        if size:
+            assert vec.nth(size - 1) == size - 1
+    assert list(PVector.from_iterable(range(1100)).pop()) == list(range(1099))
+
+
+def test_pvector_assoc():
+    vec = PVector.from_iterable(range(1100))
+    for idx in [0, 31, 32, 1023, 1024, 1099]:
+        changed = vec.assoc(idx, -1)
+        assert changed.nth(idx) == -1
+        assert list(changed) == [-1 if i == idx else i for i in range(1100)]
+    assert list(vec) == list(range(1100))
+    assert list(vec.rest().assoc(0, "x"))[:2] == ["x", 2]
+
+
+def test_hash_persistence():
+    original = TlHash({TlString("a"): TlInt(1), TlString("b"): TlInt(2)})
+    updated = original.set(TlString("a"), TlInt(3)).set(TlString("c"), TlInt(4))
+    assert to_py_type(original) == {"a": 1, "b": 2}
+    assert to_py_type(updated) == {"a": 3, "b": 2, "c": 4}
+    # Insertion order is kept
+    assert list(updated) == ["a", "b", "c"]
+    assert TlString("c") not in original
+
+
+class Colliding(TlString):
+    """A string with a terrible hash"""
+
+    def __hash__(self):
+        return 7
+
+
+def test_hash_large():
+    h = TlHash()
+    for i in range(5000):
+        h = h.set(TlInt(i), TlInt(i * 2))
+        h = h.set(TlString(str(i)), TlInt(i))
+    assert len(h) == 10000
+    assert all(h[TlInt(i)] == i * 2 for i in range(5000))
+    assert list(h)[:4] == [0, "0", 1, "1"]
+    # Updating a key keeps its position
+    h = h.set(TlInt(1), TlInt(-1))
+    assert list(h.items())[2] == (TlInt(1), TlInt(-1))
+
+    c = TlHash({Colliding(str(i)): TlInt(i) for i in range(20)})
+    c = c.set(TlInt(7), TlInt(-1)).set(Colliding("3"), TlInt(33))
+    assert len(c) == 21
+    assert c[Colliding("3")] == 33 and c[TlInt(7)] == -1
+    assert Colliding("20") not in c
+
+
+EQUALITY_TEST_OBJS = [
+    TlNull(),
+    TlTrue(),
+    TlFalse(),
+    TlInt(1),
+    TlString("foo"),
+    TlFuturePtr(3),
+    TlQuote(TlString("foo")),
+    TlList([TlInt(1), TlList([TlString("x")])]),
+    TlHash({TlString("a"): TlList([TlInt(1)]), TlInt(2): TlNull()}),
+    TlFunctionPtr("#1:foo"),
+    TlForeignPtr("foo", "pysrc", "pysrc.foo"),
+]
+
+
+@pytest.mark.parametrize("obj", EQUALITY_TEST_OBJS)
+def test_equality(obj):
+    copy = TlType.deserialise(obj.serialise())
+    assert copy is not obj
+    assert copy == obj and not copy != obj
+    assert hash(copy) == hash(obj)
+    others = [o for o in EQUALITY_TEST_OBJS if o is not obj]
+    assert all(obj != o for o in others)
+
+
+def test_equality_values():
+    assert TlList([TlInt(1), TlInt(2)]) != TlList([TlInt(1)])
+    assert TlList([TlInt(1), TlInt(2)]) != TlList([TlInt(1), TlInt(3)])
+    assert TlHash({TlInt(1): TlInt(2)}) != TlHash({TlInt(1): TlInt(3)})
+    assert TlHash({TlInt(1): TlInt(2)}) != TlHash({TlInt(2): TlInt(2)})
+    assert TlFunctionPtr("#1:foo") != TlFunctionPtr("#2:bar")
+    assert TlNull() != None
+    # Values of different types are different, even with the same data
+    assert TlString("a") != TlSymbol("a") and not TlString("a") == TlSymbol("a")
+    assert TlInstruction("a") != TlString("a")
+    assert TlList([TlString("a")]) != TlList([TlSymbol("a")])
+    assert TlString("a") == "a"
+
+
 def test_quote():
     obj = TlQuote(TlList([TlInt(1), TlString("foo")]))
     deser = to_json_and_back(obj)